@@ -14,9 +14,21 @@ from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
 from datetime import timedelta
 from math import radians, sin, cos, sqrt, atan2
 from pytz import timezone as pytz_timezone
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from werkzeug.utils import secure_filename
 import uuid
+import threading
+import hashlib
+import sqlite3
+import atexit
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # ویندوز: قفل بین پردازه‌ای در دسترس نیست
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-2024'
@@ -33,6 +45,200 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'doc', 'docx', 'xls',
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
 
+# ==============================================
+# کش نسخه‌دار داده‌ها (Dataset Cache)
+# ==============================================
+# هر DataFrame تمیزشده بر اساس (مسیر، شیت، زمان تغییر، حجم) نگهداری می‌شود
+# و فقط وقتی فایل عوض شود دوباره خوانده می‌شود.
+# با Copy-on-Write، نسخه سطحی هر DataFrame مثل یک نمای فقط‌خواندنی است:
+# تغییرات هر route فقط روی نسخه خودش اعمال می‌شود و داده کش دست نمی‌خورد.
+#
+# ⚠️ این تنظیم سراسری است و رفتار pandas را در کل برنامه عوض می‌کند:
+# - انتساب زنجیره‌ای (df[col][mask] = x یا df[col].fillna(..., inplace=True))
+#   دیگر DataFrame اصلی را تغییر نمی‌دهد؛ همیشه از df.loc[mask, col] = x استفاده کنید.
+# - آرایه‌های to_numpy()/values ستون‌ها فقط‌خواندنی‌اند؛ برای تغییر، اول copy() بگیرید.
+# - به‌روزرسانی‌های درجا مثل customers_df.loc[...] = ... (موقعیت مشتری)،
+#   tours_df.loc[...] = ... (وضعیت تور) و status_df.loc[...] = ... (وضعیت آنلاین)
+#   روی نسخه سطحی برگشتی از کش انجام می‌شوند؛ همین تنظیم باعث می‌شود قبل از
+#   نوشتن کپی شوند و DataFrame کش‌شده خراب نشود.
+pd.set_option('mode.copy_on_write', True)
+
+_dataset_cache = {}
+_dataset_cache_lock = threading.Lock()
+_dataset_load_locks = {}
+
+
+def get_file_version(path):
+    """نسخه فایل بر اساس زمان تغییر و حجم - اگر فایل نباشد None"""
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+
+def load_cached_dataset(path, sheet_name, reader):
+    """
+    بارگذاری یک DataFrame از کش نسخه‌دار
+
+    Args:
+        path: مسیر فایل Excel
+        sheet_name: نام شیت (فقط برای کلید کش)
+        reader: تابعی که فایل را می‌خواند و DataFrame تمیزشده برمی‌گرداند
+
+    Returns:
+        نسخه سطحی (فقط‌خواندنی) از DataFrame یا خروجی reader اگر DataFrame نباشد
+    """
+    key = (os.path.abspath(path), sheet_name)
+
+    with _dataset_cache_lock:
+        load_lock = _dataset_load_locks.setdefault(key, threading.Lock())
+
+    # فقط یک thread فایل را می‌خواند، بقیه منتظر نتیجه می‌مانند
+    with load_lock:
+        version = get_file_version(path)
+        entry = _dataset_cache.get(key)
+
+        if entry is None or entry['version'] != version:
+            data = reader()
+            if data is None:
+                return None
+            entry = {'version': version, 'data': data}
+            _dataset_cache[key] = entry
+            print(f"📦 Dataset cached: {os.path.basename(path)} [{sheet_name}]")
+
+    data = entry['data']
+    if isinstance(data, pd.DataFrame):
+        return data.copy(deep=False)
+    if isinstance(data, list):
+        return list(data)
+    return data
+
+
+_derived_cache = {}
+
+
+def get_dataset_versions(*paths):
+    """نسخه چند فایل با هم - برای کلید کش ساختارهای مشتق‌شده"""
+    return tuple(get_file_version(path) for path in paths)
+
+
+def load_derived_dataset(name, paths, builder, extra_version=None):
+    """
+    کش ساختارهای مشتق‌شده (ایندکس، تجمیع، ...) به ازای نسخه فایل‌های ورودی
+
+    Args:
+        name: نام ساختار
+        paths: فایل‌هایی که ساختار از آن‌ها ساخته می‌شود
+        builder: تابع سازنده (فقط وقتی یکی از فایل‌ها عوض شود صدا زده می‌شود)
+        extra_version: نسخه ورودی‌هایی که فایل نیستند (مثلاً مانیفست عکس‌ها)
+    """
+    versions = get_dataset_versions(*paths) + (extra_version,)
+
+    with _dataset_cache_lock:
+        build_lock = _dataset_load_locks.setdefault(('derived', name), threading.Lock())
+
+    with build_lock:
+        entry = _derived_cache.get(name)
+        if entry is not None and entry[0] == versions:
+            return entry[1]
+
+        value = builder()
+        if value is not None:
+            _derived_cache[name] = (versions, value)
+        return value
+
+
+def invalidate_dataset_cache(path=None):
+    """پاک کردن کش یک فایل (یا همه فایل‌ها)"""
+    with _dataset_cache_lock:
+        _derived_cache.clear()
+        if path is None:
+            _dataset_cache.clear()
+            return
+
+        full_path = os.path.abspath(path)
+        for key in list(_dataset_cache.keys()):
+            if key[0] == full_path:
+                del _dataset_cache[key]
+
+
+# ==============================================
+# اسنپ‌شات ستونی فایل‌های Excel
+# ==============================================
+# خواندن xlsx با openpyxl پرهزینه‌ترین کار سرور است. نسخه تمیزشده هر شیت
+# یک بار به فرمت باینری pandas (pickle) ذخیره می‌شود و تا وقتی checksum
+# فایل Excel عوض نشده، از همان خوانده می‌شود. Excel همچنان مرجع اصلی است.
+SNAPSHOT_FOLDER = 'data_snapshots'
+
+
+def calculate_file_checksum(path):
+    """محاسبه checksum فایل (SHA-1)"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_dataset_snapshot(path, sheet_name, reader):
+    """
+    خواندن DataFrame از اسنپ‌شات؛ اگر اسنپ‌شات کهنه باشد از Excel ساخته می‌شود
+
+    checksum فایل Excel داخل همان فایل pickle ذخیره می‌شود تا داده و نسخه‌اش
+    با یک os.replace با هم جایگزین شوند (دو worker که همزمان نسخه‌های
+    مختلف را می‌سازند نمی‌توانند checksum یکی را کنار داده دیگری بگذارند).
+
+    Args:
+        path: مسیر فایل Excel
+        sheet_name: نام شیت
+        reader: تابعی که Excel را می‌خواند و DataFrame تمیزشده برمی‌گرداند
+    """
+    base_name = f"{os.path.basename(path)}.{sheet_name}"
+    snapshot_path = os.path.join(SNAPSHOT_FOLDER, base_name + '.pkl')
+
+    try:
+        checksum = calculate_file_checksum(path)
+    except OSError as e:
+        print(f"❌ Error reading {path} for checksum: {e}")
+        return reader()
+
+    # اسنپ‌شات معتبر
+    try:
+        if os.path.exists(snapshot_path):
+            snapshot = pd.read_pickle(snapshot_path)
+            if isinstance(snapshot, dict) and snapshot.get('checksum') == checksum:
+                df = snapshot['data']
+                print(f"⚡ Snapshot loaded: {base_name} ({len(df)} records)")
+                return df
+            print(f"🔄 Snapshot is stale: {base_name}")
+    except Exception as e:
+        print(f"⚠️ Snapshot unreadable, rebuilding {base_name}: {e}")
+
+    df = reader()
+    if df is None:
+        return None
+
+    # ذخیره اتمیک (داده و checksum در یک فایل) تا workerهای دیگر فایل نیمه‌کاره نبینند
+    try:
+        os.makedirs(SNAPSHOT_FOLDER, exist_ok=True)
+        temp_path = f"{snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pd.to_pickle({
+            'source': path,
+            'sheet': sheet_name,
+            'checksum': checksum,
+            'rows': len(df),
+            'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'data': df
+        }, temp_path)
+        os.replace(temp_path, snapshot_path)
+        print(f"💾 Snapshot saved: {base_name}")
+    except Exception as e:
+        print(f"⚠️ Error saving snapshot {base_name}: {e}")
+
+    return df
+
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     """محاسبه فاصله بین دو نقطه جغرافیایی به متر (فرمول Haversine)"""
     try:
@@ -86,26 +292,29 @@ def load_brand_order_from_excel():
         if not os.path.exists('products.xlsx'):
             return None
             
-        # بررسی وجود شیت brand
-        with pd.ExcelFile('products.xlsx') as xls:
-            if 'brand' not in xls.sheet_names:
-                return None
-                
-        df = pd.read_excel('products.xlsx', sheet_name='brand')
-        
-        # پاک کردن فاصله‌های اضافی
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip()
-        
-        # مرتب‌سازی بر اساس Radif
-        df = df.sort_values('Radif', ascending=True)
-        
-        # برگرداندن لیست برندها
-        brand_order = df['Brand'].tolist()
+        def read_brand_order():
+            # بررسی وجود شیت brand
+            with pd.ExcelFile('products.xlsx') as xls:
+                if 'brand' not in xls.sheet_names:
+                    return None
+                    
+            df = pd.read_excel('products.xlsx', sheet_name='brand')
+            
+            # پاک کردن فاصله‌های اضافی
+            for col in df.columns:
+                if df[col].dtype == 'object':
+                    df[col] = df[col].astype(str).str.strip()
+            
+            # مرتب‌سازی بر اساس Radif
+            df = df.sort_values('Radif', ascending=True)
+            
+            # برگرداندن لیست برندها
+            brand_order = df['Brand'].tolist()
+            
+            print(f"✅ Brand order loaded: {brand_order}")
+            return brand_order
         
-        print(f"✅ Brand order loaded: {brand_order}")
-        return brand_order
+        return load_cached_dataset('products.xlsx', 'brand', read_brand_order)
         
     except Exception as e:
         print(f"❌ Error loading brand order: {e}")
@@ -250,6 +459,287 @@ def jalali_date_compact(gregorian_date_str):
         print(f"خطا در تبدیل تاریخ {gregorian_date_str}: {e}")
         return gregorian_date_str
 
+
+# ==============================================
+# موتور برداری تبدیل تاریخ (کل ستون در یک مرحله)
+# ==============================================
+# همه تاریخ‌ها به «شماره روز» (ordinal میلادی پایتون) تبدیل می‌شوند.
+# جدول شروع ماه‌های شمسی یک بار با jdatetime ساخته می‌شود و بعد از آن
+# تبدیل هر ستون فقط چند عملیات numpy روی مقادیر یکتای ستون است.
+JALALI_TABLE_START_YEAR = 1300
+JALALI_TABLE_END_YEAR = 1500
+INVALID_DAY_ORDINAL = 0
+
+_jalali_month_starts = np.array([
+    jdatetime.date(year, month, 1).togregorian().toordinal()
+    for year in range(JALALI_TABLE_START_YEAR, JALALI_TABLE_END_YEAR + 1)
+    for month in range(1, 13)
+], dtype=np.int64)
+
+# طول هر ماه = فاصله تا شروع ماه بعد (اسفند سال آخر حذف می‌شود)
+_jalali_month_lengths = np.diff(_jalali_month_starts)
+_jalali_month_starts = _jalali_month_starts[:-1]
+
+_DATE_PARTS_PATTERN = r'^\s*(\d{4})[/\-]?(\d{1,2})[/\-]?(\d{1,2})'
+
+
+def gregorian_parts_to_ordinal(years, months, days):
+    """تبدیل برداری سال/ماه/روز میلادی به ordinal (الگوریتم days-from-civil)"""
+    years = np.asarray(years, dtype=np.int64)
+    months = np.asarray(months, dtype=np.int64)
+    days = np.asarray(days, dtype=np.int64)
+
+    y = years - (months <= 2)
+    era = np.floor_divide(y, 400)
+    yoe = y - era * 400
+    mp = (months + 9) % 12
+    doy = (153 * mp + 2) // 5 + days - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    # 719163 = ordinal پایتون برای 1970-01-01
+    return era * 146097 + doe - 719468 + 719163
+
+
+def ordinal_to_jalali_parts(ordinals):
+    """تبدیل برداری ordinal به (سال، ماه، روز) شمسی"""
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    idx = np.searchsorted(_jalali_month_starts, ordinals, side='right') - 1
+    idx = np.clip(idx, 0, len(_jalali_month_starts) - 1)
+    years = JALALI_TABLE_START_YEAR + idx // 12
+    months = idx % 12 + 1
+    days = ordinals - _jalali_month_starts[idx] + 1
+    return years, months, days
+
+
+def jalali_week_of_year(ordinals, years):
+    """شماره هفته شمسی (شروع هفته شنبه، هفته 1 شامل اول فروردین)"""
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    year_idx = np.clip((np.asarray(years, dtype=np.int64) - JALALI_TABLE_START_YEAR) * 12,
+                       0, len(_jalali_month_starts) - 1)
+    year_start = _jalali_month_starts[year_idx]
+    # فاصله اول فروردین از شنبه قبلش (ordinal 6 شنبه است)
+    start_offset = (year_start - 6) % 7
+    return (ordinals - year_start + start_offset) // 7 + 1
+
+
+def convert_date_column(values):
+    """
+    تبدیل برداری یک ستون تاریخ (شمسی/میلادی، با / یا - یا فشرده) به شماره روز
+
+    فرمت‌های پشتیبانی شده: 1403/05/15، 1403-05-15، 14030515، 2024-08-05 و Timestamp.
+    سال کمتر از 1700 شمسی و بیشتر از آن میلادی در نظر گرفته می‌شود.
+
+    Returns:
+        DataFrame هم‌ایندکس با ستون‌های DayOrdinal، JalaliYear، JalaliMonth، JalaliDay،
+        JalaliWeek، YearMonth (سال*100+ماه) و GregorianDate (YYYY-MM-DD).
+        ردیف‌های نامعتبر: DayOrdinal = 0 و GregorianDate = None
+    """
+    series = values if isinstance(values, pd.Series) else pd.Series(values)
+
+    # فقط مقادیر یکتا تبدیل می‌شوند (تعداد روزهای متمایز خیلی کمتر از ردیف‌هاست)
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    unique_strings = pd.Series(uniques, dtype=object).astype(str)
+    parts = unique_strings.str.extract(_DATE_PARTS_PATTERN)
+
+    valid = parts.notna().all(axis=1).to_numpy().copy()
+    y = pd.to_numeric(parts[0], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    m = pd.to_numeric(parts[1], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    d = pd.to_numeric(parts[2], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    valid &= (m >= 1) & (m <= 12) & (d >= 1)
+
+    ordinals = np.full(len(uniques), INVALID_DAY_ORDINAL, dtype=np.int64)
+
+    # شمسی
+    is_jalali = valid & (y >= JALALI_TABLE_START_YEAR) & (y < JALALI_TABLE_END_YEAR)
+    month_idx = np.where(is_jalali, (y - JALALI_TABLE_START_YEAR) * 12 + m - 1, 0)
+    is_jalali &= d <= _jalali_month_lengths[month_idx]
+    ordinals[is_jalali] = _jalali_month_starts[month_idx[is_jalali]] + d[is_jalali] - 1
+
+    # میلادی
+    is_gregorian = valid & (y >= 1700)
+    if is_gregorian.any():
+        g_ord = gregorian_parts_to_ordinal(y, m, d)
+        next_month_ord = gregorian_parts_to_ordinal(y + (m == 12), m % 12 + 1, np.ones_like(d))
+        is_gregorian &= g_ord < next_month_ord
+        ordinals[is_gregorian] = g_ord[is_gregorian]
+
+    # محدوده جدول شمسی
+    in_range = (ordinals >= _jalali_month_starts[0]) & (ordinals < _jalali_month_starts[-1] + 31)
+    ordinals[~in_range] = INVALID_DAY_ORDINAL
+    ok = ordinals != INVALID_DAY_ORDINAL
+
+    j_year, j_month, j_day = ordinal_to_jalali_parts(np.where(ok, ordinals, _jalali_month_starts[0]))
+    j_week = jalali_week_of_year(np.where(ok, ordinals, _jalali_month_starts[0]), j_year)
+    gregorian_dates = np.array([
+        datetime.fromordinal(int(o)).strftime('%Y-%m-%d') if o != INVALID_DAY_ORDINAL else None
+        for o in ordinals
+    ], dtype=object)
+
+    unique_result = {
+        'DayOrdinal': ordinals,
+        'JalaliYear': np.where(ok, j_year, 0),
+        'JalaliMonth': np.where(ok, j_month, 0),
+        'JalaliDay': np.where(ok, j_day, 0),
+        'JalaliWeek': np.where(ok, j_week, 0),
+        'YearMonth': np.where(ok, j_year * 100 + j_month, 0),
+        'GregorianDate': gregorian_dates
+    }
+
+    # پخش نتیجه مقادیر یکتا روی همه ردیف‌ها؛ مقادیر خالی (کد -1) به یک ردیف نامعتبر اشاره می‌کنند
+    take = np.where(codes < 0, len(uniques), codes)
+    result = {}
+    for name, column in unique_result.items():
+        invalid_value = None if name == 'GregorianDate' else INVALID_DAY_ORDINAL
+        result[name] = np.append(column, np.array([invalid_value], dtype=column.dtype))[take]
+
+    return pd.DataFrame(result, index=series.index)
+
+
+def date_to_ordinal(date_value):
+    """تبدیل یک تاریخ (شمسی یا میلادی) به شماره روز - نامعتبر: None"""
+    if date_value is None:
+        return None
+    ordinal = int(convert_date_column(pd.Series([date_value]))['DayOrdinal'].iloc[0])
+    return ordinal if ordinal != INVALID_DAY_ORDINAL else None
+
+
+def date_window_to_ordinals(date_from, date_to):
+    """
+    بازه تاریخ درخواست به (شماره روز شروع، پایان)
+
+    اگر یکی از دو تاریخ نامعتبر باشد None برمی‌گرداند (نه بازه باز)، تا ورودی
+    اشتباه به جای خطا همه سوابق را برنگرداند.
+    """
+    start_ordinal = date_to_ordinal(date_from)
+    end_ordinal = date_to_ordinal(date_to)
+    if start_ordinal is None or end_ordinal is None:
+        return None
+    return start_ordinal, end_ordinal
+
+
+def ordinal_to_jalali_str(ordinal):
+    """تبدیل شماره روز به تاریخ شمسی 1403/05/15"""
+    year, month, day = ordinal_to_jalali_parts([ordinal])
+    return f"{int(year[0]):04d}/{int(month[0]):02d}/{int(day[0]):02d}"
+
+
+# ==============================================
+# جدول تقویم شمسی (Calendar Dimension)
+# ==============================================
+# هر روز 1390 تا 1420 یک ردیف: سال/ماه/روز شمسی، تاریخ میلادی، شماره روز،
+# روز هفته (0 = شنبه)، شماره هفته و نام ماه/روز. گزارش‌های هفتگی و ماهانه
+# به جای ساختن jdatetime برای هر ردیف، با DayOrdinal به این جدول join می‌شوند.
+CALENDAR_START_YEAR = 1390
+CALENDAR_END_YEAR = 1420
+
+JALALI_MONTH_NAMES = [
+    'فروردین', 'اردیبهشت', 'خرداد', 'تیر', 'مرداد', 'شهریور',
+    'مهر', 'آبان', 'آذر', 'دی', 'بهمن', 'اسفند'
+]
+JALALI_DAY_NAMES = ['شنبه', 'یکشنبه', 'دوشنبه', 'سه‌شنبه', 'چهارشنبه', 'پنج‌شنبه', 'جمعه']
+
+_jalali_calendar = None
+_month_week_layouts = {}
+
+
+def jalali_month_start_ordinal(year, month):
+    """شماره روز اول یک ماه شمسی"""
+    return int(_jalali_month_starts[(year - JALALI_TABLE_START_YEAR) * 12 + month - 1])
+
+
+def jalali_days_in_month(year, month):
+    """تعداد روزهای یک ماه شمسی (با در نظر گرفتن سال کبیسه)"""
+    return int(_jalali_month_lengths[(year - JALALI_TABLE_START_YEAR) * 12 + month - 1])
+
+
+def get_jalali_calendar():
+    """جدول تقویم شمسی (یک بار ساخته می‌شود)"""
+    global _jalali_calendar
+
+    if _jalali_calendar is None:
+        start = jalali_month_start_ordinal(CALENDAR_START_YEAR, 1)
+        end = jalali_month_start_ordinal(CALENDAR_END_YEAR + 1, 1)
+        ordinals = np.arange(start, end, dtype=np.int64)
+
+        years, months, days = ordinal_to_jalali_parts(ordinals)
+        weekdays = (ordinals - 6) % 7  # 0 = شنبه
+
+        calendar_df = pd.DataFrame({
+            'DayOrdinal': ordinals,
+            'JalaliYear': years,
+            'JalaliMonth': months,
+            'JalaliDay': days,
+            'YearMonth': years * 100 + months,
+            'Weekday': weekdays,
+            # شماره هفته مطلق (از شنبه) از ابتدای جدول
+            'WeekIndex': (ordinals - start + weekdays[0]) // 7,
+            'JalaliWeek': jalali_week_of_year(ordinals, years),
+        })
+        calendar_df['JalaliDate'] = (
+            calendar_df['JalaliYear'].astype(str) + '/' +
+            calendar_df['JalaliMonth'].astype(str).str.zfill(2) + '/' +
+            calendar_df['JalaliDay'].astype(str).str.zfill(2)
+        )
+        calendar_df['GregorianDate'] = (ordinals - 719163).astype('datetime64[D]').astype(str)
+        calendar_df['MonthName'] = np.array(JALALI_MONTH_NAMES, dtype=object)[months - 1]
+        calendar_df['DayName'] = np.array(JALALI_DAY_NAMES, dtype=object)[weekdays]
+
+        _jalali_calendar = calendar_df
+        print(f"📅 Jalali calendar built: {len(calendar_df)} days ({CALENDAR_START_YEAR}-{CALENDAR_END_YEAR})")
+
+    return _jalali_calendar
+
+
+def get_calendar_rows(ordinals):
+    """ردیف‌های تقویم برای لیستی از شماره روزها (خارج از بازه: حذف)"""
+    calendar_df = get_jalali_calendar()
+    positions = np.asarray(ordinals, dtype=np.int64) - int(calendar_df['DayOrdinal'].iat[0])
+    positions = positions[(positions >= 0) & (positions < len(calendar_df))]
+    return calendar_df.iloc[positions]
+
+
+def get_month_week_layout(year, month):
+    """
+    چیدمان هفته‌های یک ماه برای گزارش‌های هفتگی
+
+    هفته اول از اولین شنبه ماه شروع می‌شود و هر هفته 7 روز است؛ روزهای هفته
+    آخر ممکن است به ماه بعد برسند (is_next_month).
+
+    Returns:
+        لیست هفته‌ها؛ هر هفته لیستی از dict با کلیدهای ordinal، date، day_name، is_next_month
+    """
+    key = (year, month)
+    if key in _month_week_layouts:
+        return _month_week_layouts[key]
+
+    weeks = []
+    calendar_df = get_jalali_calendar()
+    if CALENDAR_START_YEAR <= year <= CALENDAR_END_YEAR:
+        month_start = jalali_month_start_ordinal(year, month)
+        days_in_month = jalali_days_in_month(year, month)
+        month_end = month_start + days_in_month - 1
+
+        # اولین شنبه ماه
+        first_saturday = month_start + (-(month_start - 6)) % 7
+
+        calendar_start = int(calendar_df['DayOrdinal'].iat[0])
+        for week_start in range(first_saturday, month_end + 1, 7):
+            week_days = []
+            for ordinal in range(week_start, week_start + 7):
+                position = ordinal - calendar_start
+                if position >= len(calendar_df):
+                    break
+                week_days.append({
+                    'ordinal': ordinal,
+                    'date': calendar_df['JalaliDate'].iat[position],
+                    'day_name': calendar_df['DayName'].iat[position],
+                    'is_next_month': ordinal > month_end
+                })
+            if week_days:
+                weeks.append(week_days)
+
+    _month_week_layouts[key] = weeks
+    return weeks
+
 def load_users_from_excel():
     """بارگذاری کاربران از فایل Excel"""
     try:
@@ -257,15 +747,18 @@ def load_users_from_excel():
             print("❌ Users file not found:", USERS_FILE)
             return None
             
-        df = pd.read_excel(USERS_FILE, sheet_name='users')
-        print("✅ Users file loaded successfully")
+        def read_users():
+            df = pd.read_excel(USERS_FILE, sheet_name='users')
+            print("✅ Users file loaded successfully")
         
-        # پاک کردن فاصله‌های اضافی
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip()
+            # پاک کردن فاصله‌های اضافی
+            for col in df.columns:
+                if df[col].dtype == 'object':
+                    df[col] = df[col].astype(str).str.strip()
         
-        return df
+            return df
+
+        return load_cached_dataset(USERS_FILE, 'users', read_users)
     except Exception as e:
         print("❌ Error loading users file:", e)
         return None
@@ -277,216 +770,253 @@ def load_customers_from_excel():
             print("❌ Customers file not found:", CUSTOMERS_FILE)
             return None
             
-        df = pd.read_excel(CUSTOMERS_FILE, sheet_name='customers')
-        print("✅ Customers file loaded successfully")
-        
-        # پاک کردن فاصله‌های اضافی
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip()
-        
-        # 🔧 FIX: تبدیل مقادیر NaN به مقادیر قابل استفاده
-        # اگر ستون LocationSet وجود داره، NaN ها رو به False تبدیل کن
-        if 'LocationSet' in df.columns:
-            df['LocationSet'] = df['LocationSet'].fillna(False)
-            # تبدیل string values به boolean
-            df['LocationSet'] = df['LocationSet'].apply(lambda x: 
-                True if str(x).lower() in ['true', '1', 'yes', 'بله'] else False
-            )
+        def read_customers():
+            df = pd.read_excel(CUSTOMERS_FILE, sheet_name='customers')
+            print("✅ Customers file loaded successfully")
+        
+            # پاک کردن فاصله‌های اضافی
+            for col in df.columns:
+                if df[col].dtype == 'object':
+                    df[col] = df[col].astype(str).str.strip()
+        
+            # 🔧 FIX: تبدیل مقادیر NaN به مقادیر قابل استفاده
+            # اگر ستون LocationSet وجود داره، NaN ها رو به False تبدیل کن
+            if 'LocationSet' in df.columns:
+                df['LocationSet'] = df['LocationSet'].fillna(False)
+                # تبدیل string values به boolean
+                df['LocationSet'] = df['LocationSet'].apply(lambda x: 
+                    True if str(x).lower() in ['true', '1', 'yes', 'بله'] else False
+                )
         
-        # اگر ستون‌های Latitude/Longitude وجود دارن، NaN ها رو به 0 تبدیل کن
-        if 'Latitude' in df.columns:
-            df['Latitude'] = df['Latitude'].fillna(0)
+            # اگر ستون‌های Latitude/Longitude وجود دارن، NaN ها رو به 0 تبدیل کن
+            if 'Latitude' in df.columns:
+                df['Latitude'] = df['Latitude'].fillna(0)
         
-        if 'Longitude' in df.columns:
-            df['Longitude'] = df['Longitude'].fillna(0)
+            if 'Longitude' in df.columns:
+                df['Longitude'] = df['Longitude'].fillna(0)
         
-        print(f"📊 Customers data cleaned: {len(df)} records")
-        return df
+            print(f"📊 Customers data cleaned: {len(df)} records")
+            return df
+
+        return load_cached_dataset(CUSTOMERS_FILE, 'customers',
+                                   lambda: load_dataset_snapshot(CUSTOMERS_FILE, 'customers', read_customers))
         
     except Exception as e:
         print("❌ Error loading customers file:", e)
         return None
 
-def filter_duplicate_products(products_df):
+# ==============================================
+# محدوده مشتریان هر بازاریاب (نسخه‌دار)
+# ==============================================
+
+def build_customer_scope_index():
     """
-    فیلتر کردن محصولات تکراری (رسمی و غیررسمی)
-    
-    فرمت کدها:
-    - رسمی: P991234 (P + 99 + کد پایه)
-    - غیررسمی: P1234 (P + کد پایه)
-    
+    ساخت محدوده مشتریان بازاریاب‌ها - یک بار به ازای هر نسخه فایل مشتریان و کاربران
+
+    Returns:
+        dict شامل:
+        - customers: DataFrame کامل مشتریان (همان خروجی load_customers_from_excel)
+        - positions: بازاریاب -> شماره ردیف‌های مشتریانش (به ترتیب فایل)
+        - codes: بازاریاب -> frozenset کد مشتریان
+        - salesperson_by_customer: کد مشتری -> کد بازاریاب (اولین ردیف مشتری)
+        - customer_names: کد مشتری -> نام مشتری (اولین ردیف)
+        - salesperson_names: کد بازاریاب -> نام (اولین ردیف فایل کاربران)
+    """
+    customers_df = load_customers_from_excel()
+    if customers_df is None:
+        return None
+
+    positions = {}
+    codes = {}
+    if {'CustomerCode', 'BazaryabCode'} <= set(customers_df.columns):
+        customer_codes = customers_df['CustomerCode'].to_numpy()
+        for salesperson_code, rows in customers_df.groupby('BazaryabCode', sort=False).indices.items():
+            positions[salesperson_code] = rows
+            codes[salesperson_code] = frozenset(customer_codes[rows])
+
+    def first_value_map(df, key_column, value_column):
+        if df is None or not {key_column, value_column} <= set(df.columns):
+            return {}
+        firsts = df[[key_column, value_column]].dropna(subset=[key_column]).drop_duplicates(key_column)
+        return dict(zip(firsts[key_column], firsts[value_column]))
+
+    scope_index = {
+        'customers': customers_df,
+        'positions': positions,
+        'codes': codes,
+        'salesperson_by_customer': first_value_map(customers_df, 'CustomerCode', 'BazaryabCode'),
+        'customer_names': first_value_map(customers_df, 'CustomerCode', 'CustomerName'),
+        'salesperson_names': first_value_map(load_users_from_excel(), 'Codev', 'Namev')
+    }
+    print(f"👥 Customer scopes built: {len(customers_df)} customers, {len(positions)} salespeople")
+    return scope_index
+
+
+def get_customer_scope_index():
+    """محدوده مشتریان از کش نسخه‌دار (با تغییر فایل مشتریان یا کاربران دوباره ساخته می‌شود)"""
+    return load_derived_dataset('customer_scopes', [CUSTOMERS_FILE, USERS_FILE], build_customer_scope_index)
+
+
+def scope_customers(scope_index, salesperson_code=None):
+    """ردیف‌های مشتریان یک بازاریاب به ترتیب فایل (None: همه مشتریان)"""
+    customers_df = scope_index['customers']
+    if salesperson_code is None:
+        return customers_df
+    rows = scope_index['positions'].get(salesperson_code)
+    if rows is None:
+        return customers_df.iloc[0:0]
+    return customers_df.iloc[rows]
+
+
+def scope_customer_codes(scope_index, salesperson_code):
+    """مجموعه کد مشتریان یک بازاریاب"""
+    return scope_index['codes'].get(salesperson_code, frozenset())
+
+
+def customer_in_scope(scope_index, salesperson_code, customer_code):
+    """آیا این مشتری (بر اساس اولین ردیفش) متعلق به این بازاریاب است"""
+    return scope_index['salesperson_by_customer'].get(customer_code, None) == salesperson_code
+
+# ==============================================
+# تفکیک نسخه رسمی/غیررسمی کالاها (کدهای P99)
+# ==============================================
+# فرمت کدها:
+# - رسمی: P991234 (P + 99 + کد پایه)
+# - غیررسمی: P1234 (P + کد پایه)
+# - کدی که با P شروع نمی‌شود منحصر به فرد است (کد پایه = خود کد)
+
+def split_product_variant_codes(codes):
+    """
+    تفکیک برداری کد کالاها به کد پایه و نوع نسخه
+
+    Returns:
+        DataFrame: ProductCode (نرمال‌شده)، BaseCode، IsOfficial، IsVariant (کد P دار)
+        و PartnerCode (کد نسخه دیگر همان کالا، برای کد منحصر به فرد None)
+    """
+    codes = pd.Series(list(codes), dtype=object).astype(str).str.strip().str.upper()
+    without_p = codes.str[1:]
+    is_variant = codes.str.startswith('P')
+    is_official = is_variant & without_p.str.startswith('99') & (without_p.str.len() > 2)
+    base_codes = codes.where(~is_variant, without_p.where(~is_official, without_p.str[2:]))
+    partner_codes = ('P' + base_codes).where(is_official, 'P99' + base_codes).where(is_variant, None)
+
+    return pd.DataFrame({
+        'ProductCode': codes,
+        'BaseCode': base_codes,
+        'IsOfficial': is_official,
+        'IsVariant': is_variant,
+        'PartnerCode': partner_codes
+    })
+
+
+def resolve_product_variants(products_df):
+    """
+    انتخاب نسخه باقی‌مانده هر کد پایه (یک groupby به جای پیمایش ردیف‌ها)
+
     منطق:
-    1. استخراج کد پایه (بدون P و بدون 99)
-    2. اگر یکی موجودی داشت → آن را نشان بده
-    3. اگر هر دو موجودی داشتند یا نداشتند → گران‌تر را نشان بده
+    1. کد منحصر به فرد (بدون P) همیشه نگه داشته می‌شود
+    2. اگر فقط یکی از رسمی/غیررسمی موجودی داشت → همان
+    3. اگر هر دو موجودی داشتند یا نداشتند → گران‌تر (در تساوی رسمی)
+    از چند ردیف با کد یکسان آخرین ردیف حساب می‌شود.
+
+    Returns:
+        dict: variants (هم‌ردیف products_df، با ستون Survivor)، survivor_positions
+        (شماره ردیف‌های باقی‌مانده به ترتیب اولین ظهور کد پایه) و آمار
+    """
+    variants = split_product_variant_codes(products_df['ProductCode'])
+    prices = pd.to_numeric(products_df['Price'], errors='coerce').fillna(0).to_numpy()
+    stocks = pd.to_numeric(products_df['Stock'], errors='coerce').fillna(0).to_numpy()
+
+    kinds = np.where(~variants['IsVariant'], 'single', np.where(variants['IsOfficial'], 'official', 'unofficial'))
+    rows = pd.DataFrame({'BaseCode': variants['BaseCode'], 'Kind': kinds, 'Position': np.arange(len(variants))})
+
+    # آخرین ردیف هر نوع برای هر کد پایه، به ترتیب اولین ظهور کد پایه
+    positions = rows.drop_duplicates(['BaseCode', 'Kind'], keep='last') \
+        .pivot(index='BaseCode', columns='Kind', values='Position') \
+        .reindex(index=rows['BaseCode'].drop_duplicates().to_numpy(), columns=['single', 'official', 'unofficial'])
+
+    single = positions['single'].to_numpy()
+    official = positions['official'].to_numpy()
+    unofficial = positions['unofficial'].to_numpy()
+    has_single = ~np.isnan(single)
+    has_official = ~np.isnan(official)
+    has_unofficial = ~np.isnan(unofficial)
+    official_row = np.where(has_official, official, 0).astype(np.int64)
+    unofficial_row = np.where(has_unofficial, unofficial, 0).astype(np.int64)
+
+    official_stock, unofficial_stock = stocks[official_row], stocks[unofficial_row]
+    keep_official = ((official_stock > 0) & (unofficial_stock == 0)) | (
+        ~((unofficial_stock > 0) & (official_stock == 0)) & (prices[official_row] >= prices[unofficial_row]))
+
+    survivor_positions = np.select(
+        [has_single, has_official & has_unofficial, has_official],
+        [single, np.where(keep_official, official, unofficial), official],
+        default=unofficial
+    ).astype(np.int64)
+
+    variants['Survivor'] = False
+    variants.loc[survivor_positions, 'Survivor'] = True
+
+    return {
+        'variants': variants,
+        'survivor_positions': survivor_positions,
+        'base_codes': len(positions),
+        'official': int(has_official.sum()),
+        'unofficial': int(has_unofficial.sum()),
+        'single': int(has_single.sum()),
+        'duplicates': int((has_official & has_unofficial & ~has_single).sum())
+    }
+
+
+def filter_duplicate_products(products_df):
+    """
+    فیلتر کردن محصولات تکراری (رسمی و غیررسمی) - منطق انتخاب در resolve_product_variants
     """
     
     if products_df.empty:
         return products_df
     
-    print("\n" + "="*70)
-    print("🔍 شروع فیلتر محصولات تکراری (فرمت P99...)")
-    print("="*70)
-    
     # تبدیل کد محصول به string و پاک کردن فضاهای خالی
     products_df = products_df.copy()
     products_df['ProductCode'] = products_df['ProductCode'].astype(str).str.strip().str.upper()
     products_df['Price'] = pd.to_numeric(products_df['Price'], errors='coerce').fillna(0)
     products_df['Stock'] = pd.to_numeric(products_df['Stock'], errors='coerce').fillna(0)
     
-    # دیکشنری برای ذخیره محصولات بر اساس کد پایه
-    products_by_base = {}
-    
-    for idx, row in products_df.iterrows():
-        code = str(row['ProductCode']).strip().upper()
-        
-        # بررسی فرمت کد
-        if not code.startswith('P'):
-            # کدی که با P شروع نمی‌شود - نگه دار
-            products_by_base[code] = {
-                'single': {
-                    'index': idx,
-                    'code': code,
-                    'price': float(row['Price']),
-                    'stock': float(row['Stock']),
-                    'row': row
-                }
-            }
-            continue
-        
-        # حذف P از ابتدا
-        code_without_p = code[1:]  # حذف P
-        
-        # تشخیص رسمی یا غیررسمی
-        if code_without_p.startswith('99') and len(code_without_p) > 2:
-            # کد رسمی (P99...)
-            base_code = code_without_p[2:]  # حذف 99
-            product_type = 'official'
-        else:
-            # کد غیررسمی (P...)
-            base_code = code_without_p
-            product_type = 'unofficial'
-        
-        # ذخیره محصول
-        if base_code not in products_by_base:
-            products_by_base[base_code] = {}
-        
-        products_by_base[base_code][product_type] = {
-            'index': idx,
-            'code': code,
-            'price': float(row['Price']),
-            'stock': float(row['Stock']),
-            'row': row
-        }
-    
-    print(f"\n📊 آمار محصولات:")
-    total_official = sum(1 for p in products_by_base.values() if 'official' in p)
-    total_unofficial = sum(1 for p in products_by_base.values() if 'unofficial' in p)
-    total_single = sum(1 for p in products_by_base.values() if 'single' in p)
-    total_duplicates = sum(1 for p in products_by_base.values() if 'official' in p and 'unofficial' in p)
-    
-    print(f"   کدهای پایه یکتا: {len(products_by_base)}")
-    print(f"   دارای نسخه رسمی: {total_official}")
-    print(f"   دارای نسخه غیررسمی: {total_unofficial}")
-    print(f"   کدهای منحصر به فرد: {total_single}")
-    print(f"   محصولات تکراری (هر دو نسخه): {total_duplicates}")
-    
-    # انتخاب محصولات نهایی
-    duplicates_found = 0
-    indices_to_keep = []
+    resolution = resolve_product_variants(products_df)
+    filtered_df = products_df.iloc[resolution['survivor_positions']].copy()
     
-    for base_code, versions in products_by_base.items():
-        
-        # اگر کد منحصر به فرد است (نه رسمی نه غیررسمی)
-        if 'single' in versions:
-            indices_to_keep.append(versions['single']['index'])
-            continue
-        
-        # اگر هر دو نسخه (رسمی و غیررسمی) دارد
-        if 'official' in versions and 'unofficial' in versions:
-            duplicates_found += 1
-            
-            official = versions['official']
-            unofficial = versions['unofficial']
-            
-            print(f"\n🔄 محصول تکراری پیدا شد:")
-            print(f"   کد پایه: {base_code}")
-            print(f"   ├─ رسمی (P99{base_code}):")
-            print(f"   │  ├─ کد کامل: {official['code']}")
-            print(f"   │  ├─ قیمت: {official['price']:,.0f} ریال")
-            print(f"   │  └─ موجودی: {official['stock']:.0f}")
-            print(f"   └─ غیررسمی (P{base_code}):")
-            print(f"      ├─ کد کامل: {unofficial['code']}")
-            print(f"      ├─ قیمت: {unofficial['price']:,.0f} ریال")
-            print(f"      └─ موجودی: {unofficial['stock']:.0f}")
-            
-            # تصمیم‌گیری: کدام را نگه داریم؟
-            keep_official = False
-            reason = ""
-            
-            # قانون 1: اگر فقط یکی موجودی دارد
-            if official['stock'] > 0 and unofficial['stock'] == 0:
-                keep_official = True
-                reason = "فقط رسمی موجودی دارد"
-            elif unofficial['stock'] > 0 and official['stock'] == 0:
-                keep_official = False
-                reason = "فقط غیررسمی موجودی دارد"
-            
-            # قانون 2: هر دو موجودی دارند یا ندارند → گران‌تر را نگه دار
-            else:
-                if official['price'] >= unofficial['price']:
-                    keep_official = True
-                    reason = f"رسمی گران‌تر است ({official['price']:,.0f} >= {unofficial['price']:,.0f})"
-                else:
-                    keep_official = False
-                    reason = f"غیررسمی گران‌تر است ({unofficial['price']:,.0f} > {official['price']:,.0f})"
-            
-            # اعمال تصمیم
-            if keep_official:
-                indices_to_keep.append(official['index'])
-                print(f"   ✅ تصمیم: رسمی ({official['code']}) نگه داشته می‌شود - {reason}")
-            else:
-                indices_to_keep.append(unofficial['index'])
-                print(f"   ✅ تصمیم: غیررسمی ({unofficial['code']}) نگه داشته می‌شود - {reason}")
-        
-        # اگر فقط یک نسخه دارد
-        elif 'official' in versions:
-            # فقط رسمی دارد
-            indices_to_keep.append(versions['official']['index'])
-            print(f"   ℹ️  فقط رسمی: P99{base_code}")
-        elif 'unofficial' in versions:
-            # فقط غیررسمی دارد
-            indices_to_keep.append(versions['unofficial']['index'])
-            print(f"   ℹ️  فقط غیررسمی: P{base_code}")
-    
-    # فیلتر کردن DataFrame
-    filtered_df = products_df.loc[indices_to_keep].copy()
-    
-    print(f"\n" + "="*70)
-    print(f"📊 نتیجه فیلتر:")
-    print(f"   تعداد کل محصولات: {len(products_df)}")
-    print(f"   محصولات تکراری (دارای هر دو نسخه): {duplicates_found}")
-    print(f"   محصولات حذف شده: {len(products_df) - len(filtered_df)}")
-    print(f"   محصولات نهایی: {len(filtered_df)}")
-    print("="*70 + "\n")
+    print(f"🔍 فیلتر محصولات تکراری (P99): {len(products_df)} محصول، {resolution['base_codes']} کد پایه، "
+          f"{resolution['duplicates']} تکراری → {len(filtered_df)} محصول نهایی")
     
     return filtered_df
 
 
+def build_product_variant_resolver():
+    """نسخه رسمی/غیررسمی همه کالاهای products.xlsx و لیست فیلترشده کاتالوگ"""
+    products_df = load_cached_dataset('products.xlsx', 'products_raw',
+                                      lambda: pd.read_excel('products.xlsx', sheet_name='products'))
+    filtered_df = filter_duplicate_products(products_df)
+    variants = split_product_variant_codes(products_df['ProductCode'])
+
+    return {
+        'filtered': filtered_df,
+        'variants': variants.drop_duplicates('ProductCode', keep='last').set_index('ProductCode')
+    }
+
+
+def get_product_variant_resolver():
+    """تفکیک نسخه‌های کالا - یک بار به ازای هر نسخه فایل کالاها"""
+    return load_derived_dataset('product_variants', ['products.xlsx'], build_product_variant_resolver)
+
+
 def load_products_with_filter():
     """
     بارگذاری محصولات با فیلتر خودکار تکراری‌ها
     جایگزین تابع load_products_from_excel موجود
     """
     try:
-        # بارگذاری محصولات
-        products_df = pd.read_excel('products.xlsx', sheet_name='products')
-        
-        # اعمال فیلتر
-        filtered_df = filter_duplicate_products(products_df)
-        
-        return filtered_df
+        # محصولات فیلترشده از کش نسخه‌دار
+        return get_product_variant_resolver()['filtered'].copy(deep=False)
         
     except Exception as e:
         print(f"❌ خطا در بارگذاری محصولات: {e}")
@@ -497,14 +1027,23 @@ def load_products_with_filter():
 def load_visits_from_excel():
     """بارگذاری مراجعات از فایل Excel"""
     try:
+        if is_sqlite_storage():
+            return load_storage_table('visits')
+        
         if not os.path.exists(VISITS_FILE):
             print("❌ Visits file not found:", VISITS_FILE)
             return None
             
-        df = pd.read_excel(VISITS_FILE, sheet_name='visits')
-        print("✅ Visits file loaded successfully")
+        def read_visits():
+            df = pd.read_excel(VISITS_FILE, sheet_name='visits')
+            print("✅ Visits file loaded successfully")
         
-        return df
+            return df
+
+        if is_journal_storage():
+            return load_with_journal('visits', lambda: load_cached_dataset(VISITS_FILE, 'visits', read_visits))
+        
+        return load_cached_dataset(VISITS_FILE, 'visits', read_visits)
     except Exception as e:
         print("❌ Error loading visits file:", e)
         return None
@@ -522,6 +1061,9 @@ def save_customers_to_excel(df):
 def save_visits_to_excel(df):
     """ذخیره مراجعات در فایل Excel"""
     try:
+        if is_sqlite_storage():
+            return save_storage_table('visits', df)
+        
         df.to_excel(VISITS_FILE, sheet_name='visits', index=False)
         print("✅ Visits file saved successfully")
         return True
@@ -628,14 +1170,14 @@ def customers_list():
         return redirect(url_for('login'))
     
     # بارگذاری مشتریان
-    customers_df = load_customers_from_excel()
-    if customers_df is None:
+    scope_index = get_customer_scope_index()
+    if scope_index is None:
         flash('خطا در بارگذاری لیست مشتریان!', 'error')
         return redirect(url_for('index'))
     
     # فیلتر کردن مشتریان بر اساس کد بازاریاب
     bazaryab_code = session['user_info']['Codev']
-    my_customers = customers_df[customers_df['BazaryabCode'] == bazaryab_code]
+    my_customers = scope_customers(scope_index, bazaryab_code)
     
     customers = my_customers.to_dict('records')
     
@@ -750,13 +1292,17 @@ def record_visit():
             }), 403
         
         # اگر فاصله مجاز باشد، مراجعه را ثبت کنید
-        visits_df = load_visits_from_excel()
-        if visits_df is None:
-            visits_df = pd.DataFrame(columns=['VisitCode', 'BazaryabCode', 'CustomerCode', 'VisitDate', 'VisitTime', 'Latitude', 'Longitude', 'Distance'])
-        
-        # ایجاد کد مراجعه جدید
-        visit_count = len(visits_df) + 1
-        visit_code = f"V{visit_count:03d}"
+        if is_sqlite_storage() or is_journal_storage():
+            # کد مراجعه هنگام درج و زیر همان قفل/تراکنش ساخته می‌شود
+            visits_df = None
+            visit_code = None
+        else:
+            visits_df = load_visits_from_excel()
+            if visits_df is None:
+                visits_df = pd.DataFrame(columns=['VisitCode', 'BazaryabCode', 'CustomerCode', 'VisitDate', 'VisitTime', 'Latitude', 'Longitude', 'Distance'])
+            
+            # ایجاد کد مراجعه جدید
+            visit_code = f"V{len(visits_df) + 1:03d}"
         
         # ✅ تاریخ و ساعت شمسی با timezone صحیح
         from pytz import timezone as pytz_timezone
@@ -784,11 +1330,29 @@ def record_visit():
             'Distance': round(distance, 2)
         }
         
-        # اضافه کردن به DataFrame
-        visits_df = pd.concat([visits_df, pd.DataFrame([new_visit])], ignore_index=True)
+        if is_sqlite_storage():
+            visit_code = append_storage_row_with_id(
+                'visits', new_visit, 'VisitCode',
+                lambda conn: f"V{conn.execute('SELECT COUNT(*) FROM visits').fetchone()[0] + 1:03d}"
+            )
+            saved = visit_code is not None
+        elif is_journal_storage():
+            # شمارش ردیف‌ها (Excel + ژورنال) و نوشتن خط ژورنال زیر یک قفل
+            with journal_lock('visits'):
+                visits_df = load_visits_from_excel()
+                if visits_df is None:
+                    # فایل مراجعات هنوز ساخته نشده؛ فقط ردیف‌های ژورنال شمرده می‌شوند
+                    visits_df = apply_journal_entries(pd.DataFrame(), read_journal_entries('visits'))
+                visit_code = f"V{len(visits_df) + 1:03d}"
+                new_visit['VisitCode'] = visit_code
+                saved = append_journal_rows('visits', [new_visit])
+        else:
+            # اضافه کردن به DataFrame
+            visits_df = pd.concat([visits_df, pd.DataFrame([new_visit])], ignore_index=True)
+            saved = save_visits_to_excel(visits_df)
         
         # ذخیره فایل
-        if save_visits_to_excel(visits_df):
+        if saved:
             return jsonify({
                 'success': True,
                 'message': f'مراجعه با موفقیت ثبت شد (فاصله: {distance:.1f} متر)',
@@ -893,35 +1457,39 @@ def load_products_from_excel():
             print("❌ Products file not found!")
             return None
             
-        df = pd.read_excel('products.xlsx', sheet_name='products')
-        print("✅ Products file loaded successfully")
-        
-        # پاک کردن فاصله‌های اضافی
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip()
-        
-        # 🔧 FIX: تبدیل مقادیر NaN به مقادیر قابل استفاده
-        # برای ستون‌های متنی: NaN -> ""
-        text_columns = ['ProductCode', 'ProductName', 'Brand', 'Category', 'ImageFile', 'Description']
-        for col in text_columns:
-            if col in df.columns:
-                df[col] = df[col].fillna('')
-        
-        # برای ستون‌های عددی: NaN -> 0
-        numeric_columns = ['Price', 'Stock']
-        for col in numeric_columns:
-            if col in df.columns:
-                df[col] = df[col].fillna(0)
-        
-        # برای ستون‌های offer: NaN -> ""
-        offer_columns = ['Offer1', 'Offer2', 'Offer3']
-        for col in offer_columns:
-            if col in df.columns:
-                df[col] = df[col].fillna('')
-        
-        print(f"📊 Products data cleaned: {len(df)} records")
-        return df
+        def read_products():
+            df = pd.read_excel('products.xlsx', sheet_name='products')
+            print("✅ Products file loaded successfully")
+        
+            # پاک کردن فاصله‌های اضافی
+            for col in df.columns:
+                if df[col].dtype == 'object':
+                    df[col] = df[col].astype(str).str.strip()
+        
+            # 🔧 FIX: تبدیل مقادیر NaN به مقادیر قابل استفاده
+            # برای ستون‌های متنی: NaN -> ""
+            text_columns = ['ProductCode', 'ProductName', 'Brand', 'Category', 'ImageFile', 'Description']
+            for col in text_columns:
+                if col in df.columns:
+                    df[col] = df[col].fillna('')
+        
+            # برای ستون‌های عددی: NaN -> 0
+            numeric_columns = ['Price', 'Stock']
+            for col in numeric_columns:
+                if col in df.columns:
+                    df[col] = df[col].fillna(0)
+        
+            # برای ستون‌های offer: NaN -> ""
+            offer_columns = ['Offer1', 'Offer2', 'Offer3']
+            for col in offer_columns:
+                if col in df.columns:
+                    df[col] = df[col].fillna('')
+        
+            print(f"📊 Products data cleaned: {len(df)} records")
+            return df
+
+        return load_cached_dataset('products.xlsx', 'products',
+                                   lambda: load_dataset_snapshot('products.xlsx', 'products', read_products))
         
     except Exception as e:
         print("❌ Error loading products file:", e)
@@ -934,220 +1502,1117 @@ def load_sales_from_excel():
             print("❌ Sales file not found!")
             return None
             
-        # بررسی شیت‌های موجود
-        with pd.ExcelFile('sales.xlsx') as xls:
-            sheet_names = xls.sheet_names
-            print(f"📋 Available sheets in sales.xlsx: {sheet_names}")
-            
-            # اگر شیت 'sales' موجود نیست، اولین شیت را استفاده کن
-            if 'sales' in sheet_names:
-                sheet_name = 'sales'
-            elif len(sheet_names) > 0:
-                sheet_name = sheet_names[0]
-                print(f"⚠️ Using sheet '{sheet_name}' instead of 'sales'")
-            else:
-                print("❌ No sheets found in sales file")
-                return None
+        def read_sales():
+            # بررسی شیت‌های موجود
+            with pd.ExcelFile('sales.xlsx') as xls:
+                sheet_names = xls.sheet_names
+                print(f"📋 Available sheets in sales.xlsx: {sheet_names}")
+            
+                # اگر شیت 'sales' موجود نیست، اولین شیت را استفاده کن
+                if 'sales' in sheet_names:
+                    sheet_name = 'sales'
+                elif len(sheet_names) > 0:
+                    sheet_name = sheet_names[0]
+                    print(f"⚠️ Using sheet '{sheet_name}' instead of 'sales'")
+                else:
+                    print("❌ No sheets found in sales file")
+                    return None
         
-        df = pd.read_excel('sales.xlsx', sheet_name=sheet_name)
-        print(f"✅ Sales file loaded successfully with {len(df)} records")
-        print(f"📑 Columns: {list(df.columns)}")
-        
-        # پاک کردن فاصه‌های اضافی
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip()
-        
-        # 🔧 FIX: تبدیل مقادیر NaN برای اجتناب از خطای JSON
-        # برای ستون‌های عددی
-        numeric_columns = ['Quantity', 'UnitPrice', 'TotalAmount']
-        for col in numeric_columns:
-            if col in df.columns:
-                df[col] = df[col].fillna(0)
-        
-        # برای ستون‌های متنی
-        text_columns = ['CustomerCode', 'ProductCode', 'InvoiceDate', 'Status', 'Notes']
-        for col in text_columns:
-            if col in df.columns:
-                df[col] = df[col].fillna('')
-        
-        print(f"📊 Sales data cleaned: {len(df)} records")
-        return df
+            df = pd.read_excel('sales.xlsx', sheet_name=sheet_name)
+            print(f"✅ Sales file loaded successfully with {len(df)} records")
+            print(f"📑 Columns: {list(df.columns)}")
+        
+            # پاک کردن فاصه‌های اضافی
+            for col in df.columns:
+                if df[col].dtype == 'object':
+                    df[col] = df[col].astype(str).str.strip()
+        
+            # 🔧 FIX: تبدیل مقادیر NaN برای اجتناب از خطای JSON
+            # برای ستون‌های عددی
+            numeric_columns = ['Quantity', 'UnitPrice', 'TotalAmount']
+            for col in numeric_columns:
+                if col in df.columns:
+                    df[col] = df[col].fillna(0)
+        
+            # برای ستون‌های متنی
+            text_columns = ['CustomerCode', 'ProductCode', 'InvoiceDate', 'Status', 'Notes']
+            for col in text_columns:
+                if col in df.columns:
+                    df[col] = df[col].fillna('')
+        
+            print(f"📊 Sales data cleaned: {len(df)} records")
+            return df
+
+        return load_cached_dataset('sales.xlsx', 'sales',
+                                   lambda: load_dataset_snapshot('sales.xlsx', 'sales', read_sales))
         
     except Exception as e:
         print(f"❌ Error loading sales file: {e}")
         return None
 
-@app.route('/product_report/<customer_code>')
-def product_report(customer_code):
-    """گزارش کالاهای خریداری شده و نشده مشتری"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    # بارگذاری اطلاعات مشتری
-    customers_df = load_customers_from_excel()
-    if customers_df is None:
-        flash('خطا در بارگذاری اطلاعات مشتری!', 'error')
-        return redirect(url_for('customers_list'))
-    
-    # پیدا کردن مشتری
-    customer = customers_df[customers_df['CustomerCode'] == customer_code]
-    if customer.empty:
-        flash('مشتری یافت نشد!', 'error')
-        return redirect(url_for('customers_list'))
-    
-    customer_info = customer.iloc[0].to_dict()
-    
-    # بررسی دسترسی
-    if (session['user_info']['Typev'] != 'admin' and 
-        customer_info['BazaryabCode'] != session['user_info']['Codev']):
-        flash('شما اجازه مشاهده گزارش این مشتری را ندارید!', 'error')
-        return redirect(url_for('customers_list'))
-    
-    return render_template('product_report.html', 
-                         customer=customer_info,
-                         user=session['user_info'])
+# ==============================================
+# ایندکس تاریخ فروش (مرتب بر اساس شماره روز)
+# ==============================================
 
-@app.route('/get_product_data/<customer_code>')
-def get_product_data(customer_code):
-    """دریافت داده‌های کالا برای مشتری در بازه زمانی"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
-    
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
-    date_type = request.args.get('date_type', 'gregorian')
-    
-    if not date_from or not date_to:
-        return jsonify({'error': 'Date range required'}), 400
-    
-    # تبدیل تاریخ شمسی به میلادی در صورت نیاز
-    if date_type == 'jalali':
-        date_from_gregorian = jalali_to_gregorian(date_from)
-        date_to_gregorian = jalali_to_gregorian(date_to)
-        
-        if not date_from_gregorian or not date_to_gregorian:
-            return jsonify({'error': 'Invalid date format'}), 400
-    else:
+def build_sales_date_index():
+    """فروش کش‌شده به همراه ستون‌های تاریخ، مرتب شده بر اساس DayOrdinal"""
+    sales_df = load_sales_from_excel()
+    if sales_df is None:
+        return None
+
+    if 'InvoiceDate' in sales_df.columns:
+        sale_dates = convert_date_column(sales_df['InvoiceDate'])
+    else:
+        sale_dates = convert_date_column(pd.Series([None] * len(sales_df), index=sales_df.index))
+
+    indexed_df = sales_df.assign(
+        DayOrdinal=sale_dates['DayOrdinal'],
+        JalaliYear=sale_dates['JalaliYear'],
+        JalaliMonth=sale_dates['JalaliMonth'],
+        JalaliWeek=sale_dates['JalaliWeek'],
+        YearMonth=sale_dates['YearMonth'],
+        InvoiceDateConverted=sale_dates['GregorianDate']
+    )
+    # برچسب ردیف‌ها همان شماره ردیف فایل می‌ماند تا ترتیب اصلی با sort_index قابل بازیابی باشد
+    indexed_df = indexed_df.sort_values('DayOrdinal', kind='stable')
+
+    print(f"🗂️ Sales date index built: {len(indexed_df)} records")
+    return {
+        'sales': indexed_df,
+        'ordinals': indexed_df['DayOrdinal'].to_numpy(),
+        'year_months': indexed_df['YearMonth'].to_numpy()
+    }
+
+
+def get_sales_date_index():
+    """ایندکس تاریخ فروش - یک بار به ازای هر نسخه sales.xlsx"""
+    return load_derived_dataset('sales_date_index', ['sales.xlsx'], build_sales_date_index)
+
+
+def get_indexed_sales():
+    """کل فروش مرتب شده بر اساس تاریخ (با DayOrdinal، JalaliYear، JalaliMonth، YearMonth)"""
+    index = get_sales_date_index()
+    if index is None:
+        return None
+    return index['sales'].copy(deep=False)
+
+
+def sales_between(from_ordinal=None, to_ordinal=None):
+    """
+    فروش‌های یک بازه تاریخی با جستجوی دودویی روی ایندکس مرتب
+
+    Args:
+        from_ordinal: شماره روز شروع (شامل) - None یعنی از ابتدا
+        to_ordinal: شماره روز پایان (شامل) - None یعنی تا انتها
+
+    Returns:
+        برشی از فروش‌ها (فقط ردیف‌های با تاریخ معتبر) یا None اگر فایل فروش نباشد
+    """
+    index = get_sales_date_index()
+    if index is None:
+        return None
+
+    start, end = get_sales_range_bounds(index, from_ordinal, to_ordinal)
+    return index['sales'].iloc[start:end]
+
+
+def get_sales_range_bounds(index, from_ordinal=None, to_ordinal=None):
+    """محدوده ردیف‌های [start, end) یک بازه تاریخی در ایندکس مرتب فروش"""
+    ordinals = index['ordinals']
+    low = from_ordinal if from_ordinal is not None else INVALID_DAY_ORDINAL + 1
+    start = int(np.searchsorted(ordinals, low, side='left'))
+    end = len(ordinals) if to_ordinal is None else int(np.searchsorted(ordinals, to_ordinal, side='right'))
+    return start, end
+
+
+def get_year_month_bounds(index, start_ym, end_ym):
+    """محدوده ردیف‌های [start, end) بازه ماه‌های شمسی (کلید سال*100+ماه) در ایندکس مرتب فروش"""
+    year_months = index['year_months']
+    start = int(np.searchsorted(year_months, max(start_ym, 1), side='left'))
+    end = int(np.searchsorted(year_months, end_ym, side='right'))
+    return start, max(start, end)
+
+
+def filter_by_jalali_range(start_ym, end_ym):
+    """
+    فروش‌های بازه ماه‌های شمسی - برش مستقیم از فروش کش‌شده
+
+    Args:
+        start_ym: ماه شروع به صورت سال*100+ماه (مثلاً 140301)
+        end_ym: ماه پایان (شامل)
+
+    Returns:
+        برشی از فروش‌های مرتب بر اساس تاریخ یا None اگر فایل فروش نباشد
+    """
+    index = get_sales_date_index()
+    if index is None:
+        return None
+
+    start, end = get_year_month_bounds(index, int(start_ym), int(end_ym))
+    return index['sales'].iloc[start:end]
+
+
+def filter_by_jalali(year, months):
+    """فروش‌های چند ماه (نه لزوماً پشت سر هم) از یک سال شمسی"""
+    index = get_sales_date_index()
+    if index is None:
+        return None
+
+    year = int(year)
+    bounds = [get_year_month_bounds(index, year * 100 + month, year * 100 + month)
+              for month in sorted({int(m) for m in months})]
+    if len(bounds) == 1:
+        return index['sales'].iloc[bounds[0][0]:bounds[0][1]]
+
+    positions = np.concatenate([np.arange(start, end) for start, end in bounds]) if bounds else np.empty(0, dtype=np.intp)
+    return index['sales'].iloc[positions]
+
+
+def get_year_month_keys(sales_df):
+    """کلید سال*100+ماه شمسی ردیف‌ها - ستون YearMonth اگر از قبل باشد، وگرنه تبدیل برداری"""
+    if 'YearMonth' in sales_df.columns:
+        return sales_df['YearMonth']
+    return convert_date_column(sales_df['InvoiceDate'])['YearMonth']
+
+
+# ==============================================
+# ایندکس‌های هش فروش (مشتری، کالا، بازاریاب)
+# ==============================================
+
+SALES_KEY_COLUMNS = {
+    'customer': 'CustomerCode',
+    'product': 'ProductCode'
+}
+
+
+def build_sales_key_index():
+    """نگاشت کد -> شماره ردیف‌ها (در فروش مرتب شده بر اساس تاریخ) برای مشتری، کالا و بازاریاب"""
+    date_index = get_sales_date_index()
+    if date_index is None:
+        return None
+
+    sales_df = date_index['sales']
+    # شماره ردیف‌ها فقط برای همین نسخه فروش معتبرند؛ sales_by_key از همین ایندکس برش می‌زند
+    key_index = {'date_index': date_index}
+    for key, column in SALES_KEY_COLUMNS.items():
+        if column in sales_df.columns:
+            key_index[key] = sales_df.groupby(column, sort=False).indices
+        else:
+            key_index[key] = {}
+
+    # بازاریاب از روی مشتریان او (BazaryabCode در فایل مشتریان) مشتق می‌شود
+    salesperson_positions = {}
+    customers_df = load_customers_from_excel()
+    if customers_df is not None and {'BazaryabCode', 'CustomerCode'} <= set(customers_df.columns):
+        customer_positions = key_index['customer']
+        for salesperson_code, codes in customers_df.groupby('BazaryabCode', sort=False)['CustomerCode']:
+            parts = [customer_positions[code] for code in codes.unique() if code in customer_positions]
+            if parts:
+                salesperson_positions[salesperson_code] = np.unique(np.concatenate(parts))
+    key_index['salesperson'] = salesperson_positions
+
+    print(f"🗂️ Sales key index built: {len(key_index['customer'])} customers, "
+          f"{len(key_index['product'])} products, {len(salesperson_positions)} salespeople")
+    return key_index
+
+
+def get_sales_key_index():
+    """ایندکس‌های هش فروش - یک بار به ازای هر نسخه فایل فروش و مشتریان"""
+    return load_derived_dataset('sales_key_index', ['sales.xlsx', CUSTOMERS_FILE], build_sales_key_index)
+
+
+def sales_by_key(key, codes, from_ordinal=None, to_ordinal=None):
+    """
+    فروش‌های یک یا چند کد (مشتری، کالا یا بازاریاب) بدون پیمایش کل جدول
+
+    Args:
+        key: 'customer'، 'product' یا 'salesperson'
+        codes: یک کد یا لیستی از کدها
+        from_ordinal, to_ordinal: بازه تاریخ اختیاری (مانند sales_between)
+
+    Returns:
+        ردیف‌های فروش به ترتیب تاریخ یا None اگر فایل فروش نباشد
+    """
+    key_index = get_sales_key_index()
+    if key_index is None:
+        return None
+    date_index = key_index['date_index']
+
+    if isinstance(codes, (list, tuple, set, np.ndarray, pd.Series)):
+        codes = pd.unique(pd.Series(list(codes), dtype=object))
+    else:
+        codes = [codes]
+
+    code_positions = key_index[key]
+    parts = [code_positions[code] for code in codes if code in code_positions]
+    if not parts:
+        positions = np.empty(0, dtype=np.intp)
+    elif len(parts) == 1:
+        positions = parts[0]
+    else:
+        positions = np.unique(np.concatenate(parts))
+
+    # شماره ردیف‌ها مرتب هستند، پس بازه تاریخ هم با جستجوی دودویی بریده می‌شود
+    if from_ordinal is not None or to_ordinal is not None:
+        start, end = get_sales_range_bounds(date_index, from_ordinal, to_ordinal)
+        positions = positions[np.searchsorted(positions, start, side='left'):np.searchsorted(positions, end, side='left')]
+
+    return date_index['sales'].iloc[positions]
+
+
+# ==============================================
+# موتور دسته‌ای خریداران / نخریداران کالاها
+# ==============================================
+
+def resolve_date_window(date_from, date_to, date_type):
+    """بازه تاریخ درخواست به (شماره روز شروع، پایان) - بدون بازه یا تاریخ نامعتبر: (None، None)"""
+    if not date_from or not date_to:
+        return None, None
+
+    if date_type == 'jalali':
+        date_from_gregorian = jalali_to_gregorian(date_from)
+        date_to_gregorian = jalali_to_gregorian(date_to)
+        if not date_from_gregorian or not date_to_gregorian:
+            print(f"⚠️ Invalid date format")
+            return None, None
+    else:
         date_from_gregorian = date_from
         date_to_gregorian = date_to
-    
-    # بارگذاری داده‌ها
-    products_df = load_products_from_excel()
+
+    return date_to_ordinal(date_from_gregorian), date_to_ordinal(date_to_gregorian)
+
+
+def format_purchase_dates(invoice_dates):
+    """تاریخ نمایشی خرید (شمسی) - تبدیل فقط روی مقادیر یکتا"""
+    display_dates = {}
+    for original_date in invoice_dates.dropna().unique():
+        date_str = str(original_date).strip()
+        if '/' in date_str:
+            display_dates[original_date] = date_str
+        elif '-' in date_str and len(date_str) == 10:
+            display_dates[original_date] = gregorian_to_jalali(date_str)
+        else:
+            display_dates[original_date] = date_str
+    return invoice_dates.map(display_dates)
+
+
+def get_product_buyers(product_codes, from_ordinal=None, to_ordinal=None):
+    """
+    خریداران چند کالا در یک بازه - یک برش تاریخ و یک groupby برای همه کالاها
+
+    Returns:
+        dict: کد کالا -> {کد مشتری -> TotalQuantity، TotalAmount، LastPurchaseDate، PurchaseDates}
+        (ترتیب خریداران و تاریخ‌ها همان ترتیب فایل فروش) یا None اگر فایل فروش نباشد
+    """
+    product_sales = sales_by_key('product', list(product_codes), from_ordinal, to_ordinal)
+    if product_sales is None:
+        return None
+
+    product_sales = product_sales.sort_index()
+    quantities = pd.to_numeric(product_sales['Quantity'], errors='coerce').fillna(0).astype('int64').to_numpy()
+    amounts = pd.to_numeric(product_sales['TotalAmount'], errors='coerce').fillna(0).to_numpy()
+    display_dates = format_purchase_dates(product_sales['InvoiceDate']).to_numpy()
+    ordinals = product_sales['DayOrdinal'].to_numpy()
+
+    buyers = {product_code: {} for product_code in product_codes}
+    for (product_code, customer_code), positions in product_sales.groupby(
+            ['ProductCode', 'CustomerCode'], sort=False).indices.items():
+        last_ordinal = int(ordinals[positions].max())
+        buyers[product_code][customer_code] = {
+            'TotalQuantity': int(quantities[positions].sum()),
+            'TotalAmount': int(amounts[positions].sum()),
+            'LastPurchaseDate': ordinal_to_jalali_str(last_ordinal) if last_ordinal != INVALID_DAY_ORDINAL else '',
+            'PurchaseDates': [
+                {'date': display_dates[position], 'quantity': int(quantities[position]), 'amount': int(amounts[position])}
+                for position in positions
+                if not pd.isna(display_dates[position])
+            ]
+        }
+
+    return buyers
+
+
+def normalize_location_set(location_set):
+    """مقدار LocationSet به boolean"""
+    if pd.isna(location_set):
+        return False
+    if isinstance(location_set, str):
+        return location_set.lower() in ['true', '1', 'yes', 'بله']
+    return bool(location_set)
+
+
+def get_scope_customer_records(customers_df, users_df, include_bazaryab_code=False):
+    """اطلاعات نمایشی مشتریان محدوده کاربر (نام بازاریاب با یک نگاشت) - لیست (کد، dict)"""
+    bazaryab_names = {}
+    if users_df is not None:
+        bazaryab_names = users_df.drop_duplicates('Codev').set_index('Codev')['Namev'].to_dict()
+
+    location_sets = customers_df['LocationSet'] if 'LocationSet' in customers_df.columns \
+        else pd.Series(False, index=customers_df.index)
+
+    records = []
+    for customer_code, customer_name, bazaryab_code, location_set in zip(
+            customers_df['CustomerCode'], customers_df['CustomerName'],
+            customers_df['BazaryabCode'], location_sets):
+        record = {
+            'CustomerCode': str(customer_code),
+            'CustomerName': str(customer_name)
+        }
+        if include_bazaryab_code:
+            record['BazaryabCode'] = str(bazaryab_code)
+        record['BazaryabName'] = bazaryab_names.get(bazaryab_code, "نامشخص")
+        record['LocationSet'] = normalize_location_set(location_set)
+        records.append((customer_code, record))
+    return records
+
+
+def split_product_customers(customer_records, product_buyers):
+    """تفکیک مشتریان محدوده به خریدار (با آمار خرید) و نخریدار"""
+    purchased_customers = []
+    not_purchased_customers = []
+    for customer_code, record in customer_records:
+        purchase_data = product_buyers.get(customer_code)
+        if purchase_data is not None:
+            purchased_customers.append({**record, **purchase_data})
+        else:
+            not_purchased_customers.append(dict(record))
+    return purchased_customers, not_purchased_customers
+
+
+def clean_product_details(product_details):
+    """تمیز کردن اطلاعات کالا از NaN"""
+    clean_details = {}
+    for key, value in product_details.items():
+        if pd.isna(value):
+            clean_details[key] = 0 if key in ['Price', 'Stock'] else ""
+        else:
+            clean_details[key] = value
+    return clean_details
+
+
+# ==============================================
+# مکعب تجمیعی فروش (بازاریاب × برند × کالا × مشتری × ماه شمسی)
+# ==============================================
+
+SALES_CUBE_DIMENSIONS = ['SalespersonCode', 'Brand', 'ProductCode', 'CustomerCode', 'YearMonth']
+
+# وضعیت آخرین ساخت مکعب برای به‌روزرسانی افزایشی (وقتی فقط ردیف به انتهای فایل اضافه شده)
+_sales_cube_state = {}
+
+
+def get_sales_dimension_maps():
+    """نگاشت کد کالا -> برند و کد مشتری -> بازاریاب"""
+    catalog_index = get_product_catalog_index()
+    customers_df = load_customers_from_excel()
+
+    brand_map = pd.Series(dtype=object)
+    if catalog_index is not None and 'Brand' in catalog_index['by_code'].columns:
+        brand_map = catalog_index['by_code']['Brand']
+
+    salesperson_map = pd.Series(dtype=object)
+    if customers_df is not None and {'CustomerCode', 'BazaryabCode'} <= set(customers_df.columns):
+        salesperson_map = customers_df.drop_duplicates('CustomerCode', keep='last').set_index('CustomerCode')['BazaryabCode']
+
+    return brand_map, salesperson_map
+
+
+def aggregate_sales_cube(sales_part, brand_map, salesperson_map):
+    """
+    تجمیع ردیف‌های فروش در دانه مکعب
+
+    FirstRow کوچک‌ترین شماره ردیف فایل در هر گروه است تا ترتیب اولین ظهور حفظ شود.
+    """
+    if 'YearMonth' in sales_part.columns:
+        year_months = sales_part['YearMonth']
+    elif 'InvoiceDate' in sales_part.columns:
+        year_months = convert_date_column(sales_part['InvoiceDate'])['YearMonth']
+    else:
+        year_months = pd.Series(0, index=sales_part.index)
+
+    def numeric_column(column):
+        if column not in sales_part.columns:
+            return pd.Series(0.0, index=sales_part.index)
+        return pd.to_numeric(sales_part[column], errors='coerce').fillna(0)
+
+    cube_rows = pd.DataFrame({
+        'SalespersonCode': sales_part['CustomerCode'].map(salesperson_map),
+        'Brand': sales_part['ProductCode'].map(brand_map),
+        'ProductCode': sales_part['ProductCode'],
+        'CustomerCode': sales_part['CustomerCode'],
+        'YearMonth': year_months,
+        'Amount': numeric_column('TotalAmount'),
+        'Quantity': numeric_column('Quantity'),
+        'FirstRow': sales_part.index
+    }, index=sales_part.index)
+
+    return cube_rows.groupby(SALES_CUBE_DIMENSIONS, sort=False, dropna=False).agg(
+        Amount=('Amount', 'sum'),
+        Quantity=('Quantity', 'sum'),
+        InvoiceCount=('Amount', 'size'),
+        FirstRow=('FirstRow', 'min')
+    ).reset_index()
+
+
+def merge_sales_cubes(*cubes):
+    """ادغام چند مکعب هم‌دانه (جمع مقادیر، کمینه FirstRow)"""
+    return pd.concat(cubes, ignore_index=True).groupby(SALES_CUBE_DIMENSIONS, sort=False, dropna=False).agg(
+        Amount=('Amount', 'sum'),
+        Quantity=('Quantity', 'sum'),
+        InvoiceCount=('InvoiceCount', 'sum'),
+        FirstRow=('FirstRow', 'min')
+    ).reset_index()
+
+
+def build_sales_cube():
+    """ساخت مکعب فروش - اگر فقط ردیف جدید اضافه شده باشد، فقط همان ردیف‌ها تجمیع می‌شوند"""
     sales_df = load_sales_from_excel()
+    if sales_df is None:
+        return None
+
+    sales_df = sales_df.reset_index(drop=True)
+    maps_version = get_dataset_versions('products.xlsx', CUSTOMERS_FILE)
+    brand_map, salesperson_map = get_sales_dimension_maps()
+    row_hashes = pd.util.hash_pandas_object(sales_df, index=False).to_numpy()
+
+    previous = _sales_cube_state.get('state')
+    old_count = previous['row_count'] if previous else 0
+    appended_only = (
+        previous is not None
+        and previous['maps_version'] == maps_version
+        and 0 < old_count <= len(sales_df)
+        and np.array_equal(row_hashes[:old_count], previous['row_hashes'])
+    )
+
+    if appended_only:
+        cube = previous['cube']
+        if old_count < len(sales_df):
+            tail_cube = aggregate_sales_cube(sales_df.iloc[old_count:], brand_map, salesperson_map)
+            cube = merge_sales_cubes(cube, tail_cube)
+        print(f"🧊 Sales cube refreshed incrementally: +{len(sales_df) - old_count} rows")
+    else:
+        cube = aggregate_sales_cube(sales_df, brand_map, salesperson_map)
+        print(f"🧊 Sales cube built: {len(sales_df)} rows -> {len(cube)} cells")
+
+    cube = cube.sort_values('YearMonth', kind='stable').reset_index(drop=True)
+    _sales_cube_state['state'] = {
+        'maps_version': maps_version,
+        'row_count': len(sales_df),
+        'row_hashes': row_hashes,
+        'cube': cube
+    }
+
+    return {
+        'cube': cube,
+        'year_months': cube['YearMonth'].to_numpy(),
+        'brand_map': brand_map,
+        'salesperson_map': salesperson_map
+    }
+
+
+def get_sales_cube():
+    """مکعب فروش - یک بار به ازای هر نسخه فایل‌های فروش، کالا و مشتری"""
+    return load_derived_dataset('sales_cube', ['sales.xlsx', 'products.xlsx', CUSTOMERS_FILE], build_sales_cube)
+
+
+def jalali_month_index_to_year_month(month_index):
+    """شماره ماه در جدول ماه‌های شمسی -> سال*100+ماه"""
+    return (JALALI_TABLE_START_YEAR + month_index // 12) * 100 + month_index % 12 + 1
+
+
+def get_full_month_span(from_ordinal=None, to_ordinal=None):
+    """اولین و آخرین ماه کامل (شماره ماه در جدول ماه‌های شمسی) داخل یک بازه روزانه"""
+    if from_ordinal is None:
+        first_month = 0
+    else:
+        first_month = int(np.searchsorted(_jalali_month_starts, from_ordinal, side='right')) - 1
+        if _jalali_month_starts[max(first_month, 0)] != from_ordinal:
+            first_month += 1
+    if to_ordinal is None:
+        last_month = len(_jalali_month_starts) - 1
+    else:
+        last_month = int(np.searchsorted(_jalali_month_starts, to_ordinal, side='right')) - 1
+        if last_month >= 0 and _jalali_month_starts[last_month] + _jalali_month_lengths[last_month] - 1 != to_ordinal:
+            last_month -= 1
+    return max(first_month, 0), last_month
+
+
+def sales_cube_between(from_ordinal=None, to_ordinal=None):
+    """
+    سلول‌های مکعب فروش برای یک بازه روزانه
+
+    ماه‌های کامل بازه مستقیماً از مکعب برش زده می‌شوند و فقط روزهای ماه‌های
+    ناقص ابتدا و انتهای بازه از ایندکس تاریخ فروش تجمیع می‌شوند.
+
+    Returns:
+        DataFrame هم‌دانه مکعب (ممکن است یک گروه در چند ردیف تکرار شود) یا None
+    """
+    cube_index = get_sales_cube()
+    if cube_index is None:
+        return None
+
+    first_month, last_month = get_full_month_span(from_ordinal, to_ordinal)
+    if first_month > last_month:
+        # بازه کوچک‌تر از یک ماه کامل است
+        edge_sales = sales_between(from_ordinal, to_ordinal)
+        return aggregate_sales_cube(edge_sales, cube_index['brand_map'], cube_index['salesperson_map'])
+
+    year_months = cube_index['year_months']
+    start = np.searchsorted(year_months, jalali_month_index_to_year_month(first_month), side='left')
+    end = np.searchsorted(year_months, jalali_month_index_to_year_month(last_month), side='right')
+    parts = [cube_index['cube'].iloc[start:end]]
+
+    # روزهای ماه ناقص ابتدا و انتهای بازه
+    first_day = int(_jalali_month_starts[first_month])
+    last_day = int(_jalali_month_starts[last_month] + _jalali_month_lengths[last_month] - 1)
+    if from_ordinal is not None and from_ordinal < first_day:
+        head_sales = sales_between(from_ordinal, first_day - 1)
+        parts.append(aggregate_sales_cube(head_sales, cube_index['brand_map'], cube_index['salesperson_map']))
+    if to_ordinal is not None and to_ordinal > last_day:
+        tail_sales = sales_between(last_day + 1, to_ordinal)
+        parts.append(aggregate_sales_cube(tail_sales, cube_index['brand_map'], cube_index['salesperson_map']))
+
+    if len(parts) == 1:
+        return parts[0]
+    return pd.concat(parts, ignore_index=True)
+
+
+def summarize_sales_cube(cube_rows, by):
+    """جمع سلول‌های مکعب روی ابعاد دلخواه (مبلغ، تعداد، فاکتور، مشتریان متمایز)"""
+    return cube_rows.groupby(by, sort=False, dropna=False).agg(
+        Amount=('Amount', 'sum'),
+        Quantity=('Quantity', 'sum'),
+        InvoiceCount=('InvoiceCount', 'sum'),
+        CustomerCount=('CustomerCode', 'nunique'),
+        FirstRow=('FirstRow', 'min')
+    ).reset_index()
+
+
+# ==============================================
+# بیت‌مپ خرید مشتری × کالا به تفکیک ماه شمسی
+# ==============================================
+
+def pack_purchase_cells(cells):
+    """
+    شماره سلول‌ها (مشتری * عرض سطر + کالا) -> (شماره بایت، مقدار بایت) یکتا
+
+    ترتیب بیت‌ها مانند np.packbits است (بیت پرارزش = کالای اول هر بایت).
+    """
+    cells = np.unique(cells)
+    byte_positions = cells >> 3
+    bits = (0x80 >> (cells & 7)).astype(np.uint8)
+    if len(cells) == 0:
+        return byte_positions, bits
+
+    starts = np.flatnonzero(np.r_[True, byte_positions[1:] != byte_positions[:-1]])
+    return byte_positions[starts], np.bitwise_or.reduceat(bits, starts)
+
+
+def build_purchase_bitmap_index():
+    """
+    ایندکس بیت‌مپ خرید: برای هر ماه شمسی، خانه‌های روشن ماتریس مشتری × کالا
+
+    هر ماه فقط بایت‌های غیرصفر ماتریس بیتی را نگه می‌دارد، پس حافظه با تعداد
+    خریدهای متمایز رشد می‌کند نه با ابعاد ماتریس (20 هزار مشتری × 5 هزار کالا
+    در یک پنجره فقط 12.5 مگابایت است).
+    """
+    date_index = get_sales_date_index()
+    if date_index is None:
+        return None
+
+    sales_df = date_index['sales']
+
+    def factorize_codes(values):
+        # کدها به صورت متن (کد عددی و متنی یکسان) - کد خالی: -1
+        codes, uniques = pd.factorize(values)
+        remap, axis = pd.factorize(pd.Index(uniques).astype(str))
+        return np.where(codes >= 0, remap[np.maximum(codes, 0)], -1), pd.Index(axis)
+
+    customer_ids, customers = factorize_codes(sales_df['CustomerCode'])
+    product_ids, products = factorize_codes(sales_df['ProductCode'])
+    row_bytes = max((len(products) + 7) // 8, 1)
+
+    # سلول هر ردیف فروش به ترتیب تاریخ (-1 برای کد خالی)
+    valid = (customer_ids >= 0) & (product_ids >= 0)
+    row_cells = np.where(valid, customer_ids.astype(np.int64) * row_bytes * 8 + product_ids, -1)
+
+    months = {}
+    year_months = date_index['year_months']
+    month_starts = np.flatnonzero(np.r_[True, year_months[1:] != year_months[:-1]]) if len(year_months) else []
+    month_ends = np.r_[month_starts[1:], len(year_months)] if len(year_months) else []
+    for start, end in zip(month_starts, month_ends):
+        year_month = int(year_months[start])
+        if year_month == 0:
+            continue
+        cells = row_cells[start:end]
+        months[year_month] = pack_purchase_cells(cells[cells >= 0])
+
+    stored_bytes = sum(positions.nbytes + values.nbytes for positions, values in months.values())
+    print(f"🧮 Purchase bitmap built: {len(customers)} customers × {len(products)} products, "
+          f"{len(months)} months, {stored_bytes / 1024 / 1024:.1f} MB")
+
+    return {
+        'customers': customers,
+        'products': products,
+        'row_bytes': row_bytes,
+        'months': months,
+        'row_cells': row_cells
+    }
+
+
+def get_purchase_bitmap_index():
+    """ایندکس بیت‌مپ خرید - یک بار به ازای هر نسخه فایل فروش"""
+    return load_derived_dataset('purchase_bitmap', ['sales.xlsx'], build_purchase_bitmap_index)
+
+
+def purchase_bitmap_between(from_ordinal=None, to_ordinal=None):
+    """
+    ماتریس بیتی خرید (مشتری × کالا) برای یک بازه روزانه
+
+    ماه‌های کامل بازه با OR برش‌های ماهانه ساخته می‌شوند و فقط روزهای ماه‌های
+    ناقص ابتدا و انتهای بازه از سلول‌های ردیف‌های فروش اضافه می‌شوند.
+
+    Returns:
+        dict: matrix (uint8 به شکل مشتری × بایت کالا)، customers، products یا None
+    """
+    bitmap_index = get_purchase_bitmap_index()
+    date_index = get_sales_date_index()
+    if bitmap_index is None or date_index is None:
+        return None
+
+    customers = bitmap_index['customers']
+    products = bitmap_index['products']
+    row_bytes = bitmap_index['row_bytes']
+    matrix = np.zeros(len(customers) * row_bytes, dtype=np.uint8)
+
+    def or_cells(day_from, day_to):
+        start, end = get_sales_range_bounds(date_index, day_from, day_to)
+        cells = bitmap_index['row_cells'][start:end]
+        positions, values = pack_purchase_cells(cells[cells >= 0])
+        matrix[positions] |= values
+
+    first_month, last_month = get_full_month_span(from_ordinal, to_ordinal)
+    if first_month > last_month:
+        # بازه کوچک‌تر از یک ماه کامل است
+        or_cells(from_ordinal, to_ordinal)
+    else:
+        first_year_month = jalali_month_index_to_year_month(first_month)
+        last_year_month = jalali_month_index_to_year_month(last_month)
+        for year_month, (positions, values) in bitmap_index['months'].items():
+            if first_year_month <= year_month <= last_year_month:
+                matrix[positions] |= values
+
+        # روزهای ماه ناقص ابتدا و انتهای بازه
+        first_day = int(_jalali_month_starts[first_month])
+        last_day = int(_jalali_month_starts[last_month] + _jalali_month_lengths[last_month] - 1)
+        if from_ordinal is not None and from_ordinal < first_day:
+            or_cells(from_ordinal, first_day - 1)
+        if to_ordinal is not None and to_ordinal > last_day:
+            or_cells(last_day + 1, to_ordinal)
+
+    return {
+        'matrix': matrix.reshape(len(customers), row_bytes),
+        'customers': customers,
+        'products': products
+    }
+
+
+def bitmap_products_bought(bitmap, customer_codes):
+    """کدهای کالاهایی که حداقل یکی از مشتریان داده شده در بازه بیت‌مپ خریده‌اند"""
+    if isinstance(customer_codes, (str, int, np.integer)):
+        customer_codes = [customer_codes]
+    rows = bitmap['customers'].get_indexer(pd.Index(list(customer_codes)).astype(str))
+    rows = rows[rows >= 0]
+    if len(rows) == 0:
+        return []
+
+    packed = np.bitwise_or.reduce(bitmap['matrix'][rows], axis=0)
+    bought = np.unpackbits(packed)[:len(bitmap['products'])]
+    return bitmap['products'][np.flatnonzero(bought)].tolist()
+
+
+def bitmap_customers_bought(bitmap, product_code, customer_codes):
+    """
+    آرایه boolean هم‌ردیف customer_codes: آیا مشتری کالا را در بازه بیت‌مپ خریده است؟
+
+    "چه کسی X را نخریده" همان ~نتیجه روی مشتریان محدوده کاربر است.
+    """
+    customer_rows = bitmap['customers'].get_indexer(pd.Index(list(customer_codes)).astype(str))
+    bought = np.zeros(len(customer_rows), dtype=bool)
+
+    product_position = bitmap['products'].get_indexer([str(product_code)])[0]
+    if product_position < 0:
+        return bought
+
+    column = bitmap['matrix'][:, product_position >> 3] & (0x80 >> (product_position & 7))
+    known = customer_rows >= 0
+    bought[known] = column[customer_rows[known]] != 0
+    return bought
+
+
+# ==============================================
+# مانیفست عکس‌های کالا (static/images)
+# ==============================================
+# به جای os.path.exists برای هر کالا در هر درخواست، فهرست عکس‌ها یک بار
+# خوانده می‌شود و وقتی پوشه تغییر کند (یا هر چند ثانیه) دوباره بررسی می‌شود.
+# هش محتوای هر عکس فقط وقتی حجم یا زمان تغییر آن عوض شود دوباره محاسبه می‌شود.
+
+PRODUCT_IMAGES_DIR = 'static/images'
+NULL_PRODUCT_IMAGE = 'null.jpg'
+IMAGE_MANIFEST_RESCAN_SECONDS = 60
+
+_image_manifest = {'dir_version': None, 'checked_at': 0.0, 'images': {}, 'version': None}
+_image_manifest_lock = threading.Lock()
+
+
+def hash_image_file(path):
+    """هش محتوای فایل عکس (برای آدرس‌های cache-busting)"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_image_manifest(force=False):
+    """
+    مانیفست عکس‌ها: نام فایل -> حجم، زمان تغییر و هش محتوا
+
+    Returns:
+        dict: images (نام فایل -> size، mtime، hash) و version (نسخه کل مانیفست)
+    """
+    global _image_manifest
+
+    with _image_manifest_lock:
+        manifest = _image_manifest
+        dir_version = get_file_version(PRODUCT_IMAGES_DIR)
+        now = time.time()
+        if not force and manifest['version'] is not None and dir_version == manifest['dir_version'] \
+                and now - manifest['checked_at'] < IMAGE_MANIFEST_RESCAN_SECONDS:
+            return manifest
+
+        previous_images = manifest['images']
+        images = {}
+        try:
+            with os.scandir(PRODUCT_IMAGES_DIR) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    previous = previous_images.get(entry.name)
+                    if previous is not None and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime_ns:
+                        images[entry.name] = previous
+                        continue
+                    try:
+                        images[entry.name] = {
+                            'size': stat.st_size,
+                            'mtime': stat.st_mtime_ns,
+                            'hash': hash_image_file(entry.path)
+                        }
+                    except OSError as e:
+                        print(f"⚠️ Image skipped: {entry.name} ({e})")
+        except OSError as e:
+            print(f"⚠️ Images folder not readable: {e}")
+
+        version = hashlib.md5(repr(sorted((name, info['hash']) for name, info in images.items())).encode()).hexdigest()
+        if version != manifest['version']:
+            print(f"🖼️ Image manifest built: {len(images)} images")
+
+        _image_manifest = {'dir_version': dir_version, 'checked_at': now, 'images': images, 'version': version}
+        return _image_manifest
+
+
+def resolve_product_image(image_file, manifest=None):
+    """نام فایل عکس کالا اگر در مانیفست باشد، وگرنه عکس پیش‌فرض"""
+    if manifest is None:
+        manifest = get_image_manifest()
+    return image_file if image_file in manifest['images'] else NULL_PRODUCT_IMAGE
+
+
+def product_image_url(image_file, manifest=None):
+    """آدرس عکس کالا با نسخه محتوا (?v=) برای cache-busting مرورگر"""
+    if manifest is None:
+        manifest = get_image_manifest()
+    image_file = resolve_product_image(image_file, manifest)
+    url = f"/{PRODUCT_IMAGES_DIR}/{image_file}"
+    info = manifest['images'].get(image_file)
+    if info is not None:
+        url += f"?v={info['hash'][:12]}"
+    return url
+
+
+# ساخت مانیفست در شروع برنامه (در پس‌زمینه تا بالا آمدن سرور معطل هش عکس‌ها نشود)
+threading.Thread(target=get_image_manifest, name='image-manifest', daemon=True).start()
+
+
+# ==============================================
+# ایندکس کاتالوگ کالا و گزارش کالاهای مشتری (کش‌شده)
+# ==============================================
+
+PRODUCT_REPORT_FIELDS = ['ProductCode', 'ProductName', 'Brand', 'Category', 'Price',
+                         'ImageFile', 'Description', 'Offer1', 'Offer2', 'Offer3']
+
+# نتیجه گزارش کالاهای مشتری به ازای (مشتری، بازه، نسخه داده) - LRU
+PRODUCT_REPORT_CACHE_SIZE = 256
+_product_report_cache = OrderedDict()
+_product_report_cache_lock = threading.Lock()
+
+
+def index_products(products_df, brand_order=None):
+    """
+    ایندکس جستجوی کالاها (بدون اطلاعات عکس)
+
+    Args:
+        products_df: کالاهای تمیزشده (load_products_from_excel)
+        brand_order: ترتیب برندها از شیت brand (اختیاری)
+
+    Returns:
+        dict:
+            products: همه کالاها با ایندکس 0..n-1
+            by_code: کالا به ازای کد (اولین ردیف هر کد)
+            brand_positions: برند -> شماره ردیف‌ها به ترتیب فایل
+            brand_sorted_positions: برند -> شماره ردیف‌ها مرتب بر اساس دسته و ردیف
+            brands: برندهای موجود به ترتیب الفبا
+            base_codes: کد کالا -> کد پایه (رسمی/غیررسمی)
+            brand_order، brand_radif: ترتیب شیت brand و ردیف هر برند در آن
+    """
+    products = products_df.reset_index(drop=True)
+    radif = products['Radif'] if 'Radif' in products.columns else pd.Series(999999, index=products.index)
+
+    sorted_products = products.assign(_Radif=radif).sort_values(['Category', '_Radif'], kind='stable')
+    brand_sorted_positions = {
+        brand: sorted_products.index.to_numpy()[positions]
+        for brand, positions in sorted_products.groupby('Brand', sort=False).indices.items()
+    }
+
+    variants = split_product_variant_codes(products['ProductCode'])
+    brand_order = list(brand_order) if brand_order else []
+
+    return {
+        'products': products,
+        'by_code': products.drop_duplicates('ProductCode').set_index('ProductCode', drop=False),
+        'brand_positions': products.groupby('Brand', sort=False).indices,
+        'brand_sorted_positions': brand_sorted_positions,
+        'brands': sorted(products['Brand'].unique()),
+        'base_codes': pd.Series(variants['BaseCode'].to_numpy(), index=products['ProductCode'].to_numpy()),
+        'brand_order': brand_order,
+        'brand_radif': {brand: index + 1 for index, brand in enumerate(brand_order)}
+    }
+
+
+def build_product_catalog_index():
+    """
+    ایندکس کاتالوگ کالا: ایندکس جستجو (index_products) به اضافه اطلاعات نمایشی
+    هر کالا با عکس بررسی‌شده
+
+    ترتیب report_products همان ترتیب گزارش کالاهای مشتری است
+    (برندها به ترتیب الفبا، کالاهای هر برند بر اساس دسته و ردیف).
+    """
+    products_df = load_products_from_excel()
+    if products_df is None:
+        return None
+
+    catalog_index = index_products(products_df, load_brand_order_from_excel())
+    products = catalog_index['products']
+
+    report_products = []
+    for brand in catalog_index['brands']:
+        brand_products = products.iloc[catalog_index['brand_sorted_positions'][brand]]
+        report_products.extend(brand_products[PRODUCT_REPORT_FIELDS].to_dict('records'))
+
+    # عکس هر کالا از مانیفست (بدون بررسی فایل)
+    manifest = get_image_manifest()
+    for product in report_products:
+        product['ImageUrl'] = product_image_url(product['ImageFile'], manifest)
+        product['ImageFile'] = resolve_product_image(product['ImageFile'], manifest)
+    catalog_index['report_products'] = report_products
+
+    print(f"📚 Product catalog index built: {len(products)} products, {len(catalog_index['brands'])} brands")
+    return catalog_index
+
+
+def get_product_catalog_index():
+    """ایندکس کاتالوگ - یک بار به ازای هر نسخه فایل کالاها و مانیفست عکس‌ها"""
+    return load_derived_dataset('product_catalog', ['products.xlsx'], build_product_catalog_index,
+                                extra_version=get_image_manifest()['version'])
+
+
+def lookup_product(catalog_index, product_code):
+    """کالا با کد (Series) یا None"""
+    by_code = catalog_index['by_code']
+    if product_code not in by_code.index:
+        return None
+    return by_code.loc[product_code]
+
+
+def get_brand_products(catalog_index, brand, sort=False):
+    """کالاهای یک برند به ترتیب فایل (یا مرتب بر اساس دسته و ردیف)"""
+    positions_by_brand = catalog_index['brand_sorted_positions' if sort else 'brand_positions']
+    positions = positions_by_brand.get(brand, np.empty(0, dtype=np.intp))
+    return catalog_index['products'].iloc[positions]
+
+
+def build_customer_product_aggregates(customer_code, from_ordinal, to_ordinal):
+    """
+    تجمیع خریدهای یک مشتری در بازه به تفکیک کالا (یک groupby)
+
+    Returns:
+        dict: total_amount و products (کد کالا -> تعداد، مبلغ، تاریخ‌های خرید) یا None
+    """
+    customer_sales = sales_by_key('customer', customer_code, from_ordinal, to_ordinal)
+    if customer_sales is None:
+        return None
+    customer_sales = customer_sales.sort_index()
+
+    total_amount = customer_sales['TotalAmount'].sum()
+
+    # تاریخ نمایشی و فشرده فقط برای تاریخ‌های یکتا
+    display_dates = {}
+    for original_date in customer_sales['InvoiceDate'].unique():
+        # اگر تاریخ اصلی شمسی است، همان را نشان بده، اگر میلادی است به شمسی تبدیل کن
+        if '/' in str(original_date):
+            display_dates[original_date] = (str(original_date), str(original_date).replace('/', ''))
+        else:
+            display_dates[original_date] = (gregorian_to_jalali(original_date), jalali_date_compact(original_date))
+
+    invoice_dates = customer_sales['InvoiceDate'].tolist()
+    quantities = customer_sales['Quantity'].tolist()
+    amounts = customer_sales['TotalAmount'].tolist()
+
+    products = {}
+    for product_code, positions in customer_sales.groupby('ProductCode', sort=False).indices.items():
+        product_amount = sum(amounts[position] for position in positions)
+        purchase_dates = []
+        for position in positions:
+            display_date, compact_date = display_dates[invoice_dates[position]]
+            purchase_dates.append({
+                'date': display_date,
+                'compact': compact_date,
+                'quantity': quantities[position],
+                'amount': amounts[position]
+            })
+
+        products[product_code] = {
+            'TotalQuantity': int(sum(quantities[position] for position in positions)),
+            'TotalAmount': int(product_amount),
+            'Percentage': round((product_amount / total_amount * 100) if total_amount > 0 else 0, 2),
+            'PurchaseDates': purchase_dates
+        }
+
+    return {'total_amount': int(total_amount), 'products': products}
+
+
+def get_product_report_payload(customer_code, from_ordinal, to_ordinal):
+    """
+    کالاهای خریداری شده و نشده مشتری در بازه - کش‌شده به ازای (مشتری، بازه، نسخه داده)
+
+    Returns:
+        dict: purchased، not_purchased و total_amount یا None اگر فایل‌ها نباشند
+    """
+    key = (customer_code, from_ordinal, to_ordinal,
+           get_dataset_versions('sales.xlsx', 'products.xlsx'), get_image_manifest()['version'])
+
+    with _product_report_cache_lock:
+        payload = _product_report_cache.get(key)
+        if payload is not None:
+            _product_report_cache.move_to_end(key)
+            return payload
+
+    catalog_index = get_product_catalog_index()
+    aggregates = build_customer_product_aggregates(customer_code, from_ordinal, to_ordinal)
+    if catalog_index is None or aggregates is None:
+        return None
+
+    purchased_list = []
+    not_purchased_list = []
+    for product in catalog_index['report_products']:
+        purchase_data = aggregates['products'].get(product['ProductCode'])
+        if purchase_data is not None:
+            purchased_list.append({**product, 'Purchased': True, **purchase_data})
+        else:
+            not_purchased_list.append({**product, 'Purchased': False})
+
+    payload = {
+        'purchased': purchased_list,
+        'not_purchased': not_purchased_list,
+        'total_amount': aggregates['total_amount']
+    }
+
+    with _product_report_cache_lock:
+        _product_report_cache[key] = payload
+        while len(_product_report_cache) > PRODUCT_REPORT_CACHE_SIZE:
+            _product_report_cache.popitem(last=False)
+
+    return payload
+
+
+@app.route('/product_report/<customer_code>')
+def product_report(customer_code):
+    """گزارش کالاهای خریداری شده و نشده مشتری"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
     
-    if products_df is None or sales_df is None:
-        return jsonify({'error': 'Failed to load data'}), 500
-    
-    # تبدیل تاریخ‌های فروش به میلادی اگر شمسی هستند
-    def convert_sale_date_to_gregorian(date_value):
-        """تبدیل تاریخ فروش به میلادی"""
-        if pd.isna(date_value):
-            return None
-        
-        date_str = str(date_value).strip()
-        
-        # اگر شمسی است (شامل / است)
-        if '/' in date_str and len(date_str.split('/')) == 3:
-            return jalali_to_gregorian(date_str)
-        
-        # اگر قبلاً میلادی است
-        if '-' in date_str and len(date_str) == 10:
-            return date_str
-        
-        return date_str
+    # بارگذاری اطلاعات مشتری
+    customers_df = load_customers_from_excel()
+    if customers_df is None:
+        flash('خطا در بارگذاری اطلاعات مشتری!', 'error')
+        return redirect(url_for('customers_list'))
     
-    # تبدیل تمام تاریخ‌های فروش به میلادی
-    sales_df_copy = sales_df.copy()
-    sales_df_copy['InvoiceDateConverted'] = sales_df_copy['InvoiceDate'].apply(convert_sale_date_to_gregorian)
+    # پیدا کردن مشتری
+    customer = customers_df[customers_df['CustomerCode'] == customer_code]
+    if customer.empty:
+        flash('مشتری یافت نشد!', 'error')
+        return redirect(url_for('customers_list'))
     
-    # فیلتر فروش در بازه زمانی و مشتری
-    customer_sales = sales_df_copy[
-        (sales_df_copy['CustomerCode'] == customer_code) &
-        (sales_df_copy['InvoiceDateConverted'] >= date_from_gregorian) &
-        (sales_df_copy['InvoiceDateConverted'] <= date_to_gregorian)
-    ]
+    customer_info = customer.iloc[0].to_dict()
     
-    # محاسبه کل مبلغ خرید
-    total_amount = customer_sales['TotalAmount'].sum()
+    # بررسی دسترسی
+    if (session['user_info']['Typev'] != 'admin' and 
+        customer_info['BazaryabCode'] != session['user_info']['Codev']):
+        flash('شما اجازه مشاهده گزارش این مشتری را ندارید!', 'error')
+        return redirect(url_for('customers_list'))
     
-    # کالاهای خریداری شده
-    purchased_products = customer_sales['ProductCode'].unique()
+    return render_template('product_report.html', 
+                         customer=customer_info,
+                         user=session['user_info'])
+
+@app.route('/get_product_data/<customer_code>')
+def get_product_data(customer_code):
+    """دریافت داده‌های کالا برای مشتری در بازه زمانی"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
     
-    # تفکیک برند و مرتب‌سازی
-    purchased_list = []
-    not_purchased_list = []
+    date_from = request.args.get('date_from')
+    date_to = request.args.get('date_to')
+    date_type = request.args.get('date_type', 'gregorian')
     
-    # گروه‌بندی بر اساس برند
-    brands = products_df['Brand'].unique()
+    if not date_from or not date_to:
+        return jsonify({'error': 'Date range required'}), 400
     
-    for brand in sorted(brands):
-        brand_products = products_df[products_df['Brand'] == brand].sort_values('Category')
+    # تبدیل تاریخ شمسی به میلادی در صورت نیاز
+    if date_type == 'jalali':
+        date_from_gregorian = jalali_to_gregorian(date_from)
+        date_to_gregorian = jalali_to_gregorian(date_to)
         
-        for _, product in brand_products.iterrows():
-            # بررسی وجود عکس
-            image_path = f"static/images/{product['ImageFile']}"
-            if not os.path.exists(image_path):
-                image_file = "null.jpg"
-            else:
-                image_file = product['ImageFile']
-            
-            product_data = {
-                'ProductCode': product['ProductCode'],
-                'ProductName': product['ProductName'],
-                'Brand': product['Brand'],
-                'Category': product['Category'],
-                'Price': product['Price'],
-                'ImageFile': image_file,
-                'Description': product['Description'],
-                'Offer1': product['Offer1'],
-                'Offer2': product['Offer2'],
-                'Offer3': product['Offer3']
-            }
-            
-            if product['ProductCode'] in purchased_products:
-                # محاسبه آمار خرید
-                product_sales = customer_sales[customer_sales['ProductCode'] == product['ProductCode']]
-                total_qty = product_sales['Quantity'].sum()
-                product_amount = product_sales['TotalAmount'].sum()
-                percentage = (product_amount / total_amount * 100) if total_amount > 0 else 0
-                
-                # تاریخ‌های خرید (نمایش اصلی)
-                purchase_dates = []
-                for _, sale in product_sales.iterrows():
-                    original_date = sale['InvoiceDate']
-                    # اگر تاریخ اصلی شمسی است، همان را نشان بده
-                    if '/' in str(original_date):
-                        display_date = str(original_date)
-                        compact_date = str(original_date).replace('/', '')
-                    else:
-                        # اگر میلادی است، به شمسی تبدیل کن
-                        display_date = gregorian_to_jalali(original_date)
-                        compact_date = jalali_date_compact(original_date)
-                    
-                    purchase_dates.append({
-                        'date': display_date,
-                        'compact': compact_date,
-                        'quantity': sale['Quantity'],
-                        'amount': sale['TotalAmount']
-                    })
-                
-                product_data.update({
-                    'Purchased': True,
-                    'TotalQuantity': int(total_qty),
-                    'TotalAmount': int(product_amount),
-                    'Percentage': round(percentage, 2),
-                    'PurchaseDates': purchase_dates
-                })
-                purchased_list.append(product_data)
-            else:
-                product_data['Purchased'] = False
-                not_purchased_list.append(product_data)
+        if not date_from_gregorian or not date_to_gregorian:
+            return jsonify({'error': 'Invalid date format'}), 400
+    else:
+        date_from_gregorian = date_from
+        date_to_gregorian = date_to
+    
+    # تاریخ نامعتبر نباید به بازه باز تبدیل و در کش گزارش ذخیره شود
+    day_window = date_window_to_ordinals(date_from_gregorian, date_to_gregorian)
+    if day_window is None:
+        return jsonify({'error': 'Invalid date format'}), 400
+    
+    # کالاهای خریداری شده و نشده از تجمیع کش‌شده مشتری
+    payload = get_product_report_payload(customer_code, *day_window)
+    if payload is None:
+        return jsonify({'error': 'Failed to load data'}), 500
     
     return jsonify({
-        'purchased': purchased_list,
-        'not_purchased': not_purchased_list,
-        'total_amount': int(total_amount),
+        'purchased': payload['purchased'],
+        'not_purchased': payload['not_purchased'],
+        'total_amount': payload['total_amount'],
         'date_from': date_from,
         'date_to': date_to,
         'date_from_jalali': date_from if date_type == 'jalali' else gregorian_to_jalali(date_from_gregorian),
@@ -1173,33 +2638,31 @@ def get_brand_data():
         
         print("📂 Loading brand data...")
         
-        # بارگذاری داده‌ها
-        products_df = load_products_from_excel()
-        if products_df is None:
+        # بارگذاری ایندکس کاتالوگ
+        catalog_index = get_product_catalog_index()
+        if catalog_index is None:
             print("❌ Products file not found")
             return jsonify({'error': 'فایل محصولات یافت نشد'}), 500
         
-        print(f"✅ Products loaded: {len(products_df)} products")
-        print(f"🔑 Product columns: {list(products_df.columns)}")
+        print(f"✅ Products loaded: {len(catalog_index['products'])} products")
         
-        # بارگذاری ترتیب برندها از شیت brand
-        brand_order = load_brand_order_from_excel()
+        # ترتیب برندها از شیت brand
+        brand_order = catalog_index['brand_order']
         
         if brand_order:
-            print(f"📋 Brand order loaded from Excel: {brand_order}")
             # استفاده از ترتیب موجود در شیت brand
             ordered_brands = brand_order
         else:
             print("⚠️ No brand order found, using alphabetical order")
             # اگر شیت brand وجود ندارد، ترتیب الفبایی
-            ordered_brands = sorted(products_df['Brand'].unique())
+            ordered_brands = catalog_index['brands']
         
         print(f"🏷️ Final brand order: {ordered_brands}")
         
         # ایجاد دیکشنری کالاها برای هر برند
         brand_products = {}
         for brand in ordered_brands:
-            brand_items = products_df[products_df['Brand'] == brand]
+            brand_items = get_brand_products(catalog_index, brand)
             products_list = []
             
             for _, product in brand_items.iterrows():
@@ -1262,191 +2725,55 @@ def get_customers_by_product():
         
         # بارگذاری داده‌های اصلی
         print("📂 Loading data files...")
-        customers_df = load_customers_from_excel()
-        products_df = load_products_from_excel()
+        scope_index = get_customer_scope_index()
+        catalog_index = get_product_catalog_index()
         
         # بررسی وجود فایل‌های ضروری
-        if customers_df is None:
+        if scope_index is None:
             print("❌ Customers file not found")
             return jsonify({'error': 'فایل مشتریان یافت نشد'}), 500
             
-        if products_df is None:
+        if catalog_index is None:
             print("❌ Products file not found")
             return jsonify({'error': 'فایل محصولات یافت نشد'}), 500
         
         # بررسی وجود کالا
-        product_info = products_df[products_df['ProductCode'] == product_code]
-        if product_info.empty:
+        product_info = lookup_product(catalog_index, product_code)
+        if product_info is None:
             print(f"❌ Product not found: {product_code}")
             return jsonify({'error': f'کالا با کد {product_code} یافت نشد'}), 404
         
-        product_details = product_info.iloc[0].to_dict()
+        product_details = product_info.to_dict()
         print(f"✅ Product found: {product_details['ProductName']}")
         
         # فیلتر مشتریان بر اساس بازاریاب
         bazaryab_code = session['user_info']['Codev']
         if session['user_info']['Typev'] != 'admin':
-            my_customers = customers_df[customers_df['BazaryabCode'] == bazaryab_code]
+            my_customers = scope_customers(scope_index, bazaryab_code)
             print(f"👤 Filtering by bazaryab: {bazaryab_code}, found {len(my_customers)} customers")
         else:
-            my_customers = customers_df
+            my_customers = scope_customers(scope_index)
             print(f"👑 Admin access: showing all {len(my_customers)} customers")
         
-        # بارگذاری فروش (اختیاری - اگر نباشه مشکلی نیست)
-        sales_df = load_sales_from_excel()
-        purchased_customer_codes = []
-        customer_purchase_data = {}
-        
-        if sales_df is not None and not sales_df.empty:
-            print("📊 Processing sales data...")
-            print(f"📋 Sales columns: {list(sales_df.columns)}")
-            
-            # بررسی وجود ستون‌های مورد نیاز
-            required_columns = ['CustomerCode', 'ProductCode', 'InvoiceDate']
-            missing_columns = [col for col in required_columns if col not in sales_df.columns]
-            
-            if missing_columns:
-                print(f"⚠️ Missing columns in sales file: {missing_columns}")
-                print("📝 Available columns:", list(sales_df.columns))
-                # ادامه می‌دیم بدون داده‌های فروش
-            else:
-                # تبدیل تاریخ اگر نیاز باشد
-                date_from_gregorian = None
-                date_to_gregorian = None
-                
-                if date_from and date_to:
-                    if date_type == 'jalali':
-                        date_from_gregorian = jalali_to_gregorian(date_from)
-                        date_to_gregorian = jalali_to_gregorian(date_to)
-                        print(f"📅 Date conversion: {date_from} -> {date_from_gregorian}, {date_to} -> {date_to_gregorian}")
-                    else:
-                        date_from_gregorian = date_from
-                        date_to_gregorian = date_to
-                
-                # تبدیل تاریخ‌های فروش
-                def convert_sale_date_to_gregorian(date_value):
-                    if pd.isna(date_value):
-                        return None
-                    date_str = str(date_value).strip()
-                    if '/' in date_str and len(date_str.split('/')) == 3:
-                        return jalali_to_gregorian(date_str)
-                    if '-' in date_str and len(date_str) == 10:
-                        return date_str
-                    return date_str
-                
-                sales_df_copy = sales_df.copy()
-                sales_df_copy['InvoiceDateConverted'] = sales_df_copy['InvoiceDate'].apply(convert_sale_date_to_gregorian)
-                
-                # فیلتر فروش‌ها
-                if date_from_gregorian and date_to_gregorian:
-                    product_sales = sales_df_copy[
-                        (sales_df_copy['ProductCode'] == product_code) &
-                        (sales_df_copy['InvoiceDateConverted'] >= date_from_gregorian) &
-                        (sales_df_copy['InvoiceDateConverted'] <= date_to_gregorian)
-                    ]
-                    print(f"📈 Filtered sales records: {len(product_sales)}")
-                else:
-                    product_sales = sales_df_copy[sales_df_copy['ProductCode'] == product_code]
-                    print(f"📈 All sales records for product: {len(product_sales)}")
-                
-                # مشتریانی که این کالا را خریده‌اند
-                purchased_customer_codes = product_sales['CustomerCode'].unique()
-                print(f"👥 Customers who bought this product: {len(purchased_customer_codes)}")
-                
-                # محاسبه داده‌های خرید برای هر مشتری
-                for customer_code in purchased_customer_codes:
-                    customer_purchases = product_sales[product_sales['CustomerCode'] == customer_code]
-                    
-                    # محاسبه مجموع
-                    total_qty = 0
-                    total_amount = 0
-                    purchase_dates = []
-                    
-                    for _, sale in customer_purchases.iterrows():
-                        # مقادیر با مقدار پیش‌فرض
-                        qty = int(sale.get('Quantity', 0)) if not pd.isna(sale.get('Quantity', 0)) else 0
-                        amount = int(sale.get('TotalAmount', 0)) if not pd.isna(sale.get('TotalAmount', 0)) else 0
-                        
-                        total_qty += qty
-                        total_amount += amount
-                        
-                        # تاریخ نمایش
-                        original_date = sale.get('InvoiceDate', '')
-                        if '/' in str(original_date):
-                            display_date = str(original_date)
-                        else:
-                            display_date = gregorian_to_jalali(str(original_date)) if original_date else ''
-                        
-                        purchase_dates.append({
-                            'date': display_date,
-                            'quantity': qty,
-                            'amount': amount
-                        })
-                    
-                    customer_purchase_data[customer_code] = {
-                        'TotalQuantity': total_qty,
-                        'TotalAmount': total_amount,
-                        'PurchaseDates': purchase_dates
-                    }
-        else:
+        # خریداران کالا از ایندکس فروش (اختیاری - اگر فایل فروش نباشد مشکلی نیست)
+        from_ordinal, to_ordinal = resolve_date_window(date_from, date_to, date_type)
+        buyers = get_product_buyers([product_code], from_ordinal, to_ordinal)
+        if buyers is None:
             print("⚠️ No sales data found - showing customers without purchase history")
-        
+            buyers = {product_code: {}}
+        print(f"👥 Customers who bought this product: {len(buyers[product_code])}")
+
         # تفکیک مشتریان
-        purchased_customers = []
-        not_purchased_customers = []
-        
-        # بارگذاری اطلاعات کاربران برای نام‌های بازاریاب
-        users_df = load_users_from_excel()
-        
-        for _, customer in my_customers.iterrows():
-            customer_code = customer['CustomerCode']
-            
-            # نام بازاریاب
-            bazaryab_name = "نامشخص"
-            if users_df is not None:
-                bazaryab = users_df[users_df['Codev'] == customer['BazaryabCode']]
-                if not bazaryab.empty:
-                    bazaryab_name = bazaryab.iloc[0]['Namev']
-            
-            # 🔧 FIX: تبدیل مقادیر NaN به boolean
-            location_set = customer.get('LocationSet', False)
-            if pd.isna(location_set):
-                location_set = False
-            elif isinstance(location_set, str):
-                location_set = location_set.lower() in ['true', '1', 'yes', 'بله']
-            else:
-                location_set = bool(location_set)
-            
-            customer_data = {
-                'CustomerCode': str(customer['CustomerCode']),  # تبدیل به string
-                'CustomerName': str(customer['CustomerName']),
-                'BazaryabCode': str(customer['BazaryabCode']),
-                'BazaryabName': bazaryab_name,
-                'LocationSet': location_set  # ✅ حالا boolean است، نه NaN
-            }
-            
-            # اگر این مشتری کالا رو خریده
-            if customer_code in purchased_customer_codes and customer_code in customer_purchase_data:
-                customer_data.update(customer_purchase_data[customer_code])
-                purchased_customers.append(customer_data)
-            else:
-                not_purchased_customers.append(customer_data)
-        
+        customer_records = get_scope_customer_records(my_customers, load_users_from_excel(), include_bazaryab_code=True)
+        purchased_customers, not_purchased_customers = split_product_customers(customer_records, buyers[product_code])
+
         print(f"✅ Final result: {len(purchased_customers)} purchased, {len(not_purchased_customers)} not purchased")
-        
+
         # 🔧 FIX: اطمینان از عدم وجود NaN در product_details
-        clean_product_details = {}
-        for key, value in product_details.items():
-            if pd.isna(value):
-                if key in ['Price', 'Stock']:
-                    clean_product_details[key] = 0
-                else:
-                    clean_product_details[key] = ""
-            else:
-                clean_product_details[key] = value
-        
+        clean_details = clean_product_details(product_details)
+
         response_data = {
-            'product': clean_product_details,
+            'product': clean_details,
             'purchased_customers': purchased_customers,
             'not_purchased_customers': not_purchased_customers,
             'date_from': date_from,
@@ -1472,6 +2799,9 @@ def get_customers_by_product():
 def load_orders_from_excel():
     """بارگذاری سفارشات از فایل Excel"""
     try:
+        if is_sqlite_storage():
+            return load_storage_table('orders')
+        
         if not os.path.exists('orders.xlsx'):
             # ایجاد فایل خالی اگر وجود نداشته باشد
             empty_df = pd.DataFrame(columns=[
@@ -1482,9 +2812,15 @@ def load_orders_from_excel():
             empty_df.to_excel('orders.xlsx', sheet_name='orders', index=False)
             return empty_df
             
-        df = pd.read_excel('orders.xlsx', sheet_name='orders')
-        print("✅ Orders file loaded successfully")
-        return df
+        def read_orders():
+            df = pd.read_excel('orders.xlsx', sheet_name='orders')
+            print("✅ Orders file loaded successfully")
+            return df
+        
+        if is_journal_storage():
+            return load_with_journal('orders', lambda: load_cached_dataset('orders.xlsx', 'orders', read_orders))
+        
+        return load_cached_dataset('orders.xlsx', 'orders', read_orders)
     except Exception as e:
         print("❌ Error loading orders file:", e)
         return None
@@ -1492,6 +2828,9 @@ def load_orders_from_excel():
 def save_orders_to_excel(df):
     """ذخیره سفارشات در فایل Excel"""
     try:
+        if is_sqlite_storage():
+            return save_storage_table('orders', df)
+        
         df.to_excel('orders.xlsx', sheet_name='orders', index=False)
         print("✅ Orders file saved successfully")
         return True
@@ -1499,14 +2838,15 @@ def save_orders_to_excel(df):
         print("❌ Error saving orders file:", e)
         return False
 
-def generate_order_number():
-    """تولید شماره سفارش منحصر به فرد"""
+def generate_order_number(orders_df=None):
+    """تولید شماره سفارش منحصر به فرد (orders_df: سفارش‌های خوانده‌شده زیر قفل درج)"""
     now = datetime.now()
     jalali_now = jdatetime.datetime.fromgregorian(datetime=now)
     date_str = jalali_now.strftime('%Y%m%d')
     
     # بررسی آخرین شماره سفارش امروز
-    orders_df = load_orders_from_excel()
+    if orders_df is None:
+        orders_df = load_orders_from_excel()
     if orders_df is not None and len(orders_df) > 0:
         today_orders = orders_df[orders_df['OrderNumber'].str.contains(f'ORD-{date_str}')]
         if len(today_orders) > 0:
@@ -1518,13 +2858,14 @@ def generate_order_number():
     
     return f"ORD-{date_str}{last_number:03d}"
 
-def generate_document_number():
-    """تولید شماره سند منحصر به فرد"""
+def generate_document_number(orders_df=None):
+    """تولید شماره سند منحصر به فرد (orders_df: سفارش‌های خوانده‌شده زیر قفل درج)"""
     now = datetime.now()
     date_str = now.strftime('%y%m%d')
     
     # بررسی آخرین شماره سند امروز
-    orders_df = load_orders_from_excel()
+    if orders_df is None:
+        orders_df = load_orders_from_excel()
     if orders_df is not None and len(orders_df) > 0:
         today_docs = orders_df[orders_df['DocumentNumber'].str.contains(f'DOC-{date_str}')]
         if len(today_docs) > 0:
@@ -1536,6 +2877,14 @@ def generate_document_number():
     
     return f"DOC-{date_str}{last_number:03d}"
 
+def next_sqlite_order_numbers(conn):
+    """شماره سفارش و سند بعدی در SQLite (داخل تراکنش درج صدا زده شود)"""
+    orders_df = pd.read_sql_query('SELECT "OrderNumber", "DocumentNumber" FROM orders', conn)
+    return {
+        'OrderNumber': generate_order_number(orders_df),
+        'DocumentNumber': generate_document_number(orders_df)
+    }
+
 @app.route('/catalog')
 def catalog():
     """صفحه کاتالوگ کالاها"""
@@ -1544,6 +2893,129 @@ def catalog():
     
     return render_template('catalog.html', user=session['user_info'])
 
+# ==============================================
+# کش payload کاتالوگ (نسخه‌دار، با ETag)
+# ==============================================
+# بخش برند/کالا یک بار به ازای هر نسخه products.xlsx و مانیفست عکس‌ها ساخته
+# و به JSON تبدیل می‌شود؛ لیست مشتریان هر بازاریاب هم به ازای نسخه
+# customers.xlsx. ETag از هش همین دو بخش است، پس درخواست تکراری مرورگر
+# بدون ساخت و ارسال دوباره داده پاسخ 304 می‌گیرد.
+
+
+def dump_json_fragment(data):
+    """JSON فشرده با همان تنظیمات jsonify (برای کنار هم گذاشتن بخش‌های کش‌شده)"""
+    return app.json.dumps(data, separators=(',', ':'))
+
+
+def build_catalog_brands_payload():
+    """بخش برند/کالای کاتالوگ (قیمت رسمی/غیررسمی، موجودی، عکس) همراه JSON و هش آن"""
+    products_df = load_products_with_filter()
+    if products_df is None or products_df.empty:
+        return None
+
+    # تنظیم کالاها بر اساس برند
+    brands = {}
+    image_manifest = get_image_manifest()
+
+    for _, product in products_df.iterrows():
+        brand = str(product.get('Brand', 'نامشخص'))
+
+        if brand not in brands:
+            brands[brand] = []
+
+        # عکس از مانیفست
+        image_file = resolve_product_image(str(product.get('ImageFile', 'null.jpg')), image_manifest)
+
+        # تشخیص اینکه کد رسمی است یا غیررسمی
+        product_code = str(product['ProductCode']).strip().upper()
+
+        # بررسی فرمت P99...
+        if product_code.startswith('P'):
+            code_without_p = product_code[1:]
+            is_official = code_without_p.startswith('99') and len(code_without_p) > 2
+        else:
+            is_official = product_code.startswith('99')
+
+        # محاسبه قیمت‌ها
+        base_price = float(product.get('Price', 0))
+
+        if is_official:
+            # اگر کد رسمی است
+            official_price = base_price
+            unofficial_price = base_price / 1.1  # حذف 10% مالیات
+        else:
+            # اگر کد غیررسمی است
+            unofficial_price = base_price
+            official_price = base_price * 1.1  # اضافه کردن 10% مالیات
+
+        # ✅ تبدیل به عدد صحیح (بدون اعشار)
+        official_price = int(round(official_price))
+        unofficial_price = int(round(unofficial_price))
+
+        # موجودی
+        stock = float(product.get('Stock', 0))
+        stock = int(round(stock))  # موجودی هم عدد صحیح
+
+        brands[brand].append({
+            'ProductCode': product_code,
+            'ProductName': str(product.get('ProductName', '')),
+            'Category': str(product.get('Category', 'عمومی')),
+            'Brand': brand,
+            'Price': official_price,  # ✅ عدد صحیح
+            'UnofficialPrice': unofficial_price,  # ✅ عدد صحیح
+            'Stock': stock,  # ✅ عدد صحیح
+            'OfficialStock': stock if is_official else 0,
+            'UnofficialStock': 0 if is_official else stock,
+            'ImageFile': image_file,
+            'ImageUrl': product_image_url(image_file, image_manifest),
+            'Description': str(product.get('Description', '')),
+            'Offer1': str(product.get('Offer1', '')),
+            'Offer2': str(product.get('Offer2', '')),
+            'Offer3': str(product.get('Offer3', '')),
+            'radif': int(product.get('radif', product.get('Radif', product.get('RADIF', 999999))))
+        })
+
+    brands_json = dump_json_fragment(brands)
+    return {
+        'brands': brands,
+        'json': brands_json,
+        'hash': hashlib.md5(brands_json.encode('utf-8')).hexdigest()
+    }
+
+
+def get_catalog_brands_payload():
+    """بخش برند/کالای کاتالوگ - یک بار به ازای هر نسخه فایل کالاها و مانیفست عکس‌ها"""
+    return load_derived_dataset('catalog_brands', ['products.xlsx'], build_catalog_brands_payload,
+                                extra_version=get_image_manifest()['version'])
+
+
+def build_catalog_customers_payload(bazaryab_code=None):
+    """لیست مشتریان کاتالوگ برای یک بازاریاب (None: همه مشتریان) همراه JSON و هش آن"""
+    scope_index = get_customer_scope_index()
+    if scope_index is None:
+        return None
+
+    customers_df = scope_customers(scope_index, bazaryab_code)
+
+    customers_list = [
+        {'CustomerCode': str(customer_code), 'CustomerName': str(customer_name)}
+        for customer_code, customer_name in zip(customers_df['CustomerCode'], customers_df['CustomerName'])
+    ]
+    customers_json = dump_json_fragment(customers_list)
+    return {
+        'customers': customers_list,
+        'json': customers_json,
+        'hash': hashlib.md5(customers_json.encode('utf-8')).hexdigest()
+    }
+
+
+def get_catalog_customers_payload(bazaryab_code=None):
+    """لیست مشتریان کاتالوگ - یک بار به ازای هر بازاریاب و نسخه فایل مشتریان"""
+    scope = '*' if bazaryab_code is None else str(bazaryab_code)
+    return load_derived_dataset(f'catalog_customers:{scope}', [CUSTOMERS_FILE, USERS_FILE],
+                                lambda: build_catalog_customers_payload(bazaryab_code))
+
+
 @app.route('/get_catalog_data')
 def get_catalog_data():
     """دریافت داده‌های کاتالوگ - با فیلتر محصولات تکراری و قیمت بدون اعشار"""
@@ -1551,100 +3023,33 @@ def get_catalog_data():
         return jsonify({'error': 'Unauthorized'}), 401
     
     try:
-        # بارگذاری محصولات با فیلتر
-        products_df = load_products_with_filter()
-        customers_df = load_customers_from_excel()
-        
-        if products_df is None or products_df.empty:
+        # بخش برند/کالا از کش نسخه‌دار
+        brands_payload = get_catalog_brands_payload()
+        if brands_payload is None:
             return jsonify({'error': 'محصولی یافت نشد'}), 500
         
-        if customers_df is None:
-            return jsonify({'error': 'Failed to load customers'}), 500
-        
-        # فیلتر مشتریان بر اساس بازاریاب
+        # لیست مشتریان بر اساس بازاریاب از کش
         bazaryab_code = session['user_info']['Codev']
         if session['user_info']['Typev'] != 'admin':
-            my_customers = customers_df[customers_df['BazaryabCode'] == bazaryab_code]
+            customers_payload = get_catalog_customers_payload(bazaryab_code)
         else:
-            my_customers = customers_df
-        
-        # تنظیم کالاها بر اساس برند
-        brands = {}
-        
-        for _, product in products_df.iterrows():
-            brand = str(product.get('Brand', 'نامشخص'))
-            
-            if brand not in brands:
-                brands[brand] = []
-            
-            # بررسی وجود عکس
-            image_file = str(product.get('ImageFile', 'null.jpg'))
-            image_path = f"static/images/{image_file}"
-            if not os.path.exists(image_path):
-                image_file = "null.jpg"
-            
-            # تشخیص اینکه کد رسمی است یا غیررسمی
-            product_code = str(product['ProductCode']).strip().upper()
-            
-            # بررسی فرمت P99...
-            if product_code.startswith('P'):
-                code_without_p = product_code[1:]
-                is_official = code_without_p.startswith('99') and len(code_without_p) > 2
-            else:
-                is_official = product_code.startswith('99')
-            
-            # محاسبه قیمت‌ها
-            base_price = float(product.get('Price', 0))
-            
-            if is_official:
-                # اگر کد رسمی است
-                official_price = base_price
-                unofficial_price = base_price / 1.1  # حذف 10% مالیات
-            else:
-                # اگر کد غیررسمی است
-                unofficial_price = base_price
-                official_price = base_price * 1.1  # اضافه کردن 10% مالیات
-            
-            # ✅ تبدیل به عدد صحیح (بدون اعشار)
-            official_price = int(round(official_price))
-            unofficial_price = int(round(unofficial_price))
-            
-            # موجودی
-            stock = float(product.get('Stock', 0))
-            stock = int(round(stock))  # موجودی هم عدد صحیح
-            
-            brands[brand].append({
-                'ProductCode': product_code,
-                'ProductName': str(product.get('ProductName', '')),
-                'Category': str(product.get('Category', 'عمومی')),
-                'Brand': brand,
-                'Price': official_price,  # ✅ عدد صحیح
-                'UnofficialPrice': unofficial_price,  # ✅ عدد صحیح
-                'Stock': stock,  # ✅ عدد صحیح
-                'OfficialStock': stock if is_official else 0,
-                'UnofficialStock': 0 if is_official else stock,
-                'ImageFile': image_file,
-                'Description': str(product.get('Description', '')),
-                'Offer1': str(product.get('Offer1', '')),
-                'Offer2': str(product.get('Offer2', '')),
-                'Offer3': str(product.get('Offer3', '')),
-                'radif': int(product.get('radif', product.get('Radif', product.get('RADIF', 999999))))
-            })
+            customers_payload = get_catalog_customers_payload()
         
-        # لیست مشتریان
-        customers_list = []
-        for _, customer in my_customers.iterrows():
-            customers_list.append({
-                'CustomerCode': str(customer['CustomerCode']),
-                'CustomerName': str(customer['CustomerName'])
-            })
+        if customers_payload is None:
+            return jsonify({'error': 'Failed to load customers'}), 500
         
-        print(f"✅ کاتالوگ آماده شد: {len(brands)} برند، {len(customers_list)} مشتری")
+        # ETag قوی از هش دو بخش - اگر مرورگر همین نسخه را دارد 304
+        etag = f"{brands_payload['hash'][:16]}-{customers_payload['hash'][:16]}"
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            print(f"✅ کاتالوگ آماده شد: {len(brands_payload['brands'])} برند، {len(customers_payload['customers'])} مشتری")
+            body = '{"brands":' + brands_payload['json'] + ',"customers":' + customers_payload['json'] + '}\n'
+            response = app.response_class(body, mimetype='application/json')
         
-        return jsonify({
-            'brands': brands,
-            'customers': customers_list
-        })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
     except Exception as e:
         print(f"❌ خطا در get_catalog_data: {e}")
@@ -1664,71 +3069,41 @@ def merge_official_unofficial_products(products_df):
     - فقط کالای رسمی نمایش داده می‌شود
     """
     try:
-        # لیست نهایی کالاها
-        merged_products_list = []
-        
-        # کالاهایی که پردازش شده‌اند
-        processed_codes = set()
-        
-        for _, product in products_df.iterrows():
-            product_code = str(product['ProductCode']).strip()
-            
-            # اگر این کالا قبلاً پردازش شده، رد شو
-            if product_code in processed_codes:
-                continue
-            
-            # اگر کد با "99" شروع میشه، غیررسمیه - رد شو چون فقط رسمی رو نمایش میدیم
-            if product_code.startswith('99'):
-                processed_codes.add(product_code)
-                continue
-            
-            # این یک کالای رسمی است
-            official_code = product_code
-            unofficial_code = f"99{product_code}"
-            
-            # پیدا کردن کالای غیررسمی مرتبط
-            unofficial_product = products_df[
-                products_df['ProductCode'].astype(str).str.strip() == unofficial_code
-            ]
-            
-            # محاسبه موجودی
-            official_stock = float(product.get('Stock', 0))
-            unofficial_stock = 0
-            
-            if not unofficial_product.empty:
-                unofficial_stock = float(unofficial_product.iloc[0].get('Stock', 0))
-                processed_codes.add(unofficial_code)  # علامت‌گذاری که پردازش شد
-            
-            total_stock = official_stock + unofficial_stock
-            
-            # محاسبه قیمت
-            official_price = float(product.get('Price', 0))
-            unofficial_price = official_price * 1.1  # قیمت رسمی + 10%
-            
-            # اضافه کردن به لیست
-            merged_product = {
-                'ProductCode': official_code,
-                'ProductName': product['ProductName'],
-                'Category': product['Category'],
-                'Brand': product['Brand'],
-                'Price': official_price,
-                'UnofficialPrice': unofficial_price,
-                'TotalStock': total_stock,
-                'OfficialStock': official_stock,
-                'UnofficialStock': unofficial_stock,
-                'ImageFile': product['ImageFile'],
-                'Description': product['Description'],
-                'Offer1': product.get('Offer1', ''),
-                'Offer2': product.get('Offer2', ''),
-                'Offer3': product.get('Offer3', ''),
-                'radif': product.get('radif', product.get('Radif', product.get('RADIF', 999999)))
-            }
-            
-            merged_products_list.append(merged_product)
-            processed_codes.add(official_code)
-        
-        # تبدیل به DataFrame
-        merged_df = pd.DataFrame(merged_products_list)
+        codes = products_df['ProductCode'].astype(str).str.strip()
+        
+        # فقط اولین ردیف هر کد رسمی نمایش داده می‌شود (کد "99..." غیررسمی است)
+        is_unofficial = codes.str.startswith('99')
+        official_mask = ~is_unofficial & ~codes.duplicated()
+        official = products_df[official_mask]
+        official_codes = codes[official_mask]
+        
+        # موجودی نسخه غیررسمی هر کالا (اولین ردیف "99" + کد) با یک نگاشت
+        unofficial_stocks = pd.Series(products_df['Stock'].to_numpy(), index=codes.to_numpy())[is_unofficial.to_numpy()]
+        unofficial_stocks = unofficial_stocks[~unofficial_stocks.index.duplicated()]
+        
+        official_stock = official['Stock'].astype(float)
+        unofficial_stock = ('99' + official_codes).map(unofficial_stocks).astype(float).fillna(0)
+        official_price = official['Price'].astype(float)
+        
+        radif_column = next((column for column in ['radif', 'Radif', 'RADIF'] if column in official.columns), None)
+        
+        merged_df = pd.DataFrame({
+            'ProductCode': official_codes,
+            'ProductName': official['ProductName'],
+            'Category': official['Category'],
+            'Brand': official['Brand'],
+            'Price': official_price,
+            'UnofficialPrice': official_price * 1.1,  # قیمت رسمی + 10%
+            'TotalStock': official_stock + unofficial_stock,
+            'OfficialStock': official_stock,
+            'UnofficialStock': unofficial_stock,
+            'ImageFile': official['ImageFile'],
+            'Description': official['Description'],
+            'Offer1': official['Offer1'] if 'Offer1' in official.columns else '',
+            'Offer2': official['Offer2'] if 'Offer2' in official.columns else '',
+            'Offer3': official['Offer3'] if 'Offer3' in official.columns else '',
+            'radif': official[radif_column] if radif_column else 999999
+        }).reset_index(drop=True)
         
         print(f"✅ Merged {len(merged_df)} products (from {len(products_df)} original)")
         return merged_df
@@ -1752,13 +3127,13 @@ def get_customer_purchase_history():
         return jsonify({'error': 'Customer code required'}), 400
     
     try:
-        # بارگذاری فروش
-        sales_df = load_sales_from_excel()
+        customer_code = str(customer_code).strip()
+        customer_sales = sales_by_key('customer', customer_code)
         
-        if sales_df is None or sales_df.empty:
+        if customer_sales is None or customer_sales.empty:
             return jsonify({'purchased_products': [], 'total_sales': 0})
         
-        print(f"📊 Total sales records: {len(sales_df)}")
+        print(f"👤 Customer {customer_code}: {len(customer_sales)} sales")
         
         # سال جاری
         today = datetime.now()
@@ -1767,39 +3142,21 @@ def get_customer_purchase_history():
         
         print(f"📅 Current year: {current_year}")
         
-        # فیلتر مشتری
-        sales_df['CustomerCode'] = sales_df['CustomerCode'].astype(str).str.strip()
-        customer_code = str(customer_code).strip()
-        customer_sales = sales_df[sales_df['CustomerCode'] == customer_code]
-        
-        print(f"👤 Customer {customer_code}: {len(customer_sales)} sales")
-        
-        if customer_sales.empty:
-            return jsonify({'purchased_products': [], 'total_sales': 0})
-        
-        # فیلتر سال جاری - تاریخ به فرمت "1403/05/15"
-        current_year_sales = []
-        for _, row in customer_sales.iterrows():
-            try:
-                date_str = str(row['InvoiceDate'])
-                if '/' in date_str:
-                    year = int(date_str.split('/')[0])
-                    if year == current_year:
-                        current_year_sales.append(row)
-            except:
-                pass
+        # بازه روزهای سال جاری از جدول ماه‌های شمسی
+        first_month = (current_year - JALALI_TABLE_START_YEAR) * 12
+        year_start = int(_jalali_month_starts[first_month])
+        year_end = int(_jalali_month_starts[first_month + 11] + _jalali_month_lengths[first_month + 11] - 1)
         
+        current_year_sales = sales_by_key('customer', customer_code, year_start, year_end)
         print(f"📅 Year {current_year}: {len(current_year_sales)} sales")
         
-        # استخراج کدهای محصول
+        # کالاهای خریداری شده در سال جاری از بیت‌مپ خرید
+        bitmap = purchase_bitmap_between(year_start, year_end)
         purchased_products = []
-        for sale in current_year_sales:
-            code = str(sale['ProductCode']).strip()
-            
+        for code in bitmap_products_bought(bitmap, customer_code):
             # تبدیل P99 به P
             if code.startswith('P99'):
                 code = 'P' + code[3:]
-                print(f"  🔄 {sale['ProductCode']} -> {code}")
             
             if code not in purchased_products:
                 purchased_products.append(code)
@@ -1863,8 +3220,8 @@ def get_sales_report():
                 return jsonify({'error': 'فایل فروش یافت نشد'})
             
             # بارگذاری فایل Customers برای نام مشتریان
-            customers_df = load_customers_from_excel()
-            if customers_df is None:
+            scope_index = get_customer_scope_index()
+            if scope_index is None:
                 return jsonify({'error': 'فایل مشتریان یافت نشد'})
             
         except Exception as e:
@@ -1874,14 +3231,14 @@ def get_sales_report():
         bazaryab_code = session['user_info']['Codev']
         
         # فیلتر مشتریان این بازاریاب
-        my_customers = customers_df[customers_df['BazaryabCode'] == bazaryab_code]
-        my_customer_codes = my_customers['CustomerCode'].tolist()
+        my_customers = scope_customers(scope_index, bazaryab_code)
+        my_customer_codes = scope_customer_codes(scope_index, bazaryab_code)
         
-        # فیلتر فروش‌های مربوط به مشتریان این بازاریاب
-        my_sales = sales_df[sales_df['CustomerCode'].isin(my_customer_codes)]
+        # فیلتر کردن داده‌ها بر اساس تاریخ شمسی (برش ماه از فروش کش‌شده)
+        month_sales = filter_by_jalali(year, [month])
         
-        # فیلتر کردن داده‌ها بر اساس تاریخ شمسی
-        filtered_sales = filter_sales_by_jalali_date(my_sales, year, month)
+        # فیلتر فروش‌های مربوط به مشتریان این بازاریاب
+        filtered_sales = month_sales[month_sales['CustomerCode'].isin(my_customer_codes)]
         
         if filtered_sales.empty:
             return jsonify({
@@ -1906,62 +3263,7 @@ def get_sales_report():
 
 def filter_sales_by_jalali_date(sales_df, year, month):
     """فیلتر کردن فروش بر اساس سال و ماه شمسی"""
-    try:
-        if sales_df.empty:
-            return pd.DataFrame()
-        
-        # فرض: ستون تاریخ InvoiceDate نام داره
-        if 'InvoiceDate' not in sales_df.columns:
-            return pd.DataFrame()
-        
-        filtered_rows = []
-        
-        for index, row in sales_df.iterrows():
-            try:
-                invoice_date = row['InvoiceDate']
-                
-                if pd.isna(invoice_date):
-                    continue
-                
-                # تبدیل تاریخ به شمسی
-                if isinstance(invoice_date, str):
-                    # اگر تاریخ رشته‌ای است
-                    if '/' in invoice_date:
-                        # فرمت شمسی: 1403/01/15
-                        date_parts = invoice_date.split('/')
-                        if len(date_parts) == 3:
-                            invoice_year = int(date_parts[0])
-                            invoice_month = int(date_parts[1])
-                            
-                            if invoice_year == year and invoice_month == month:
-                                filtered_rows.append(row)
-                    elif '-' in invoice_date:
-                        # فرمت میلادی: 2024-03-21
-                        gregorian_date = datetime.strptime(invoice_date, '%Y-%m-%d').date()
-                        jalali_date = jdatetime.date.fromgregorian(date=gregorian_date)
-                        
-                        if jalali_date.year == year and jalali_date.month == month:
-                            filtered_rows.append(row)
-                
-                elif hasattr(invoice_date, 'year'):
-                    # اگر datetime object است
-                    jalali_date = jdatetime.date.fromgregorian(
-                        year=invoice_date.year,
-                        month=invoice_date.month,
-                        day=invoice_date.day
-                    )
-                    
-                    if jalali_date.year == year and jalali_date.month == month:
-                        filtered_rows.append(row)
-                        
-            except (ValueError, AttributeError):
-                continue
-        
-        return pd.DataFrame(filtered_rows) if filtered_rows else pd.DataFrame()
-        
-    except Exception as e:
-        print(f"Error in filter_sales_by_jalali_date: {e}")
-        return pd.DataFrame()
+    return filter_sales_by_jalali_date_range(sales_df, year, month, year, month)
 
 def calculate_customer_sales_summary(sales_df, customers_df):
     """محاسبه خلاصه فروش مشتریان"""
@@ -2004,6 +3306,219 @@ def calculate_customer_sales_summary(sales_df, customers_df):
         print(f"Error in calculate_customer_sales_summary: {e}")
         return {'customers': [], 'total_sales': 0}
 
+# ==============================================
+# کش نتایج گزارش‌ها (بر اساس پارامترها و نسخه داده)
+# ==============================================
+# کلید: (endpoint، پارامترهای نرمال‌شده، محدوده کاربر، نسخه همه فایل‌های ورودی)
+# بدنه JSON آماده نگهداری می‌شود؛ با تغییر هر فایل ورودی کلید عوض می‌شود
+# و نتیجه قدیمی دیگر استفاده نمی‌شود (تا با LRU بیرون برود).
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+REPORT_CACHE_TTL_SECONDS = int(os.environ.get('REPORT_CACHE_TTL_SECONDS', '0'))  # صفر: بدون انقضا
+
+_report_cache = OrderedDict()
+_report_cache_lock = threading.Lock()
+_report_cache_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'shared': 0, 'evictions': 0, 'expired': 0, 'bytes': 0}
+
+# محاسبه‌های در جریان: یک قفل به ازای هر کلید در worker و یک فایل قفل بین workerها.
+# بدنه ساخته‌شده در report_flights/<sha1>.json می‌ماند تا workerهای منتظر و هر worker دیگری
+# با همان کلید تا REPORT_FLIGHT_MAX_AGE_SECONDS (و حداکثر ttl گزارش) آن را از دیسک بخوانند؛
+# یعنی این پوشه کش مشترک روی دیسک با عمر ۶۰۰ ثانیه است. فایل‌های .lock هرگز پاک نمی‌شوند
+# چون حذف فایل قفلی که در دست worker دیگری است دو قفل جدا روی یک کلید می‌سازد.
+REPORT_FLIGHT_FOLDER = 'report_flights'
+REPORT_FLIGHT_MAX_AGE_SECONDS = 600
+_report_flight_locks = {}
+
+
+def get_table_version(table_name):
+    """نسخه یک جدول پرنوشتن با توجه به محل ذخیره (Excel، ژورنال یا SQLite)"""
+    if is_sqlite_storage():
+        return get_dataset_versions(SQLITE_DB_FILE, SQLITE_DB_FILE + '-wal')
+    versions = get_dataset_versions(SQLITE_TABLES[table_name]['file'])
+    if is_journal_storage():
+        versions += get_dataset_versions(get_journal_path(table_name))
+    return versions
+
+
+def normalize_report_params(params):
+    """پارامترهای گزارش به رشته یکتا (کلیدها مرتب، فاصله‌های اضافه رشته‌ها حذف)"""
+    def normalize(value):
+        if isinstance(value, str):
+            return value.strip()
+        if isinstance(value, dict):
+            return {str(key): normalize(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalize(item) for item in value]
+        return value
+
+    return json.dumps(normalize(params), sort_keys=True, ensure_ascii=False, default=str)
+
+
+def evict_report_cache(max_bytes):
+    """بیرون کردن قدیمی‌ترین نتایج تا حجم کش از max_bytes کمتر شود (زیر قفل صدا زده شود)"""
+    while _report_cache and _report_cache_stats['bytes'] > max_bytes:
+        _, entry = _report_cache.popitem(last=False)
+        _report_cache_stats['bytes'] -= len(entry['body'])
+        _report_cache_stats['evictions'] += 1
+
+
+def lookup_report_cache(key, ttl):
+    """نتیجه کش‌شده یک کلید یا None (نتیجه منقضی حذف می‌شود)"""
+    with _report_cache_lock:
+        entry = _report_cache.get(key)
+        if entry is not None and ttl and time.time() - entry['stored_at'] > ttl:
+            del _report_cache[key]
+            _report_cache_stats['bytes'] -= len(entry['body'])
+            _report_cache_stats['expired'] += 1
+            entry = None
+        if entry is not None:
+            _report_cache.move_to_end(key)
+        return entry
+
+
+def store_report_cache(key, entry):
+    """ذخیره نتیجه در کش (نتیجه بزرگ‌تر از کل ظرفیت نگه داشته نمی‌شود)"""
+    if len(entry['body']) > REPORT_CACHE_MAX_BYTES:
+        return
+    with _report_cache_lock:
+        previous = _report_cache.pop(key, None)
+        if previous is not None:
+            _report_cache_stats['bytes'] -= len(previous['body'])
+        _report_cache[key] = entry
+        _report_cache_stats['bytes'] += len(entry['body'])
+        evict_report_cache(REPORT_CACHE_MAX_BYTES)
+
+
+def prune_report_flights():
+    """حذف بدنه‌ها و فایل‌های موقت قدیمی بین workerها (فایل‌های قفل نگه داشته می‌شوند)"""
+    try:
+        cutoff = time.time() - REPORT_FLIGHT_MAX_AGE_SECONDS
+        for name in os.listdir(REPORT_FLIGHT_FOLDER):
+            if name.endswith('.lock'):
+                continue
+            path = os.path.join(REPORT_FLIGHT_FOLDER, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+    except OSError as e:
+        print(f"⚠️ Error pruning report flights: {e}")
+
+
+def build_shared_report(key, ttl, builder):
+    """
+    ساخت گزارش با هماهنگی بین workerها از طریق فایل قفل محلی
+
+    اولین worker گزارش را می‌سازد و بدنه را در فایل تحویل می‌نویسد؛
+    workerهای دیگر که پشت همان قفل منتظر بوده‌اند فقط آن فایل را می‌خوانند.
+    فایل تحویل پس از پایان محاسبه هم تا REPORT_FLIGHT_MAX_AGE_SECONDS (و ttl)
+    برای همان کلید استفاده می‌شود و سپس prune_report_flights آن را پاک می‌کند.
+
+    Returns:
+        نتیجه کش ({'body'، 'stored_at'}) یا پاسخ خطای builder
+    """
+    flight_path = os.path.join(REPORT_FLIGHT_FOLDER, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+    body_path = flight_path + '.json'
+
+    with file_lock(flight_path + '.lock'):
+        try:
+            stored_at = os.path.getmtime(body_path)
+            age = time.time() - stored_at
+            if age < REPORT_FLIGHT_MAX_AGE_SECONDS and not (ttl and age > ttl):
+                with open(body_path, 'rb') as f:
+                    body = f.read()
+                with _report_cache_lock:
+                    _report_cache_stats['shared'] += 1
+                return {'body': body, 'stored_at': stored_at}
+        except OSError:
+            pass
+
+        payload = builder()
+        if not isinstance(payload, dict):
+            return payload
+
+        # همان بدنه‌ای که jsonify می‌سازد
+        body = (dump_json_fragment(payload) + '\n').encode('utf-8')
+        entry = {'body': body, 'stored_at': time.time()}
+
+        # ذخیره اتمیک تا workerهای دیگر فایل نیمه‌کاره نبینند
+        try:
+            temp_path = f"{body_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(body)
+            os.replace(temp_path, body_path)
+        except OSError as e:
+            print(f"⚠️ Error sharing report result: {e}")
+
+    prune_report_flights()
+    return entry
+
+
+def cached_report_response(endpoint, params, scope, versions, builder, ttl=None):
+    """
+    پاسخ JSON یک گزارش از کش یا با ساخت دوباره
+
+    درخواست‌های همزمان یکسان در یک worker منتظر همان یک محاسبه می‌مانند
+    و بین workerها با build_shared_report هماهنگ می‌شوند.
+
+    Args:
+        endpoint: نام گزارش
+        params: پارامترهای درخواست (dict)
+        scope: محدوده کاربر (مثلاً ('admin',) یا ('user', کد بازاریاب))
+        versions: نسخه همه فایل‌هایی که گزارش می‌خواند (get_dataset_versions / get_table_version)
+        builder: تابع سازنده؛ dict برمی‌گرداند یا پاسخ خطا (که کش نمی‌شود)
+        ttl: عمر نتیجه به ثانیه (None: REPORT_CACHE_TTL_SECONDS، صفر: بدون انقضا)
+    """
+    ttl = REPORT_CACHE_TTL_SECONDS if ttl is None else ttl
+    key = (endpoint, normalize_report_params(params), scope, versions)
+
+    entry = lookup_report_cache(key, ttl)
+    with _report_cache_lock:
+        _report_cache_stats['hits' if entry is not None else 'misses'] += 1
+
+    if entry is None:
+        with _report_cache_lock:
+            flight_lock = _report_flight_locks.setdefault(key, threading.Lock())
+
+        try:
+            # فقط یک thread گزارش را می‌سازد، بقیه منتظر نتیجه می‌مانند
+            with flight_lock:
+                entry = lookup_report_cache(key, ttl)
+                if entry is not None:
+                    with _report_cache_lock:
+                        _report_cache_stats['coalesced'] += 1
+                else:
+                    entry = build_shared_report(key, ttl, builder)
+                    if not isinstance(entry, dict):
+                        return entry
+                    store_report_cache(key, entry)
+        finally:
+            with _report_cache_lock:
+                _report_flight_locks.pop(key, None)
+
+    return app.response_class(entry['body'], mimetype='application/json')
+
+
+def get_report_cache_stats():
+    """آمار کش گزارش‌ها (برخورد، عدم برخورد، حذف و حجم)"""
+    with _report_cache_lock:
+        stats = dict(_report_cache_stats)
+        stats['entries'] = len(_report_cache)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups * 100, 1) if lookups else 0
+    stats['max_bytes'] = REPORT_CACHE_MAX_BYTES
+    stats['ttl_seconds'] = REPORT_CACHE_TTL_SECONDS
+    return stats
+
+
+@app.route('/api/report_cache_stats')
+def api_report_cache_stats():
+    """آمار کش نتایج گزارش‌ها - فقط برای ادمین"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'لطفاً وارد شوید'}), 401
+
+    if session['user_info']['Typev'] != 'admin':
+        return jsonify({'error': 'دسترسی غیرمجاز'}), 403
+
+    return jsonify(get_report_cache_stats())
+
 # این کدها رو به فایل app.py اضافه کنید
 
 @app.route('/sales_performance_report')
@@ -2019,6 +3534,77 @@ def sales_performance_report():
     
     return render_template('sales_performance_report.html', user=session['user_info'])
 
+def normalize_visit_dates(visit_dates):
+    """
+    تاریخ ویزیت‌ها به رشته میلادی قابل مقایسه - تبدیل فقط روی مقادیر یکتا
+
+    رشته‌های ۱۰ کاراکتری همان‌طور می‌مانند و بقیه با jalali_to_gregorian تبدیل می‌شوند.
+    """
+    mapping = {}
+    for visit_date in visit_dates.dropna().unique():
+        if not visit_date:
+            mapping[visit_date] = ''
+        elif isinstance(visit_date, str) and len(visit_date) == 10:
+            mapping[visit_date] = visit_date
+        else:
+            mapping[visit_date] = jalali_to_gregorian(str(visit_date)) or ''
+    return visit_dates.map(mapping).fillna('')
+
+
+def build_performance_report(salespeople, customers_df, visits_df, ranged_sales, date_from_gregorian, date_to_gregorian):
+    """
+    موتور گزارش عملکرد: مشتریان، مراجعات، فروش و نرخ تبدیل هر بازاریاب
+
+    فروش و ویزیت یک بار به بازاریاب وصل می‌شوند و آمار همه بازاریابان با groupby
+    محاسبه می‌شود. نرخ تبدیل = تعداد ردیف‌های فروش / تعداد مراجعات × ۱۰۰.
+
+    Returns:
+        لیست آمار بازاریابان (مرتب شده بر اساس فروش، بالا به پایین)
+    """
+    customer_counts = customers_df.groupby('BazaryabCode', sort=False).size()
+
+    visit_counts = pd.Series(dtype='int64')
+    if visits_df is not None and not visits_df.empty:
+        visit_dates = normalize_visit_dates(visits_df['VisitDate']) if 'VisitDate' in visits_df.columns \
+            else pd.Series('', index=visits_df.index)
+        in_range = (visit_dates != '') & (visit_dates >= date_from_gregorian) & (visit_dates <= date_to_gregorian)
+        visit_counts = visits_df.loc[in_range, 'BazaryabCode'].value_counts(sort=False)
+
+    sales_counts = pd.Series(dtype='int64')
+    sales_amounts = pd.Series(dtype='float64')
+    if ranged_sales is not None:
+        # هر فروش به همه بازاریابانی که این مشتری را دارند وصل می‌شود
+        customer_reps = customers_df[['CustomerCode', 'BazaryabCode']].drop_duplicates()
+        rep_sales = ranged_sales[['CustomerCode', 'TotalAmount']].merge(customer_reps, on='CustomerCode', how='inner')
+        rep_groups = rep_sales.groupby('BazaryabCode', sort=False)['TotalAmount']
+        sales_counts = rep_groups.size()
+        sales_amounts = rep_groups.sum()
+
+    performance_data = []
+    for salesperson_code, salesperson_name in zip(salespeople['Codev'], salespeople['Namev']):
+        total_customers = int(customer_counts.get(salesperson_code, 0))
+        total_visits = int(visit_counts.get(salesperson_code, 0))
+        total_sales = float(sales_amounts.get(salesperson_code, 0))
+
+        conversion_rate = 0
+        if total_visits > 0:
+            # فرض: هر فروش یعنی یک مراجعه موفق
+            conversion_rate = (int(sales_counts.get(salesperson_code, 0)) / total_visits) * 100
+
+        performance_data.append({
+            'salesperson_code': salesperson_code,
+            'salesperson_name': salesperson_name,
+            'total_customers': total_customers,
+            'total_visits': total_visits,
+            'total_sales': int(total_sales),
+            'conversion_rate': round(conversion_rate, 1)
+        })
+
+    # مرتب‌سازی بر اساس مجموع فروش (بالا به پایین)
+    performance_data.sort(key=lambda x: x['total_sales'], reverse=True)
+    return performance_data
+
+
 @app.route('/get_performance_report')
 def get_performance_report():
     """دریافت داده‌های گزارش عملکرد بازاریابان"""
@@ -2046,123 +3632,49 @@ def get_performance_report():
         if not date_from_gregorian or not date_to_gregorian:
             return jsonify({'error': 'فرمت تاریخ نامعتبر است'}), 400
         
-        # بارگذاری داده‌ها
-        users_df = load_users_from_excel()
-        customers_df = load_customers_from_excel() 
-        visits_df = load_visits_from_excel()
-        sales_df = load_sales_from_excel()
-        
-        if users_df is None or customers_df is None:
-            return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
-        
-        # فیلتر بازاریابان (فقط کاربران با نوع user)
-        salespeople = users_df[users_df['Typev'] == 'user']
-        
-        if salespeople.empty:
-            return jsonify({'error': 'هیچ بازاریابی یافت نشد'}), 404
-        
-        performance_data = []
+        day_window = date_window_to_ordinals(date_from_gregorian, date_to_gregorian)
+        if day_window is None:
+            return jsonify({'error': 'فرمت تاریخ نامعتبر است'}), 400
         
-        for _, salesperson in salespeople.iterrows():
-            salesperson_code = salesperson['Codev']
-            salesperson_name = salesperson['Namev']
+        def build_report():
+            # بارگذاری داده‌ها
+            users_df = load_users_from_excel()
+            customers_df = load_customers_from_excel() 
+            visits_df = load_visits_from_excel()
+            sales_df = load_sales_from_excel()
             
-            print(f"📊 Processing salesperson: {salesperson_name} ({salesperson_code})")
+            if users_df is None or customers_df is None:
+                return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
             
-            # تعداد مشتریان این بازاریاب
-            sp_customers = customers_df[customers_df['BazaryabCode'] == salesperson_code]
-            total_customers = len(sp_customers)
+            # فیلتر بازاریابان (فقط کاربران با نوع user)
+            salespeople = users_df[users_df['Typev'] == 'user']
             
-            # مراجعات در بازه زمانی
-            total_visits = 0
-            if visits_df is not None and not visits_df.empty:
-                sp_visits = visits_df[visits_df['BazaryabCode'] == salesperson_code]
-                
-                # فیلتر بر اساس تاریخ
-                filtered_visits = []
-                for _, visit in sp_visits.iterrows():
-                    visit_date = visit.get('VisitDate', '')
-                    if visit_date:
-                        # تبدیل تاریخ ویزیت به میلادی برای مقایسه
-                        if isinstance(visit_date, str) and len(visit_date) == 10:
-                            # اگر میلادی است: 2024-03-21
-                            visit_gregorian = visit_date
-                        else:
-                            # اگر شمسی است، تبدیل کن
-                            visit_gregorian = jalali_to_gregorian(str(visit_date))
-                        
-                        if (visit_gregorian and 
-                            visit_gregorian >= date_from_gregorian and 
-                            visit_gregorian <= date_to_gregorian):
-                            filtered_visits.append(visit)
-                
-                total_visits = len(filtered_visits)
+            if salespeople.empty:
+                return jsonify({'error': 'هیچ بازاریابی یافت نشد'}), 404
             
-            # فروش در بازه زمانی
-            total_sales = 0
+            # فروش‌های بازه زمانی (جستجوی دودویی روی ایندکس تاریخ)
+            ranged_sales = None
             if sales_df is not None and not sales_df.empty:
-                # فیلتر فروش‌های مشتریان این بازاریاب
-                customer_codes = sp_customers['CustomerCode'].tolist()
-                sp_sales = sales_df[sales_df['CustomerCode'].isin(customer_codes)]
-                
-                # فیلتر بر اساس تاریخ
-                filtered_sales = []
-                for _, sale in sp_sales.iterrows():
-                    sale_date = sale.get('InvoiceDate', '')
-                    if sale_date:
-                        # تبدیل تاریخ فروش
-                        if '/' in str(sale_date):
-                            # شمسی: 1404/01/15
-                            sale_gregorian = jalali_to_gregorian(str(sale_date))
-                        elif '-' in str(sale_date) and len(str(sale_date)) == 10:
-                            # میلادی: 2024-03-21
-                            sale_gregorian = str(sale_date)
-                        else:
-                            sale_gregorian = None
-                        
-                        if (sale_gregorian and 
-                            sale_gregorian >= date_from_gregorian and 
-                            sale_gregorian <= date_to_gregorian):
-                            filtered_sales.append(sale)
-                
-                # محاسبه مجموع فروش
-                for sale in filtered_sales:
-                    amount = sale.get('TotalAmount', 0)
-                    if not pd.isna(amount):
-                        total_sales += float(amount)
-            
-            # محاسبه نرخ تبدیل
-            conversion_rate = 0
-            if total_visits > 0:
-                # فرض: هر فروش یعنی یک مراجعه موفق
-                successful_visits = len(filtered_sales) if 'filtered_sales' in locals() else 0
-                conversion_rate = (successful_visits / total_visits) * 100
-            
-            performance_data.append({
-                'salesperson_code': salesperson_code,
-                'salesperson_name': salesperson_name,
-                'total_customers': int(total_customers),
-                'total_visits': int(total_visits),
-                'total_sales': int(total_sales),
-                'conversion_rate': round(conversion_rate, 1)
-            })
+                ranged_sales = sales_between(*day_window)
             
-            print(f"   👥 Customers: {total_customers}")
-            print(f"   🚪 Visits: {total_visits}")
-            print(f"   💰 Sales: {total_sales:,}")
-            print(f"   📊 Conversion: {conversion_rate:.1f}%")
-        
-        # مرتب‌سازی بر اساس مجموع فروش (بالا به پایین)
-        performance_data.sort(key=lambda x: x['total_sales'], reverse=True)
-        
-        print(f"✅ Performance report generated for {len(performance_data)} salespeople")
+            # مشتریان، مراجعات، فروش و نرخ تبدیل همه بازاریابان با یک groupby
+            performance_data = build_performance_report(
+                salespeople, customers_df, visits_df, ranged_sales, date_from_gregorian, date_to_gregorian
+            )
+            
+            print(f"✅ Performance report generated for {len(performance_data)} salespeople")
+            
+            return {
+                'salespeople': performance_data,
+                'date_from': date_from,
+                'date_to': date_to,
+                'period_info': f"{date_from} تا {date_to}"
+            }
         
-        return jsonify({
-            'salespeople': performance_data,
-            'date_from': date_from,
-            'date_to': date_to,
-            'period_info': f"{date_from} تا {date_to}"
-        })
+        # نتیجه از کش گزارش‌ها (تا وقتی هیچ فایل ورودی عوض نشده)
+        versions = get_dataset_versions(USERS_FILE, CUSTOMERS_FILE, 'sales.xlsx') + get_table_version('visits')
+        return cached_report_response('performance_report', {'date_from': date_from, 'date_to': date_to},
+                                      ('admin',), versions, build_report)
         
     except Exception as e:
         print(f"❌ Error in get_performance_report: {str(e)}")
@@ -2186,6 +3698,122 @@ def admin_brand_sales_report():
     
     return render_template('admin_brand_sales_report.html', user=session['user_info'])
 
+def build_admin_brand_sales(cube_rows, catalog_index, salespeople):
+    """
+    گزارش فروش برندی همه بازاریابان با یک ادغام و groupby
+
+    Args:
+        cube_rows: سلول‌های مکعب فروش بازه زمانی (sales_cube_between یا aggregate_sales_cube)
+        catalog_index: ایندکس کالاها (index_products) با ProductCode، Brand، ProductName، Category، Radif
+        salespeople: بازاریابان (Codev، Namev)
+
+    Returns:
+        (برندها، خلاصه بازاریابان، جمع کل) با همان ساختار JSON گزارش
+    """
+    # فقط فروش‌هایی که مشتری آن‌ها بازاریاب دارد
+    rep_codes = cube_rows['SalespersonCode']
+    rep_rows = cube_rows[rep_codes.notna() & (rep_codes.astype(str) != '')]
+    rep_rows = rep_rows[['SalespersonCode', 'ProductCode', 'Amount', 'Quantity']].rename(
+        columns={'SalespersonCode': 'BazaryabCode'})
+
+    # ترتیب بازاریابان و کالاها همان ترتیب فایل‌ها (برای مرتب‌سازی پایدار)
+    salesperson_order = salespeople.drop_duplicates('Codev').assign(SalespersonOrder=lambda x: np.arange(len(x)))
+    salesperson_order = salesperson_order.set_index('Codev')[['Namev', 'SalespersonOrder']]
+    products_df = catalog_index['products']
+    product_details = catalog_index['by_code']
+
+    # ادغام با کالاها و تجمیع برند × بازاریاب × کالا
+    product_rows = products_df[['ProductCode', 'Brand']].assign(ProductOrder=np.arange(len(products_df)))
+    brand_sales = rep_rows[rep_rows['BazaryabCode'].isin(salesperson_order.index)].merge(
+        product_rows, on='ProductCode', how='inner')
+    brand_sales = brand_sales.groupby(['Brand', 'BazaryabCode', 'ProductCode'], sort=False).agg(
+        amount=('Amount', 'sum'),
+        quantity=('Quantity', 'sum'),
+        ProductOrder=('ProductOrder', 'min')
+    ).reset_index()
+
+    # جمع هر بازاریاب از هر برند (فقط با فروش مثبت)
+    brand_salesperson = brand_sales.groupby(['Brand', 'BazaryabCode'], sort=False).agg(
+        total_amount=('amount', 'sum'),
+        total_quantity=('quantity', 'sum')
+    ).reset_index()
+    brand_salesperson = brand_salesperson[brand_salesperson['total_amount'] > 0]
+    brand_salesperson = brand_salesperson.join(salesperson_order, on='BazaryabCode')
+    brand_salesperson['amount_int'] = brand_salesperson['total_amount'].astype('int64')
+    brand_salesperson = brand_salesperson.sort_values(['amount_int', 'SalespersonOrder'], ascending=[False, True])
+
+    brand_sales['amount_int'] = brand_sales['amount'].astype('int64')
+    brand_sales['product_name'] = brand_sales['ProductCode'].map(product_details['ProductName'])
+    brand_sales['category'] = (brand_sales['ProductCode'].map(product_details['Category'])
+                               if 'Category' in product_details.columns else '')
+    brand_sales = brand_sales.sort_values(['amount_int', 'ProductOrder'], ascending=[False, True])
+    products_by_pair = {
+        pair: group for pair, group in brand_sales.groupby(['Brand', 'BazaryabCode'], sort=False)
+    }
+
+    # برندها بر اساس کمترین Radif کالاهایشان
+    radif = products_df['Radif'] if 'Radif' in products_df.columns else pd.Series(999999, index=products_df.index)
+    brands_radif = pd.DataFrame({'Brand': products_df['Brand'], 'Radif': radif.astype(int)})
+    brands_radif = brands_radif.groupby('Brand', sort=False)['Radif'].min().sort_values(kind='stable')
+
+    filtered_brands = []
+    total_sales = 0
+    brand_groups = {brand: group for brand, group in brand_salesperson.groupby('Brand', sort=False)}
+
+    for brand, brand_radif in brands_radif.items():
+        group = brand_groups.get(brand)
+        if group is None:
+            continue
+
+        salespeople_sales = []
+        for sp_code, sp_name, sp_amount, sp_quantity in zip(
+                group['BazaryabCode'], group['Namev'], group['total_amount'], group['total_quantity']):
+            sp_products = products_by_pair[(brand, sp_code)]
+            salespeople_sales.append({
+                'salesperson_code': sp_code,
+                'salesperson_name': sp_name,
+                'total_amount': int(sp_amount),
+                'total_quantity': int(sp_quantity),
+                'products': [
+                    {
+                        'product_code': product_code,
+                        'product_name': product_name,
+                        'category': category,
+                        'amount': int(amount),
+                        'quantity': int(quantity)
+                    }
+                    for product_code, product_name, category, amount, quantity in zip(
+                        sp_products['ProductCode'], sp_products['product_name'], sp_products['category'],
+                        sp_products['amount'], sp_products['quantity'])
+                ]
+            })
+
+        brand_total = int(group['total_amount'].sum())
+        filtered_brands.append({
+            'brand_name': brand,
+            'radif': int(brand_radif),
+            'total_amount': brand_total,
+            'total_quantity': int(group['total_quantity'].sum()),
+            'salespeople_sales': salespeople_sales,
+            'products': []
+        })
+        total_sales += brand_total
+
+    # آمار کلی بازاریابان (شامل کالاهای خارج از فایل کالا)
+    salesperson_totals = rep_rows.groupby('BazaryabCode', sort=False)['Amount'].sum()
+    salespeople_summary = [
+        {
+            'salesperson_code': sp_code,
+            'salesperson_name': sp_name,
+            'total_sales': int(salesperson_totals.get(sp_code, 0))
+        }
+        for sp_code, sp_name in zip(salespeople['Codev'], salespeople['Namev'])
+    ]
+    salespeople_summary.sort(key=lambda x: x['total_sales'], reverse=True)
+
+    return filtered_brands, salespeople_summary, total_sales
+
+
 @app.route('/get_admin_brand_sales_data', methods=['POST'])
 def get_admin_brand_sales_data():
     """دریافت داده‌های فروش برندی همه بازاریابان"""
@@ -2220,196 +3848,63 @@ def get_admin_brand_sales_data():
             date_from_gregorian = date_from
             date_to_gregorian = date_to
         
-        # بارگذاری داده‌ها
-        products_df = load_products_from_excel()
-        customers_df = load_customers_from_excel()
-        sales_df = load_sales_from_excel()
-        users_df = load_users_from_excel()
-        
-        if products_df is None or customers_df is None or sales_df is None or users_df is None:
-            return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
-        
-        # فیلتر بازاریابان (فقط کاربران با نوع user)
-        salespeople = users_df[users_df['Typev'] == 'user']
-        
-        if salespeople.empty:
-            return jsonify({'error': 'هیچ بازاریابی یافت نشد'}), 404
-        
-        print(f"👥 Found {len(salespeople)} salespeople")
-        
-        # فیلتر فروش‌ها بر اساس تاریخ
-        def convert_sale_date_to_gregorian(date_value):
-            if pd.isna(date_value):
-                return None
-            date_str = str(date_value).strip()
-            if '/' in date_str and len(date_str.split('/')) == 3:
-                return jalali_to_gregorian(date_str)
-            elif '-' in date_str and len(date_str) == 10:
-                return date_str
-            return None
-        
-        # تبدیل تاریخ‌های فروش
-        sales_df_copy = sales_df.copy()
-        sales_df_copy['InvoiceDateConverted'] = sales_df_copy['InvoiceDate'].apply(convert_sale_date_to_gregorian)
-        
-        # فیلتر بر اساس بازه زمانی
-        filtered_sales = sales_df_copy[
-            (sales_df_copy['InvoiceDateConverted'] >= date_from_gregorian) &
-            (sales_df_copy['InvoiceDateConverted'] <= date_to_gregorian)
-        ]
-        
-        if filtered_sales.empty:
-            return jsonify({
-                'brands': [],
-                'salespeople': [],
-                'total_sales': 0,
-                'date_from': date_from,
-                'date_to': date_to,
-                'date_type': date_type
-            })
-        
-        print(f"📊 Filtered sales: {len(filtered_sales)} records")
-        
-        # ایجاد دیکشنری برای نگاشت مشتری به بازاریاب
-        customer_to_salesperson = {}
-        for _, customer in customers_df.iterrows():
-            customer_to_salesperson[customer['CustomerCode']] = customer['BazaryabCode']
-        
-        # محاسبه فروش هر بازاریاب از هر کالا
-        salesperson_product_sales = {}
+        day_window = date_window_to_ordinals(date_from_gregorian, date_to_gregorian)
+        if day_window is None:
+            return jsonify({'error': 'فرمت تاریخ نامعتبر است'}), 400
         
-        for _, sale in filtered_sales.iterrows():
-            customer_code = sale['CustomerCode']
-            product_code = sale['ProductCode']
-            amount = float(sale.get('TotalAmount', 0)) if not pd.isna(sale.get('TotalAmount', 0)) else 0
-            quantity = int(sale.get('Quantity', 0)) if not pd.isna(sale.get('Quantity', 0)) else 0
+        def build_report():
+            # بارگذاری داده‌ها
+            catalog_index = get_product_catalog_index()
+            customers_df = load_customers_from_excel()
+            sales_df = load_sales_from_excel()
+            users_df = load_users_from_excel()
             
-            # پیدا کردن بازاریاب این مشتری
-            salesperson_code = customer_to_salesperson.get(customer_code)
+            if catalog_index is None or customers_df is None or sales_df is None or users_df is None:
+                return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
             
-            if salesperson_code:
-                if salesperson_code not in salesperson_product_sales:
-                    salesperson_product_sales[salesperson_code] = {}
-                
-                if product_code not in salesperson_product_sales[salesperson_code]:
-                    salesperson_product_sales[salesperson_code][product_code] = {'amount': 0, 'quantity': 0}
-                
-                salesperson_product_sales[salesperson_code][product_code]['amount'] += amount
-                salesperson_product_sales[salesperson_code][product_code]['quantity'] += quantity
-        
-        # تفکیک بر اساس برند
-        brand_data = {}
-        
-        # دریافت همه برندها و مرتب‌سازی بر اساس Radif
-        brands_radif = {}
-        for _, product in products_df.iterrows():
-            brand = product['Brand']
-            radif = int(product.get('Radif', 999999))
-            if brand not in brands_radif or radif < brands_radif[brand]:
-                brands_radif[brand] = radif
-        
-        # مرتب‌سازی برندها بر اساس Radif
-        sorted_brands = sorted(brands_radif.keys(), key=lambda x: brands_radif[x])
-        
-        for brand in sorted_brands:
-            brand_data[brand] = {
-                'brand_name': brand,
-                'radif': brands_radif[brand],
-                'total_amount': 0,
-                'total_quantity': 0,
-                'salespeople_sales': [],
-                'products': []
-            }
+            # فیلتر بازاریابان (فقط کاربران با نوع user)
+            salespeople = users_df[users_df['Typev'] == 'user']
             
-            # پیدا کردن کالاهای این برند
-            brand_products = products_df[products_df['Brand'] == brand]['ProductCode'].tolist()
+            if salespeople.empty:
+                return jsonify({'error': 'هیچ بازاریابی یافت نشد'}), 404
             
-            # محاسبه فروش هر بازاریاب از این برند
-            for _, salesperson in salespeople.iterrows():
-                sp_code = salesperson['Codev']
-                sp_name = salesperson['Namev']
-                
-                sp_brand_amount = 0
-                sp_brand_quantity = 0
-                sp_products = []
-                
-                if sp_code in salesperson_product_sales:
-                    for product_code in brand_products:
-                        if product_code in salesperson_product_sales[sp_code]:
-                            product_sales = salesperson_product_sales[sp_code][product_code]
-                            sp_brand_amount += product_sales['amount']
-                            sp_brand_quantity += product_sales['quantity']
-                            
-                            # اطلاعات کالا
-                            product_info = products_df[products_df['ProductCode'] == product_code]
-                            if not product_info.empty:
-                                product_detail = product_info.iloc[0]
-                                sp_products.append({
-                                    'product_code': product_code,
-                                    'product_name': product_detail['ProductName'],
-                                    'category': product_detail.get('Category', ''),
-                                    'amount': int(product_sales['amount']),
-                                    'quantity': int(product_sales['quantity'])
-                                })
-                
-                # اگر این بازاریاب از این برند فروش داشته
-                if sp_brand_amount > 0:
-                    brand_data[brand]['salespeople_sales'].append({
-                        'salesperson_code': sp_code,
-                        'salesperson_name': sp_name,
-                        'total_amount': int(sp_brand_amount),
-                        'total_quantity': int(sp_brand_quantity),
-                        'products': sorted(sp_products, key=lambda x: x['amount'], reverse=True)
-                    })
-                    
-                    brand_data[brand]['total_amount'] += sp_brand_amount
-                    brand_data[brand]['total_quantity'] += sp_brand_quantity
+            print(f"👥 Found {len(salespeople)} salespeople")
             
-            # مرتب‌سازی بازاریابان بر اساس فروش (بالا به پایین)
-            brand_data[brand]['salespeople_sales'].sort(key=lambda x: x['total_amount'], reverse=True)
-        
-        # حذف برندهایی که فروش نداشتن
-        filtered_brands = []
-        total_sales = 0
-        
-        for brand in sorted_brands:
-            if brand_data[brand]['total_amount'] > 0:
-                brand_data[brand]['total_amount'] = int(brand_data[brand]['total_amount'])
-                brand_data[brand]['total_quantity'] = int(brand_data[brand]['total_quantity'])
-                filtered_brands.append(brand_data[brand])
-                total_sales += brand_data[brand]['total_amount']
-        
-        # آمار کلی بازاریابان
-        salespeople_summary = []
-        for _, salesperson in salespeople.iterrows():
-            sp_code = salesperson['Codev']
-            sp_name = salesperson['Namev']
-            
-            sp_total = 0
-            if sp_code in salesperson_product_sales:
-                for product_sales in salesperson_product_sales[sp_code].values():
-                    sp_total += product_sales['amount']
-            
-            salespeople_summary.append({
-                'salesperson_code': sp_code,
-                'salesperson_name': sp_name,
-                'total_sales': int(sp_total)
-            })
-        
-        # مرتب‌سازی بازاریابان بر اساس فروش
-        salespeople_summary.sort(key=lambda x: x['total_sales'], reverse=True)
-        
-        print(f"✅ Admin brand report: {len(filtered_brands)} brands, total: {total_sales:,}")
-        
-        return jsonify({
-            'brands': filtered_brands,
-            'salespeople': salespeople_summary,
-            'total_sales': int(total_sales),
-            'date_from': date_from,
-            'date_to': date_to,
-            'date_type': date_type,
-            'period_info': f"{date_from} تا {date_to}"
-        })
+            # سلول‌های مکعب فروش بازه زمانی
+            cube_rows = sales_cube_between(*day_window)
+            
+            if cube_rows.empty:
+                return {
+                    'brands': [],
+                    'salespeople': [],
+                    'total_sales': 0,
+                    'date_from': date_from,
+                    'date_to': date_to,
+                    'date_type': date_type
+                }
+            
+            print(f"📊 Filtered sales: {int(cube_rows['InvoiceCount'].sum())} records")
+            
+            # برند × بازاریاب × کالا با یک ادغام و groupby
+            filtered_brands, salespeople_summary, total_sales = build_admin_brand_sales(cube_rows, catalog_index, salespeople)
+            
+            print(f"✅ Admin brand report: {len(filtered_brands)} brands, total: {total_sales:,}")
+            
+            return {
+                'brands': filtered_brands,
+                'salespeople': salespeople_summary,
+                'total_sales': int(total_sales),
+                'date_from': date_from,
+                'date_to': date_to,
+                'date_type': date_type,
+                'period_info': f"{date_from} تا {date_to}"
+            }
+            
+        # نتیجه از کش گزارش‌ها (تا وقتی هیچ فایل ورودی عوض نشده)
+        versions = get_dataset_versions('products.xlsx', CUSTOMERS_FILE, 'sales.xlsx', USERS_FILE)
+        return cached_report_response('admin_brand_sales',
+                                      {'date_from': date_from, 'date_to': date_to, 'date_type': date_type},
+                                      ('admin',), versions, build_report)
         
     except Exception as e:
         print(f"❌ Error in get_admin_brand_sales_data: {str(e)}")
@@ -2468,58 +3963,33 @@ def get_user_brand_sales_data():
             date_from_gregorian = date_from
             date_to_gregorian = date_to
         
+        day_window = date_window_to_ordinals(date_from_gregorian, date_to_gregorian)
+        if day_window is None:
+            return jsonify({'error': 'فرمت تاریخ نامعتبر است'}), 400
+        
         # بارگذاری داده‌ها
-        products_df = load_products_from_excel()
-        customers_df = load_customers_from_excel()
+        catalog_index = get_product_catalog_index()
+        scope_index = get_customer_scope_index()
         sales_df = load_sales_from_excel()
         
-        if products_df is None or customers_df is None or sales_df is None:
+        if catalog_index is None or scope_index is None or sales_df is None:
             return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
         
         # فیلتر مشتریان این بازاریاب
         bazaryab_code = session['user_info']['Codev']
-        my_customers = customers_df[customers_df['BazaryabCode'] == bazaryab_code]
-        customer_codes = my_customers['CustomerCode'].tolist()
+        customer_codes = scope_customer_codes(scope_index, bazaryab_code)
         
         if not customer_codes:
             return jsonify({'error': 'هیچ مشتری برای شما تعریف نشده است'}), 404
         
         print(f"👥 Found {len(customer_codes)} customers for bazaryab {bazaryab_code}")
         
-        # فیلتر فروش‌های مشتریان این بازاریاب
-        my_sales = sales_df[sales_df['CustomerCode'].isin(customer_codes)]
-        
-        if my_sales.empty:
-            return jsonify({
-                'brands': [],
-                'total_sales': 0,
-                'date_from': date_from,
-                'date_to': date_to,
-                'date_type': date_type
-            })
-        
-        # فیلتر بر اساس تاریخ
-        def convert_sale_date_to_gregorian(date_value):
-            if pd.isna(date_value):
-                return None
-            date_str = str(date_value).strip()
-            if '/' in date_str and len(date_str.split('/')) == 3:
-                return jalali_to_gregorian(date_str)
-            elif '-' in date_str and len(date_str) == 10:
-                return date_str
-            return None
-        
-        # تبدیل تاریخ‌های فروش
-        my_sales_copy = my_sales.copy()
-        my_sales_copy['InvoiceDateConverted'] = my_sales_copy['InvoiceDate'].apply(convert_sale_date_to_gregorian)
+        # سلول‌های مکعب فروش مشتریان این بازاریاب در بازه زمانی
+        # (بر اساس کد مشتری، چون مشتری مشترک بین دو بازاریاب در مکعب فقط زیر یکی ثبت می‌شود)
+        cube_rows = sales_cube_between(*day_window)
+        my_rows = cube_rows[cube_rows['CustomerCode'].isin(customer_codes)]
         
-        # فیلتر بر اساس بازه زمانی
-        filtered_sales = my_sales_copy[
-            (my_sales_copy['InvoiceDateConverted'] >= date_from_gregorian) &
-            (my_sales_copy['InvoiceDateConverted'] <= date_to_gregorian)
-        ]
-        
-        if filtered_sales.empty:
+        if my_rows.empty:
             return jsonify({
                 'brands': [],
                 'total_sales': 0,
@@ -2528,30 +3998,19 @@ def get_user_brand_sales_data():
                 'date_type': date_type
             })
         
-        print(f"📊 Filtered sales: {len(filtered_sales)} records")
+        print(f"📊 Filtered sales: {int(my_rows['InvoiceCount'].sum())} records")
         
-        # محاسبه فروش هر کالا
-        product_sales = {}
-        for _, sale in filtered_sales.iterrows():
-            product_code = sale['ProductCode']
-            amount = float(sale.get('TotalAmount', 0)) if not pd.isna(sale.get('TotalAmount', 0)) else 0
-            quantity = int(sale.get('Quantity', 0)) if not pd.isna(sale.get('Quantity', 0)) else 0
-            
-            if product_code not in product_sales:
-                product_sales[product_code] = {'amount': 0, 'quantity': 0}
-            
-            product_sales[product_code]['amount'] += amount
-            product_sales[product_code]['quantity'] += quantity
+        # محاسبه فروش هر کالا (به ترتیب اولین ظهور در فایل فروش)
+        product_sales = summarize_sales_cube(my_rows, ['ProductCode']).sort_values('FirstRow')
+        product_details = catalog_index['by_code']
         
         # تفکیک بر اساس برند و محاسبه مجموع هر برند
         brand_sales = {}
         
-        for product_code, sales_data in product_sales.items():
+        for product_code, amount, quantity in zip(product_sales['ProductCode'], product_sales['Amount'], product_sales['Quantity']):
             # پیدا کردن اطلاعات کالا
-            product_info = products_df[products_df['ProductCode'] == product_code]
-            
-            if not product_info.empty:
-                product_detail = product_info.iloc[0]
+            if product_code in product_details.index:
+                product_detail = product_details.loc[product_code]
                 brand = product_detail['Brand']
                 radif = int(product_detail.get('Radif', 999999))  # اگر Radif نداشته باشه، آخر قرار بگیره
                 
@@ -2565,16 +4024,16 @@ def get_user_brand_sales_data():
                     }
                 
                 # اضافه کردن به مجموع برند
-                brand_sales[brand]['total_amount'] += sales_data['amount']
-                brand_sales[brand]['total_quantity'] += sales_data['quantity']
+                brand_sales[brand]['total_amount'] += amount
+                brand_sales[brand]['total_quantity'] += quantity
                 
                 # اضافه کردن جزئیات کالا
                 brand_sales[brand]['products'].append({
                     'product_code': product_code,
                     'product_name': product_detail['ProductName'],
                     'category': product_detail.get('Category', ''),
-                    'amount': int(sales_data['amount']),
-                    'quantity': int(sales_data['quantity'])
+                    'amount': int(amount),
+                    'quantity': int(quantity)
                 })
         
         # مرتب‌سازی برندها بر اساس Radif
@@ -2708,19 +4167,20 @@ def submit_order():
             return jsonify({'error': 'Customer and product required'}), 400
         
         # دریافت اطلاعات کالا
-        products_df = load_products_from_excel()
-        product = products_df[products_df['ProductCode'] == product_code]
+        product_info = lookup_product(get_product_catalog_index(), product_code)
         
-        if product.empty:
+        if product_info is None:
             return jsonify({'error': 'Product not found'}), 404
         
-        product_info = product.iloc[0]
         unit_price = product_info['Price']
         total_amount = unit_price * quantity
         
-        # تولید شماره‌های منحصر به فرد
-        order_number = generate_order_number()
-        document_number = generate_document_number()
+        # تولید شماره‌های منحصر به فرد (در SQLite و ژورنال هنگام درج و زیر همان تراکنش/قفل)
+        if is_sqlite_storage() or is_journal_storage():
+            order_number = document_number = None
+        else:
+            order_number = generate_order_number()
+            document_number = generate_document_number()
         
         # تاریخ و ساعت فعلی
         now = datetime.now()
@@ -2745,15 +4205,30 @@ def submit_order():
         }
         
         # اضافه کردن به فایل
-        orders_df = load_orders_from_excel()
-        if orders_df is None:
-            orders_df = pd.DataFrame(columns=list(new_order.keys()))
-        
-        new_row = pd.DataFrame([new_order])
-        orders_df = pd.concat([orders_df, new_row], ignore_index=True)
+        if is_sqlite_storage():
+            numbers = append_storage_row_with_ids('orders', new_order, next_sqlite_order_numbers)
+            saved = numbers is not None
+            if saved:
+                order_number = numbers['OrderNumber']
+                document_number = numbers['DocumentNumber']
+        elif is_journal_storage():
+            # شماره‌ها از سفارش‌های خوانده‌شده زیر همان قفلی که خط ژورنال را می‌نویسد
+            with journal_lock('orders'):
+                orders_df = load_orders_from_excel()
+                new_order['OrderNumber'] = order_number = generate_order_number(orders_df)
+                new_order['DocumentNumber'] = document_number = generate_document_number(orders_df)
+                saved = append_journal_rows('orders', [new_order])
+        else:
+            orders_df = load_orders_from_excel()
+            if orders_df is None:
+                orders_df = pd.DataFrame(columns=list(new_order.keys()))
+            
+            new_row = pd.DataFrame([new_order])
+            orders_df = pd.concat([orders_df, new_row], ignore_index=True)
+            saved = save_orders_to_excel(orders_df)
         
         # ذخیره فایل
-        if save_orders_to_excel(orders_df):
+        if saved:
             return jsonify({
                 'success': True,
                 'order_number': order_number,
@@ -2830,13 +4305,17 @@ def get_salesperson_brand_detail():
             date_from_gregorian = date_from
             date_to_gregorian = date_to
         
+        day_window = date_window_to_ordinals(date_from_gregorian, date_to_gregorian)
+        if day_window is None:
+            return jsonify({'error': 'فرمت تاریخ نامعتبر است'}), 400
+        
         # بارگذاری داده‌ها
-        products_df = load_products_from_excel()
-        customers_df = load_customers_from_excel()
+        catalog_index = get_product_catalog_index()
+        scope_index = get_customer_scope_index()
         sales_df = load_sales_from_excel()
         users_df = load_users_from_excel()
         
-        if products_df is None or customers_df is None or sales_df is None or users_df is None:
+        if catalog_index is None or scope_index is None or sales_df is None or users_df is None:
             return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
         
         # پیدا کردن نام بازاریاب
@@ -2847,68 +4326,40 @@ def get_salesperson_brand_detail():
         salesperson_name = salesperson_info.iloc[0]['Namev']
         
         # پیدا کردن همه کالاهای این برند
-        brand_products = products_df[products_df['Brand'] == brand_name]
+        brand_products = get_brand_products(catalog_index, brand_name)
         if brand_products.empty:
             return jsonify({'error': 'هیچ کالایی برای این برند یافت نشد'}), 404
         
         print(f"📦 Found {len(brand_products)} products for brand {brand_name}")
         
         # پیدا کردن مشتریان این بازاریاب
-        salesperson_customers = customers_df[customers_df['BazaryabCode'] == salesperson_code]
-        customer_codes = salesperson_customers['CustomerCode'].tolist()
+        customer_codes = scope_customer_codes(scope_index, salesperson_code)
         
         if not customer_codes:
             return jsonify({'error': 'هیچ مشتری برای این بازاریاب تعریف نشده'}), 404
         
         print(f"👥 Found {len(customer_codes)} customers for salesperson {salesperson_code}")
         
-        # فیلتر فروش‌های این بازاریاب
-        salesperson_sales = sales_df[sales_df['CustomerCode'].isin(customer_codes)]
-        
-        # فیلتر بر اساس تاریخ
-        def convert_sale_date_to_gregorian(date_value):
-            if pd.isna(date_value):
-                return None
-            date_str = str(date_value).strip()
-            if '/' in date_str and len(date_str.split('/')) == 3:
-                return jalali_to_gregorian(date_str)
-            elif '-' in date_str and len(date_str) == 10:
-                return date_str
-            return None
-        
-        # تبدیل تاریخ‌های فروش
-        salesperson_sales_copy = salesperson_sales.copy()
-        salesperson_sales_copy['InvoiceDateConverted'] = salesperson_sales_copy['InvoiceDate'].apply(convert_sale_date_to_gregorian)
-        
-        # فیلتر بر اساس بازه زمانی
-        filtered_sales = salesperson_sales_copy[
-            (salesperson_sales_copy['InvoiceDateConverted'] >= date_from_gregorian) &
-            (salesperson_sales_copy['InvoiceDateConverted'] <= date_to_gregorian)
-        ]
+        # سلول‌های مکعب فروش مشتریان این بازاریاب در بازه زمانی
+        # (بر اساس کد مشتری، چون مشتری مشترک بین دو بازاریاب در مکعب فقط زیر یکی ثبت می‌شود)
+        cube_rows = sales_cube_between(*day_window)
+        salesperson_rows = cube_rows[cube_rows['CustomerCode'].isin(customer_codes)]
         
-        print(f"💰 Found {len(filtered_sales)} sales records in date range")
+        print(f"💰 Found {int(salesperson_rows['InvoiceCount'].sum())} sales records in date range")
         
         # فیلتر فروش‌های این برند
         brand_product_codes = brand_products['ProductCode'].tolist()
-        brand_sales = filtered_sales[filtered_sales['ProductCode'].isin(brand_product_codes)]
+        brand_rows = salesperson_rows[salesperson_rows['ProductCode'].isin(brand_product_codes)]
         
-        print(f"🎯 Found {len(brand_sales)} sales for this brand")
+        print(f"🎯 Found {int(brand_rows['InvoiceCount'].sum())} sales for this brand")
         
         # محاسبه فروش هر کالا
-        product_sales = {}
-        total_brand_sales = 0
-        
-        for _, sale in brand_sales.iterrows():
-            product_code = sale['ProductCode']
-            amount = float(sale.get('TotalAmount', 0)) if not pd.isna(sale.get('TotalAmount', 0)) else 0
-            quantity = int(sale.get('Quantity', 0)) if not pd.isna(sale.get('Quantity', 0)) else 0
-            
-            if product_code not in product_sales:
-                product_sales[product_code] = {'amount': 0, 'quantity': 0}
-            
-            product_sales[product_code]['amount'] += amount
-            product_sales[product_code]['quantity'] += quantity
-            total_brand_sales += amount
+        product_totals = summarize_sales_cube(brand_rows, ['ProductCode'])
+        product_sales = {
+            product_code: {'amount': amount, 'quantity': quantity}
+            for product_code, amount, quantity in zip(product_totals['ProductCode'], product_totals['Amount'], product_totals['Quantity'])
+        }
+        total_brand_sales = float(product_totals['Amount'].sum())
         
         # تفکیک کالاهای فروخته شده و نشده
         sold_products = []
@@ -3056,13 +4507,17 @@ def get_product_analysis():
             date_from_gregorian = date_from
             date_to_gregorian = date_to
         
+        day_window = date_window_to_ordinals(date_from_gregorian, date_to_gregorian)
+        if day_window is None:
+            return jsonify({'error': 'فرمت تاریخ نامعتبر است'}), 400
+        
         # بارگذاری داده‌ها
         products_df = load_products_from_excel()
-        customers_df = load_customers_from_excel()
+        scope_index = get_customer_scope_index()
         sales_df = load_sales_from_excel()
         users_df = load_users_from_excel()
         
-        if products_df is None or customers_df is None or sales_df is None or users_df is None:
+        if products_df is None or scope_index is None or sales_df is None or users_df is None:
             return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
         
         # پیدا کردن نام بازاریاب
@@ -3072,32 +4527,13 @@ def get_product_analysis():
         
         salesperson_name = salesperson_info.iloc[0]['Namev']
         
-        # فیلتر فروش‌ها بر اساس تاریخ
-        def convert_sale_date_to_gregorian(date_value):
-            if pd.isna(date_value):
-                return None
-            date_str = str(date_value).strip()
-            if '/' in date_str and len(date_str.split('/')) == 3:
-                return jalali_to_gregorian(date_str)
-            elif '-' in date_str and len(date_str) == 10:
-                return date_str
-            return None
-        
-        # تبدیل تاریخ‌های فروش
-        sales_df_copy = sales_df.copy()
-        sales_df_copy['InvoiceDateConverted'] = sales_df_copy['InvoiceDate'].apply(convert_sale_date_to_gregorian)
-        
-        # فیلتر بر اساس بازه زمانی
-        filtered_sales = sales_df_copy[
-            (sales_df_copy['InvoiceDateConverted'] >= date_from_gregorian) &
-            (sales_df_copy['InvoiceDateConverted'] <= date_to_gregorian)
-        ]
+        # فیلتر بر اساس بازه زمانی (جستجوی دودویی روی ایندکس تاریخ)
+        filtered_sales = sales_between(*day_window)
         
         print(f"📊 Found {len(filtered_sales)} sales in date range")
         
         # پیدا کردن مشتریان این بازاریاب
-        salesperson_customers = customers_df[customers_df['BazaryabCode'] == salesperson_code]
-        customer_codes = salesperson_customers['CustomerCode'].tolist()
+        customer_codes = scope_customer_codes(scope_index, salesperson_code)
         
         # فروش‌های این بازاریاب
         salesperson_sales = filtered_sales[filtered_sales['CustomerCode'].isin(customer_codes)]
@@ -3132,12 +4568,10 @@ def get_product_analysis():
             amount = float(sale.get('TotalAmount', 0)) if not pd.isna(sale.get('TotalAmount', 0)) else 0
             quantity = int(sale.get('Quantity', 0)) if not pd.isna(sale.get('Quantity', 0)) else 0
             
-            # پیدا کردن بازاریاب این مشتری
-            customer_info = customers_df[customers_df['CustomerCode'] == customer_code]
-            if not customer_info.empty:
-                other_salesperson_code = customer_info.iloc[0]['BazaryabCode']
-                other_salesperson_info = users_df[users_df['Codev'] == other_salesperson_code]
-                other_salesperson_name = other_salesperson_info.iloc[0]['Namev'] if not other_salesperson_info.empty else 'نامشخص'
+            # پیدا کردن بازاریاب این مشتری (از محدوده مشتریان)
+            if customer_code in scope_index['salesperson_by_customer']:
+                other_salesperson_code = scope_index['salesperson_by_customer'][customer_code]
+                other_salesperson_name = scope_index['salesperson_names'].get(other_salesperson_code, 'نامشخص')
             else:
                 other_salesperson_name = 'نامشخص'
             
@@ -3297,50 +4731,31 @@ def get_my_product_analysis():
             date_from_gregorian = date_from
             date_to_gregorian = date_to
         
+        day_window = date_window_to_ordinals(date_from_gregorian, date_to_gregorian)
+        if day_window is None:
+            return jsonify({'error': 'فرمت تاریخ نامعتبر است'}), 400
+        
         # بارگذاری داده‌ها
         products_df = load_products_from_excel()
-        customers_df = load_customers_from_excel()
+        scope_index = get_customer_scope_index()
         sales_df = load_sales_from_excel()
         users_df = load_users_from_excel()
         
-        if products_df is None or customers_df is None or sales_df is None or users_df is None:
+        if products_df is None or scope_index is None or sales_df is None or users_df is None:
             return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
         
-        # بارگذاری ترتیب برندها برای مرتب‌سازی
-        brand_order = load_brand_order_from_excel()
-        brand_radif = {}
-        if brand_order:
-            for index, brand in enumerate(brand_order):
-                brand_radif[brand] = index + 1
+        # ترتیب برندها برای مرتب‌سازی (شیت brand از ایندکس کاتالوگ)
+        brand_radif = get_product_catalog_index()['brand_radif']
         
         print(f"📋 Brand order loaded: {len(brand_radif)} brands")
         
-        # فیلتر فروش‌ها بر اساس تاریخ
-        def convert_sale_date_to_gregorian(date_value):
-            if pd.isna(date_value):
-                return None
-            date_str = str(date_value).strip()
-            if '/' in date_str and len(date_str.split('/')) == 3:
-                return jalali_to_gregorian(date_str)
-            elif '-' in date_str and len(date_str) == 10:
-                return date_str
-            return None
-        
-        # تبدیل تاریخ‌های فروش
-        sales_df_copy = sales_df.copy()
-        sales_df_copy['InvoiceDateConverted'] = sales_df_copy['InvoiceDate'].apply(convert_sale_date_to_gregorian)
-        
-        # فیلتر بر اساس بازه زمانی
-        filtered_sales = sales_df_copy[
-            (sales_df_copy['InvoiceDateConverted'] >= date_from_gregorian) &
-            (sales_df_copy['InvoiceDateConverted'] <= date_to_gregorian)
-        ]
+        # فیلتر بر اساس بازه زمانی (جستجوی دودویی روی ایندکس تاریخ)
+        filtered_sales = sales_between(*day_window)
         
         print(f"📊 Found {len(filtered_sales)} sales in date range")
         
         # پیدا کردن مشتریان این بازاریاب
-        salesperson_customers = customers_df[customers_df['BazaryabCode'] == salesperson_code]
-        customer_codes = salesperson_customers['CustomerCode'].tolist()
+        customer_codes = scope_customer_codes(scope_index, salesperson_code)
         
         print(f"👥 Found {len(customer_codes)} customers for this salesperson")
         
@@ -3377,12 +4792,10 @@ def get_my_product_analysis():
             amount = float(sale.get('TotalAmount', 0)) if not pd.isna(sale.get('TotalAmount', 0)) else 0
             quantity = int(sale.get('Quantity', 0)) if not pd.isna(sale.get('Quantity', 0)) else 0
             
-            # پیدا کردن بازاریاب این مشتری
-            customer_info = customers_df[customers_df['CustomerCode'] == customer_code]
-            if not customer_info.empty:
-                other_salesperson_code = customer_info.iloc[0]['BazaryabCode']
-                other_salesperson_info = users_df[users_df['Codev'] == other_salesperson_code]
-                other_salesperson_name = other_salesperson_info.iloc[0]['Namev'] if not other_salesperson_info.empty else 'نامشخص'
+            # پیدا کردن بازاریاب این مشتری (از محدوده مشتریان)
+            if customer_code in scope_index['salesperson_by_customer']:
+                other_salesperson_code = scope_index['salesperson_by_customer'][customer_code]
+                other_salesperson_name = scope_index['salesperson_names'].get(other_salesperson_code, 'نامشخص')
             else:
                 other_salesperson_name = 'نامشخص'
             
@@ -3519,11 +4932,11 @@ def all_reports():
         return redirect(url_for('login'))
     
     # بارگذاری داده‌ها
-    customers_df = load_customers_from_excel()
+    scope_index = get_customer_scope_index()
     visits_df = load_visits_from_excel()
     users_df = load_users_from_excel()
     
-    if customers_df is None or visits_df is None or users_df is None:
+    if scope_index is None or visits_df is None or users_df is None:
         flash('خطا در بارگذاری اطلاعات!', 'error')
         return redirect(url_for('index'))
     
@@ -3532,11 +4945,11 @@ def all_reports():
     if session['user_info']['Typev'] != 'admin':
         # بازاریاب فقط مراجعات خودش رو می‌بینه
         my_visits = visits_df[visits_df['BazaryabCode'] == bazaryab_code]
-        my_customers = customers_df[customers_df['BazaryabCode'] == bazaryab_code]
+        my_customers = scope_customers(scope_index, bazaryab_code)
     else:
         # ادمین همه رو می‌بینه
         my_visits = visits_df
-        my_customers = customers_df
+        my_customers = scope_customers(scope_index)
     
     # ترکیب اطلاعات
     report_data = []
@@ -3581,8 +4994,10 @@ def create_exam_file_if_not_exists():
             df = pd.DataFrame(columns=[
                 'ExamCode', 'ExamName', 'BrandName', 'CreatedDate', 'CreatedTime', 'CreatedBy'
             ])
-            df.to_excel(EXAMS_FILE, sheet_name='list', index=False)
-            print("✅ فایل azmon.xlsx ایجاد شد")
+            with exams_file_lock():
+                if not os.path.exists(EXAMS_FILE):
+                    df.to_excel(EXAMS_FILE, sheet_name='list', index=False)
+                    print("✅ فایل azmon.xlsx ایجاد شد")
             return True
         except Exception as e:
             print(f"❌ خطا در ایجاد فایل آزمون: {e}")
@@ -3601,24 +5016,27 @@ def load_exams_from_excel():
                 'CreatedDate', 'CreatedTime', 'CreatedBy'
             ])
             
-        df = pd.read_excel(EXAMS_FILE, sheet_name='list')
-        print("✅ فایل آزمون با موفقیت بارگذاری شد")
+        def read_exams():
+            df = pd.read_excel(EXAMS_FILE, sheet_name='list')
+            print("✅ فایل آزمون با موفقیت بارگذاری شد")
         
-        # اگر ستون‌های جدید وجود ندارند، اضافه کن
-        required_columns = ['ExamCode', 'ExamName', 'ExamType', 'BrandName', 'Description', 
-                          'CreatedDate', 'CreatedTime', 'CreatedBy']
+            # اگر ستون‌های جدید وجود ندارند، اضافه کن
+            required_columns = ['ExamCode', 'ExamName', 'ExamType', 'BrandName', 'Description', 
+                              'CreatedDate', 'CreatedTime', 'CreatedBy']
         
-        for col in required_columns:
-            if col not in df.columns:
-                df[col] = ''
-                print(f"➕ ستون {col} اضافه شد")
+            for col in required_columns:
+                if col not in df.columns:
+                    df[col] = ''
+                    print(f"➕ ستون {col} اضافه شد")
         
-        # پاک کردن فاصله‌های اضافی
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip()
+            # پاک کردن فاصله‌های اضافی
+            for col in df.columns:
+                if df[col].dtype == 'object':
+                    df[col] = df[col].astype(str).str.strip()
         
-        return df
+            return df
+
+        return load_cached_dataset(EXAMS_FILE, 'list', read_exams)
     except Exception as e:
         print(f"❌ خطا در بارگذاری فایل آزمون: {e}")
         # در صورت خطا، یک DataFrame خالی برگردان
@@ -3627,12 +5045,17 @@ def load_exams_from_excel():
             'CreatedDate', 'CreatedTime', 'CreatedBy'
         ])
 
+def exams_file_lock():
+    """قفل همه نوشتن‌های azmon.xlsx - همان قفلی که ادغام ژورنال نتایج آزمون می‌گیرد"""
+    return journal_lock('exam_results')
+
+
 def save_exams_to_excel(df):
     """ذخیره آزمون‌ها در فایل Excel"""
     try:
-        # استفاده از ExcelWriter برای کنترل بهتر
-        with pd.ExcelWriter(EXAMS_FILE, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='list', index=False)
+        # فقط شیت list بازنویسی می‌شود (شیت نتایج azmon حفظ می‌شود) و زیر قفل مشترک با ادغام ژورنال
+        with exams_file_lock():
+            write_excel_sheet(EXAMS_FILE, 'list', df)
         print("✅ فایل آزمون با موفقیت ذخیره شد")
         return True
     except Exception as e:
@@ -3795,13 +5218,13 @@ def get_brands_for_exam():
         if session['user_info']['Typev'] != 'admin':
             return jsonify({'error': 'دسترسی غیرمجاز'}), 403
         
-        # بارگذاری محصولات
-        products_df = load_products_from_excel()
-        if products_df is None:
+        # بارگذاری ایندکس کاتالوگ
+        catalog_index = get_product_catalog_index()
+        if catalog_index is None:
             return jsonify({'error': 'فایل محصولات یافت نشد'}), 500
         
-        # دریافت لیست برندها (حذف تکراری و مرتب‌سازی)
-        brands = sorted(products_df['Brand'].unique().tolist())
+        # لیست برندها (یکتا و مرتب) از ایندکس
+        brands = list(catalog_index['brands'])
         
         # حذف مقادیر خالی یا NaN
         brands = [brand for brand in brands if str(brand) not in ['', 'nan', 'None']]
@@ -4035,53 +5458,61 @@ def exam_info(exam_code):
 def save_exam_result_to_excel(result_data):
     """ذخیره نتیجه آزمون در فایل azmon.xlsx شیت azmon"""
     try:
-        # بررسی وجود فایل و شیت
-        if os.path.exists(EXAMS_FILE):
-            with pd.ExcelFile(EXAMS_FILE) as xls:
-                if 'azmon' in xls.sheet_names:
-                    # بارگذاری داده‌های موجود
-                    results_df = pd.read_excel(EXAMS_FILE, sheet_name='azmon')
-                else:
-                    # ایجاد DataFrame جدید
-                    results_df = pd.DataFrame(columns=[
-                        'ExamResultCode', 'ExamCode', 'BazaryabCode', 'BazaryabName',
-                        'ExamDate', 'ExamTime', 'TotalQuestions', 'CorrectAnswers', 
-                        'WrongAnswers', 'Score', 'Percentage', 'TimeTaken', 'ExamType',
-                        'BrandName', 'ResultDescription'
-                    ])
-        else:
-            # ایجاد DataFrame جدید
-            results_df = pd.DataFrame(columns=[
-                'ExamResultCode', 'ExamCode', 'BazaryabCode', 'BazaryabName',
-                'ExamDate', 'ExamTime', 'TotalQuestions', 'CorrectAnswers', 
-                'WrongAnswers', 'Score', 'Percentage', 'TimeTaken', 'ExamType',
-                'BrandName', 'ResultDescription'
-            ])
+        if is_journal_storage():
+            if not append_journal_rows('exam_results', [result_data]):
+                return False
+            print(f"✅ Exam result journaled: {result_data['ExamResultCode']}")
+            return True
         
-        # ایجاد رکورد جدید
-        new_result = pd.DataFrame([result_data])
-        results_df = pd.concat([results_df, new_result], ignore_index=True)
+        # کل خواندن و بازنویسی زیر قفل مشترک azmon.xlsx با ادغام ژورنال
+        with exams_file_lock():
+            # بررسی وجود فایل و شیت
+            if os.path.exists(EXAMS_FILE):
+                with pd.ExcelFile(EXAMS_FILE) as xls:
+                    if 'azmon' in xls.sheet_names:
+                        # بارگذاری داده‌های موجود
+                        results_df = pd.read_excel(EXAMS_FILE, sheet_name='azmon')
+                    else:
+                        # ایجاد DataFrame جدید
+                        results_df = pd.DataFrame(columns=[
+                            'ExamResultCode', 'ExamCode', 'BazaryabCode', 'BazaryabName',
+                            'ExamDate', 'ExamTime', 'TotalQuestions', 'CorrectAnswers', 
+                            'WrongAnswers', 'Score', 'Percentage', 'TimeTaken', 'ExamType',
+                            'BrandName', 'ResultDescription'
+                        ])
+            else:
+                # ایجاد DataFrame جدید
+                results_df = pd.DataFrame(columns=[
+                    'ExamResultCode', 'ExamCode', 'BazaryabCode', 'BazaryabName',
+                    'ExamDate', 'ExamTime', 'TotalQuestions', 'CorrectAnswers', 
+                    'WrongAnswers', 'Score', 'Percentage', 'TimeTaken', 'ExamType',
+                    'BrandName', 'ResultDescription'
+                ])
+        
+            # ایجاد رکورد جدید
+            new_result = pd.DataFrame([result_data])
+            results_df = pd.concat([results_df, new_result], ignore_index=True)
         
-        # ذخیره در فایل
-        if os.path.exists(EXAMS_FILE):
-            # بارگذاری سایر شیت‌ها
-            with pd.ExcelFile(EXAMS_FILE) as xls:
-                sheets_dict = {}
-                for sheet_name in xls.sheet_names:
-                    if sheet_name != 'azmon':
-                        sheets_dict[sheet_name] = pd.read_excel(xls, sheet_name=sheet_name)
-            
-            # ذخیره همه شیت‌ها
-            with pd.ExcelWriter(EXAMS_FILE, engine='openpyxl') as writer:
-                for sheet_name, df in sheets_dict.items():
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
-                results_df.to_excel(writer, sheet_name='azmon', index=False)
-        else:
-            # ایجاد فایل جدید
-            with pd.ExcelWriter(EXAMS_FILE, engine='openpyxl') as writer:
-                results_df.to_excel(writer, sheet_name='azmon', index=False)
-                # ایجاد شیت list خالی
-                pd.DataFrame().to_excel(writer, sheet_name='list', index=False)
+            # ذخیره در فایل
+            if os.path.exists(EXAMS_FILE):
+                # بارگذاری سایر شیت‌ها
+                with pd.ExcelFile(EXAMS_FILE) as xls:
+                    sheets_dict = {}
+                    for sheet_name in xls.sheet_names:
+                        if sheet_name != 'azmon':
+                            sheets_dict[sheet_name] = pd.read_excel(xls, sheet_name=sheet_name)
+            
+                # ذخیره همه شیت‌ها
+                with pd.ExcelWriter(EXAMS_FILE, engine='openpyxl') as writer:
+                    for sheet_name, df in sheets_dict.items():
+                        df.to_excel(writer, sheet_name=sheet_name, index=False)
+                    results_df.to_excel(writer, sheet_name='azmon', index=False)
+            else:
+                # ایجاد فایل جدید
+                with pd.ExcelWriter(EXAMS_FILE, engine='openpyxl') as writer:
+                    results_df.to_excel(writer, sheet_name='azmon', index=False)
+                    # ایجاد شیت list خالی
+                    pd.DataFrame().to_excel(writer, sheet_name='list', index=False)
         
         print(f"✅ Exam result saved: {result_data['ExamResultCode']}")
         return True
@@ -4224,12 +5655,12 @@ def get_exam_products(exam_code):
             return jsonify({'error': 'برند آزمون مشخص نیست'}), 400
         
         # بارگذاری محصولات این برند
-        products_df = load_products_from_excel()
-        if products_df is None:
+        catalog_index = get_product_catalog_index()
+        if catalog_index is None:
             return jsonify({'error': 'فایل محصولات یافت نشد'}), 500
         
-        # فیلتر محصولات بر اساس برند
-        brand_products = products_df[products_df['Brand'] == brand_name]
+        # محصولات برند از ایندکس کاتالوگ
+        brand_products = get_brand_products(catalog_index, brand_name)
         
         if brand_products.empty:
             return jsonify({'error': f'هیچ محصولی برای برند {brand_name} یافت نشد'}), 404
@@ -4296,8 +5727,7 @@ def submit_product_exam():
         brand_name = exam_info.get('BrandName', '')
         
         # بارگذاری محصولات برند
-        products_df = load_products_from_excel()
-        brand_products = products_df[products_df['Brand'] == brand_name]
+        brand_products = get_brand_products(get_product_catalog_index(), brand_name)
         
         # محاسبه نتایج
         total_questions = len(brand_products)
@@ -4396,20 +5826,26 @@ def load_exam_results_from_excel():
         if not os.path.exists(EXAMS_FILE):
             return pd.DataFrame()
             
-        # بررسی وجود شیت azmon
-        with pd.ExcelFile(EXAMS_FILE) as xls:
-            if 'azmon' not in xls.sheet_names:
-                return pd.DataFrame()
+        def read_exam_results():
+            # بررسی وجود شیت azmon
+            with pd.ExcelFile(EXAMS_FILE) as xls:
+                if 'azmon' not in xls.sheet_names:
+                    return pd.DataFrame()
         
-        df = pd.read_excel(EXAMS_FILE, sheet_name='azmon')
-        print(f"✅ Exam results loaded: {len(df)} records")
+            df = pd.read_excel(EXAMS_FILE, sheet_name='azmon')
+            print(f"✅ Exam results loaded: {len(df)} records")
         
-        # پاک کردن فاصله‌های اضافی
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip()
+            # پاک کردن فاصله‌های اضافی
+            for col in df.columns:
+                if df[col].dtype == 'object':
+                    df[col] = df[col].astype(str).str.strip()
         
-        return df
+            return df
+
+        if is_journal_storage():
+            return load_with_journal('exam_results', lambda: load_cached_dataset(EXAMS_FILE, 'azmon', read_exam_results))
+        
+        return load_cached_dataset(EXAMS_FILE, 'azmon', read_exam_results)
         
     except Exception as e:
         print(f"❌ Error loading exam results: {e}")
@@ -4958,6 +6394,40 @@ def safe_convert_to_dict(data):
         return data
 
 
+def tag_sales_with_periods(sales_rows, periods):
+    """
+    برچسب دوره‌های مقایسه روی فروش‌ها با کلید YearMonth (سال*100+ماه) - یک merge
+
+    Returns:
+        فروش‌های داخل دوره‌ها با ستون‌های PeriodOrder و MonthOrder، به ترتیب
+        دوره، ماه و ردیف فایل (فروشی که در چند دوره باشد تکرار می‌شود)
+    """
+    period_months = pd.DataFrame(
+        [
+            (period_order, month_order, int(period['year']) * 100 + int(month))
+            for period_order, period in enumerate(periods)
+            for month_order, month in enumerate(period['months'])
+        ],
+        columns=['PeriodOrder', 'MonthOrder', 'YearMonth']
+    )
+
+    if 'YearMonth' not in sales_rows.columns:
+        sales_rows = sales_rows.assign(YearMonth=convert_date_column(sales_rows['InvoiceDate'])['YearMonth'])
+
+    tagged = sales_rows.assign(RowOrder=sales_rows.index).merge(period_months, on='YearMonth', how='inner')
+    return tagged.sort_values(['PeriodOrder', 'MonthOrder', 'RowOrder'], kind='stable').reset_index(drop=True)
+
+
+def summarize_sales_periods(tagged_sales, by):
+    """مبلغ، تعداد، کالاهای متمایز و تعداد سفارش به ازای هر (دوره، by) با یک groupby"""
+    return tagged_sales.groupby(['PeriodOrder', by], sort=False).agg(
+        total_amount=('TotalAmount', 'sum'),
+        total_quantity=('Quantity', 'sum'),
+        unique_products=('ProductCode', 'nunique'),
+        order_count=('ProductCode', 'size')
+    )
+
+
 def get_sales_comparison_data(periods, user_code=None, user_type='admin'):
     """
     محاسبه داده‌های مقایسه‌ای فروش برای چندین دوره
@@ -4970,36 +6440,42 @@ def get_sales_comparison_data(periods, user_code=None, user_type='admin'):
         
         # بارگذاری داده‌ها
         sales_df = load_sales_from_excel()
-        customers_df = load_customers_from_excel()
+        scope_index = get_customer_scope_index()
         products_df = load_products_from_excel()
         
-        if sales_df is None or customers_df is None or products_df is None:
+        if sales_df is None or scope_index is None or products_df is None:
             print("❌ Failed to load required data files")
             return None
         
-        # تمیز کردن داده‌ها از NaN
-        print("🧹 Cleaning data from NaN values...")
-        sales_df = clean_dataframe_for_json(sales_df)
-        customers_df = clean_dataframe_for_json(customers_df)
-        products_df = clean_dataframe_for_json(products_df)
+        print(f"📊 Data loaded: {len(sales_df)} sales, {len(scope_index['customers'])} customers")
         
-        print(f"📊 Data loaded: {len(sales_df)} sales, {len(customers_df)} customers")
-        
-        # فیلتر مشتریان بر اساس نوع کاربر
+        # فیلتر مشتریان بر اساس نوع کاربر (از محدوده مشتریان) و تمیز کردن فقط همان ردیف‌ها از NaN
         if user_type != 'admin' and user_code:
-            my_customers = customers_df[customers_df['BazaryabCode'] == user_code]
-            customer_codes = my_customers['CustomerCode'].tolist()
-            filtered_customers = my_customers
-            print(f"👤 User filter applied: {len(customer_codes)} customers for user {user_code}")
+            filtered_customers = clean_dataframe_for_json(scope_customers(scope_index, user_code))
+            print(f"👤 User filter applied: {len(filtered_customers)} customers for user {user_code}")
         else:
-            customer_codes = customers_df['CustomerCode'].tolist()
-            filtered_customers = customers_df
+            filtered_customers = clean_dataframe_for_json(scope_customers(scope_index))
+            customer_codes = filtered_customers['CustomerCode'].tolist()
             print(f"👑 Admin access: {len(customer_codes)} total customers")
         
-        # فیلتر فروش‌های مربوط به مشتریان
-        relevant_sales = sales_df[sales_df['CustomerCode'].isin(customer_codes)]
+        # فیلتر فروش‌های مربوط به مشتریان (ایندکس هش بازاریاب / مشتری)
+        if user_type != 'admin' and user_code:
+            relevant_sales = sales_by_key('salesperson', user_code)
+        else:
+            relevant_sales = sales_by_key('customer', customer_codes)
+        relevant_sales = clean_dataframe_for_json(relevant_sales)
         print(f"💰 Relevant sales found: {len(relevant_sales)} records")
         
+        # برچسب دوره‌ها و آمار همه مشتریان در همه دوره‌ها با یک groupby
+        tagged_sales = tag_sales_with_periods(relevant_sales, periods)
+        period_stats = summarize_sales_periods(tagged_sales, 'CustomerCode')
+        period_sizes = tagged_sales['PeriodOrder'].value_counts()
+        
+        customer_rows = [
+            (str(code).strip(), str(name).strip())
+            for code, name in zip(filtered_customers['CustomerCode'], filtered_customers['CustomerName'])
+        ]
+        
         # آماده کردن داده‌های مقایسه‌ای
         comparison_data = {}
         
@@ -5010,63 +6486,26 @@ def get_sales_comparison_data(periods, user_code=None, user_type='admin'):
             period_key = f"{year}_{'-'.join(map(str, months))}"
             
             print(f"🔍 Processing period {period_index + 1}: Year {year}, Months {months}")
+            print(f"   📈 Period sales: {int(period_sizes.get(period_index, 0))} records")
             
-            period_sales = []
-            
-            # فیلتر فروش‌ها برای هر ماه در سال انتخابی
-            for month in months:
-                month_sales = filter_sales_by_jalali_date_range(
-                    relevant_sales, year, month, year, month
-                )
-                if not month_sales.empty:
-                    period_sales.append(month_sales)
-            
-            # ترکیب فروش‌های دوره
-            if period_sales:
-                combined_sales = pd.concat(period_sales, ignore_index=True)
-                # تمیز کردن داده‌های ترکیبی
-                combined_sales = clean_dataframe_for_json(combined_sales)
+            # آمار مشتریان این دوره
+            if period_index in period_sizes.index:
+                customer_stats = period_stats.loc[period_index]
+                customer_stats = dict(zip(customer_stats.index, customer_stats.itertuples(index=False)))
             else:
-                combined_sales = pd.DataFrame()
+                customer_stats = {}
             
-            print(f"   📈 Period sales: {len(combined_sales)} records")
-            
-            # محاسبه آمار هر مشتری در این دوره
             period_customer_stats = {}
             
-            for _, customer in filtered_customers.iterrows():
-                customer_code = str(customer['CustomerCode']).strip()
-                customer_name = str(customer['CustomerName']).strip()
-                
-                customer_sales = combined_sales[
-                    combined_sales['CustomerCode'] == customer_code
-                ] if not combined_sales.empty else pd.DataFrame()
-                
-                # محاسبه آمار با در نظر گیری مقادیر خالی
-                total_amount = 0
-                total_quantity = 0
-                unique_products = 0
-                order_count = 0
-                
-                if not customer_sales.empty:
-                    # محاسبه امن مبلغ کل
-                    amounts = customer_sales['TotalAmount'].fillna(0)
-                    total_amount = float(amounts.sum()) if not amounts.empty else 0
-                    
-                    # محاسبه امن تعداد
-                    quantities = customer_sales['Quantity'].fillna(0)
-                    total_quantity = int(quantities.sum()) if not quantities.empty else 0
-                    
-                    # تعداد محصولات منحصر به فرد
-                    unique_products = len(customer_sales['ProductCode'].dropna().unique())
-                    order_count = len(customer_sales)
+            for customer_code, customer_name in customer_rows:
+                stats = customer_stats.get(customer_code)
                 
                 period_customer_stats[customer_code] = {
                     'customer_name': customer_name,
-                    'total_amount': float(total_amount),
-                    'total_quantity': int(total_quantity),
-                    'unique_products': int(unique_products),
-                    'order_count': int(order_count)
+                    'total_amount': float(stats.total_amount) if stats else 0.0,
+                    'total_quantity': int(stats.total_quantity) if stats else 0,
+                    'unique_products': int(stats.unique_products) if stats else 0,
+                    'order_count': int(stats.order_count) if stats else 0
                 }
             
             # محاسبه مجموع دوره
@@ -5096,55 +6535,16 @@ def get_sales_comparison_data(periods, user_code=None, user_type='admin'):
 
 #
 def filter_sales_by_jalali_date_range(sales_df, start_year, start_month, end_year, end_month):
-    """فیلتر کردن فروش در بازه تاریخی شمسی"""
+    """فیلتر کردن فروش در بازه تاریخی شمسی (مقایسه برداری کلید سال*100+ماه)"""
     try:
-        if sales_df.empty:
+        if sales_df.empty or 'InvoiceDate' not in sales_df.columns:
             return pd.DataFrame()
         
-        filtered_rows = []
-        
-        for index, row in sales_df.iterrows():
-            try:
-                invoice_date = row['InvoiceDate']
-                
-                if pd.isna(invoice_date):
-                    continue
-                
-                # تبدیل تاریخ به شمسی
-                if isinstance(invoice_date, str):
-                    if '/' in invoice_date:
-                        # فرمت شمسی: 1403/01/15
-                        date_parts = invoice_date.split('/')
-                        if len(date_parts) == 3:
-                            invoice_year = int(date_parts[0])
-                            invoice_month = int(date_parts[1])
-                            
-                            # بررسی قرار گیری در بازه
-                            if (invoice_year == start_year and invoice_month >= start_month and
-                                invoice_year == end_year and invoice_month <= end_month) or \
-                               (invoice_year > start_year and invoice_year < end_year) or \
-                               (invoice_year == start_year and invoice_month >= start_month and invoice_year < end_year) or \
-                               (invoice_year > start_year and invoice_year == end_year and invoice_month <= end_month):
-                                filtered_rows.append(row)
-                    elif '-' in invoice_date:
-                        # فرمت میلادی: 2024-03-21
-                        gregorian_date = datetime.strptime(invoice_date, '%Y-%m-%d').date()
-                        jalali_date = jdatetime.date.fromgregorian(date=gregorian_date)
-                        
-                        invoice_year = jalali_date.year
-                        invoice_month = jalali_date.month
-                        
-                        if (invoice_year == start_year and invoice_month >= start_month and
-                            invoice_year == end_year and invoice_month <= end_month) or \
-                           (invoice_year > start_year and invoice_year < end_year) or \
-                           (invoice_year == start_year and invoice_month >= start_month and invoice_year < end_year) or \
-                           (invoice_year > start_year and invoice_year == end_year and invoice_month <= end_month):
-                            filtered_rows.append(row)
-                            
-            except (ValueError, AttributeError):
-                continue
+        start_ym = int(start_year) * 100 + int(start_month)
+        end_ym = int(end_year) * 100 + int(end_month)
         
-        return pd.DataFrame(filtered_rows) if filtered_rows else pd.DataFrame()
+        year_months = get_year_month_keys(sales_df)
+        return sales_df[(year_months >= max(start_ym, 1)) & (year_months <= end_ym)]
         
     except Exception as e:
         print(f"Error in filter_sales_by_jalali_date_range: {e}")
@@ -5169,279 +6569,860 @@ def get_comparative_sales_data():
         user_code = session['user_info']['Codev']
         user_type = session['user_info']['Typev']
         
-        comparison_data = get_sales_comparison_data(periods, user_code, user_type)
+        def build_report():
+            comparison_data = get_sales_comparison_data(periods, user_code, user_type)
+            
+            if comparison_data is None:
+                return jsonify({'success': False, 'error': 'خطا در پردازش داده‌ها'}), 500
+            
+            # محاسبه آمار مقایسه‌ای
+            period_keys = list(comparison_data.keys())
+            customer_comparison = {}
+            
+            # لیست کلیه مشتریان در تمام دوره‌ها
+            all_customers = set()
+            for period_data in comparison_data.values():
+                all_customers.update(period_data['customers'].keys())
+            
+            print(f"👥 Total unique customers across all periods: {len(all_customers)}")
+            
+            # مقایسه هر مشتری در دوره‌های مختلف
+            for customer_code in all_customers:
+                customer_periods = {}
+                customer_name = 'نامشخص'
+            
+                for period_key, period_data in comparison_data.items():
+                    if customer_code in period_data['customers']:
+                        customer_info = period_data['customers'][customer_code]
+                        customer_name = customer_info['customer_name']
+                        customer_periods[period_key] = customer_info
+                    else:
+                        customer_periods[period_key] = {
+                            'customer_name': customer_name,
+                            'total_amount': 0,
+                            'total_quantity': 0,
+                            'unique_products': 0,
+                            'order_count': 0
+                        }
+            
+                # محاسبه تغییرات
+                period_values = list(customer_periods.values())
+                changes = []
+            
+                if len(period_values) >= 2:
+                    for i in range(1, len(period_values)):
+                        current = float(period_values[i]['total_amount'])
+                        previous = float(period_values[i-1]['total_amount'])
+            
+                        if previous > 0:
+                            change_percent = ((current - previous) / previous) * 100
+                            change_amount = current - previous
+                        else:
+                            change_percent = 100.0 if current > 0 else 0.0
+                            change_amount = current
+            
+                        changes.append({
+                            'change_percent': round(float(change_percent), 1),
+                            'change_amount': int(change_amount),
+                            'trend': 'رشد' if change_amount > 0 else 'افت' if change_amount < 0 else 'ثابت'
+                        })
+            
+                total_across_periods = sum([float(p['total_amount']) for p in period_values])
+                average_per_period = total_across_periods / len(period_values) if period_values else 0
+            
+                customer_comparison[customer_code] = {
+                    'customer_name': customer_name,
+                    'periods': customer_periods,
+                    'changes': changes,
+                    'total_across_periods': float(total_across_periods),
+                    'average_per_period': float(average_per_period)
+                }
+            
+            # آمار کلی
+            summary_stats = {}
+            for period_key, period_data in comparison_data.items():
+                active_customers = len([
+                    c for c in period_data['customers'].values() 
+                    if float(c['total_amount']) > 0
+                ])
+            
+                summary_stats[period_key] = {
+                    'period_description': period_data['period_description'],
+                    'total_sales': int(float(period_data['period_total'])),
+                    'active_customers': int(active_customers),
+                    'total_customers': len(period_data['customers'])
+                }
+            
+            print(f"✅ Analysis complete: {len(customer_comparison)} customers analyzed")
+            
+            # اطمینان از عدم وجود مقادیر NaN در response نهایی
+            response_data = {
+                'success': True,
+                'periods': periods,
+                'customer_comparison': customer_comparison,
+                'summary_stats': summary_stats,
+                'period_descriptions': {
+                    k: str(v['period_description']) for k, v in comparison_data.items()
+                }
+            }
+            
+            return response_data
+        
+        # نتیجه از کش گزارش‌ها (به ازای محدوده کاربر و تا وقتی هیچ فایل ورودی عوض نشده)
+        versions = get_dataset_versions('sales.xlsx', CUSTOMERS_FILE, USERS_FILE, 'products.xlsx')
+        return cached_report_response('comparative_sales', {'periods': periods},
+                                      (user_type, user_code), versions, build_report)
+        
+    except Exception as e:
+        print(f"❌ Error in get_comparative_sales_data: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False, 
+            'error': f'خطای سرور: {str(e)}'
+        }), 500
+
+@app.route('/get_customer_detailed_comparison', methods=['POST'])
+def get_customer_detailed_comparison():
+    """API برای دریافت جزئیات مقایسه‌ای یک مشتری خاص"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'error': 'لطفاً وارد شوید'}), 401
+        
+        data = request.get_json()
+        customer_code = data.get('customer_code')
+        periods = data.get('periods', [])
+        
+        if not customer_code or not periods:
+            return jsonify({'error': 'کد مشتری و دوره‌ها الزامی است'}), 400
+        
+        print(f"🔍 Detailed analysis for customer: {customer_code}")
+        
+        # بارگذاری داده‌ها
+        scope_index = get_customer_scope_index()
+        catalog_index = get_product_catalog_index()
+        sales_df = load_sales_from_excel()
+        
+        if scope_index is None or catalog_index is None or sales_df is None:
+            return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
+        
+        customers_df = scope_index['customers']
+        products_df = catalog_index['products']
+        
+        # بررسی دسترسی کاربر به این مشتری
+        user_code = session['user_info']['Codev']
+        user_type = session['user_info']['Typev']
+        
+        if user_type != 'admin' and not customer_in_scope(scope_index, user_code, customer_code):
+            return jsonify({'error': 'دسترسی غیرمجاز'}), 403
         
-        if comparison_data is None:
-            return jsonify({'success': False, 'error': 'خطا در پردازش داده‌ها'}), 500
+        # اطلاعات کلی مشتری
+        customer_info = customers_df[customers_df['CustomerCode'] == customer_code]
+        if customer_info.empty:
+            return jsonify({'error': 'مشتری یافت نشد'}), 404
         
-        # محاسبه آمار مقایسه‌ای
-        period_keys = list(comparison_data.keys())
-        customer_comparison = {}
+        customer_detail = customer_info.iloc[0].to_dict()
         
-        # لیست کلیه مشتریان در تمام دوره‌ها
-        all_customers = set()
-        for period_data in comparison_data.values():
-            all_customers.update(period_data['customers'].keys())
+        # فروش‌های مشتری با برچسب دوره (ایندکس هش مشتری + کلید YearMonth)
+        tagged_sales = tag_sales_with_periods(sales_by_key('customer', customer_code), periods)
+        period_groups = dict(list(tagged_sales.groupby('PeriodOrder', sort=False)))
         
-        print(f"👥 Total unique customers across all periods: {len(all_customers)}")
+        # تحلیل هر دوره
+        period_analysis = {}
+        all_products_purchased = set()
         
-        # مقایسه هر مشتری در دوره‌های مختلف
-        for customer_code in all_customers:
-            customer_periods = {}
-            customer_name = 'نامشخص'
+        for period_index, period in enumerate(periods):
+            year = period['year']
+            months = period['months']
+            period_key = f"{year}_{'-'.join(map(str, months))}"
             
-            for period_key, period_data in comparison_data.items():
-                if customer_code in period_data['customers']:
-                    customer_info = period_data['customers'][customer_code]
-                    customer_name = customer_info['customer_name']
-                    customer_periods[period_key] = customer_info
-                else:
-                    customer_periods[period_key] = {
-                        'customer_name': customer_name,
-                        'total_amount': 0,
-                        'total_quantity': 0,
-                        'unique_products': 0,
-                        'order_count': 0
-                    }
+            combined_sales = period_groups.get(period_index, pd.DataFrame())
             
-            # محاسبه تغییرات
-            period_values = list(customer_periods.values())
-            changes = []
+            # محاسبه فروش هر محصول (به ترتیب اولین خرید)
+            product_sales = {}
+            period_total = 0
             
-            if len(period_values) >= 2:
-                for i in range(1, len(period_values)):
-                    current = float(period_values[i]['total_amount'])
-                    previous = float(period_values[i-1]['total_amount'])
+            if not combined_sales.empty:
+                for product_code, sales in combined_sales.groupby('ProductCode', sort=False):
+                    amounts = sales['TotalAmount'].astype(float).tolist()
+                    quantities = [int(quantity) for quantity in sales['Quantity']]
                     
-                    if previous > 0:
-                        change_percent = ((current - previous) / previous) * 100
-                        change_amount = current - previous
-                    else:
-                        change_percent = 100.0 if current > 0 else 0.0
-                        change_amount = current
+                    product_sales[product_code] = {
+                        'total_amount': sum(amounts),
+                        'total_quantity': sum(quantities),
+                        'purchase_dates': [
+                            {'date': date, 'amount': amount, 'quantity': quantity}
+                            for date, amount, quantity in zip(sales['InvoiceDate'], amounts, quantities)
+                        ]
+                    }
                     
-                    changes.append({
-                        'change_percent': round(float(change_percent), 1),
-                        'change_amount': int(change_amount),
-                        'trend': 'رشد' if change_amount > 0 else 'افت' if change_amount < 0 else 'ثابت'
+                    period_total += sum(amounts)
+                    all_products_purchased.add(product_code)
+            
+            # اطلاعات محصولات خریداری شده
+            purchased_products = []
+            for product_code, sales_data in product_sales.items():
+                product_detail = lookup_product(catalog_index, product_code)
+                
+                if product_detail is not None:
+                    purchased_products.append({
+                        'product_code': product_code,
+                        'product_name': product_detail.get('ProductName', ''),
+                        'brand': product_detail.get('Brand', ''),
+                        'category': product_detail.get('Category', ''),
+                        'price': float(product_detail.get('Price', 0)),
+                        'total_amount': int(sales_data['total_amount']),
+                        'total_quantity': int(sales_data['total_quantity']),
+                        'purchase_dates': sales_data['purchase_dates']
                     })
             
-            total_across_periods = sum([float(p['total_amount']) for p in period_values])
-            average_per_period = total_across_periods / len(period_values) if period_values else 0
+            # مرتب‌سازی بر اساس مبلغ خرید
+            purchased_products.sort(key=lambda x: x['total_amount'], reverse=True)
             
-            customer_comparison[customer_code] = {
-                'customer_name': customer_name,
-                'periods': customer_periods,
-                'changes': changes,
-                'total_across_periods': float(total_across_periods),
-                'average_per_period': float(average_per_period)
+            period_analysis[period_key] = {
+                'year': year,
+                'months': months,
+                'period_description': f"سال {year} - ماه‌های {', '.join(map(str, months))}",
+                'purchased_products': purchased_products,
+                'period_total': int(period_total),
+                'unique_products_count': len(purchased_products)
             }
         
-        # آمار کلی
-        summary_stats = {}
-        for period_key, period_data in comparison_data.items():
-            active_customers = len([
-                c for c in period_data['customers'].values() 
-                if float(c['total_amount']) > 0
-            ])
-            
-            summary_stats[period_key] = {
-                'period_description': period_data['period_description'],
-                'total_sales': int(float(period_data['period_total'])),
-                'active_customers': int(active_customers),
-                'total_customers': len(period_data['customers'])
-            }
+        # محصولات خریداری نشده (محصولات موجود که این مشتری نخریده)
+        all_purchased_codes = list(all_products_purchased)
+        not_purchased_products = []
+        
+        for _, product in products_df.iterrows():
+            if product['ProductCode'] not in all_purchased_codes:
+                not_purchased_products.append({
+                    'product_code': product['ProductCode'],
+                    'product_name': product.get('ProductName', ''),
+                    'brand': product.get('Brand', ''),
+                    'category': product.get('Category', ''),
+                    'price': float(product.get('Price', 0))
+                })
+        
+        # مرتب‌سازی بر اساس قیمت
+        not_purchased_products.sort(key=lambda x: x['price'], reverse=True)
         
-        print(f"✅ Analysis complete: {len(customer_comparison)} customers analyzed")
+        print(f"✅ Detailed analysis complete for customer {customer_code}")
         
-        # اطمینان از عدم وجود مقادیر NaN در response نهایی
-        response_data = {
+        return jsonify({
             'success': True,
+            'customer': customer_detail,
             'periods': periods,
-            'customer_comparison': customer_comparison,
-            'summary_stats': summary_stats,
-            'period_descriptions': {
-                k: str(v['period_description']) for k, v in comparison_data.items()
+            'period_analysis': period_analysis,
+            'not_purchased_products': not_purchased_products[:50],  # محدود کردن به 50 محصول
+            'summary': {
+                'total_across_periods': sum([p['period_total'] for p in period_analysis.values()]),
+                'unique_products_purchased': len(all_purchased_codes),
+                'products_not_purchased': len(not_purchased_products)
             }
-        }
-        
-        return jsonify(response_data)
+        })
         
     except Exception as e:
-        print(f"❌ Error in get_comparative_sales_data: {str(e)}")
+        print(f"❌ Error in get_customer_detailed_comparison: {str(e)}")
         import traceback
         traceback.print_exc()
-        return jsonify({
-            'success': False, 
-            'error': f'خطای سرور: {str(e)}'
-        }), 500
+        return jsonify({'error': f'خطای سرور: {str(e)}'}), 500
+# اضافه کردن این کدها به فایل app.py
 
-@app.route('/get_customer_detailed_comparison', methods=['POST'])
-def get_customer_detailed_comparison():
-    """API برای دریافت جزئیات مقایسه‌ای یک مشتری خاص"""
+
+# فایل‌های مربوط به تورهای ویزیت
+VISIT_PERIODS_FILE = 'visit_periods.xlsx'
+VISIT_TOURS_FILE = 'visit_tours.xlsx'
+VISIT_EXECUTIONS_FILE = 'visit_executions.xlsx'
+
+
+# ==============================================
+# Backend ذخیره‌سازی جداول پرنوشتن (SQLite)
+# ==============================================
+# سفارش‌ها، مراجعات، پیام‌ها و اجرای تورها با هر ثبت کل فایل Excel را بازنویسی
+# می‌کنند. با STORAGE_BACKEND=sqlite این جداول در SQLite (حالت WAL) نگهداری
+# می‌شوند: هر ثبت یک INSERT است و دو worker همزمان ردیف‌های هم را از بین نمی‌برند.
+# برای خروجی Excel: flask --app app export-excel
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'excel').strip().lower()
+SQLITE_DB_FILE = os.environ.get('SQLITE_DB_FILE', 'sales_system.db')
+
+SQLITE_TABLES = {
+    'orders': {
+        'file': 'orders.xlsx',
+        'sheet': 'orders',
+        'columns': ['OrderNumber', 'DocumentNumber', 'BazaryabCode', 'CustomerCode',
+                    'ProductCode', 'Quantity', 'UnitPrice', 'TotalAmount',
+                    'OrderDate', 'OrderTime', 'Status', 'Notes'],
+        'indexes': ['OrderNumber', 'BazaryabCode', 'CustomerCode']
+    },
+    'visits': {
+        'file': VISITS_FILE,
+        'sheet': 'visits',
+        'columns': ['VisitCode', 'BazaryabCode', 'CustomerCode', 'VisitDate', 'VisitTime',
+                    'Latitude', 'Longitude', 'Distance'],
+        'indexes': ['BazaryabCode', 'CustomerCode', 'VisitDate']
+    },
+    'messages': {
+        'file': MESSAGES_FILE,
+        'sheet': 'messages',
+        'columns': ['MessageID', 'SenderCode', 'SenderName', 'MessageText', 'Timestamp',
+                    'JalaliDate', 'JalaliTime', 'IsRead', 'ReadBy', 'IsEdited', 'IsDeleted',
+                    'AttachmentType', 'AttachmentName', 'AttachmentPath', 'AttachmentSize'],
+        'indexes': ['MessageID', 'SenderCode']
+    },
+    'visit_executions': {
+        'file': VISIT_EXECUTIONS_FILE,
+        'sheet': 'executions',
+        'columns': ['ExecutionCode', 'TourCode', 'CustomerCode', 'VisitDate',
+                    'VisitTime', 'BazaryabCode', 'Status', 'Notes'],
+        'indexes': ['TourCode', 'BazaryabCode', 'CustomerCode']
+    }
+}
+
+_sqlite_local = threading.local()
+_sqlite_init_lock = threading.Lock()
+_sqlite_initialized_pid = None
+
+
+def is_sqlite_storage():
+    """آیا جداول پرنوشتن در SQLite نگهداری می‌شوند؟"""
+    return STORAGE_BACKEND == 'sqlite'
+
+
+def quote_sqlite_name(name):
+    """نقل‌قول امن نام ستون/جدول برای SQL"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def to_sqlite_value(value):
+    """تبدیل مقدار pandas/numpy به مقدار قابل ذخیره در SQLite"""
+    if value is None:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if value is pd.NaT:
+        return None
+    if isinstance(value, (datetime, pd.Timestamp)):
+        return str(value)
+    return value
+
+
+def get_sqlite_connection():
+    """اتصال SQLite مخصوص هر thread (و هر worker)"""
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is not None and getattr(_sqlite_local, 'pid', None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(SQLITE_DB_FILE, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    _sqlite_local.conn = conn
+    _sqlite_local.pid = os.getpid()
+
+    init_sqlite_storage(conn)
+    return conn
+
+
+def get_sqlite_columns(conn, table_name):
+    """لیست ستون‌های یک جدول SQLite"""
+    rows = conn.execute(f"PRAGMA table_info({quote_sqlite_name(table_name)})").fetchall()
+    return [row[1] for row in rows]
+
+
+def ensure_sqlite_columns(conn, table_name, columns):
+    """اضافه کردن ستون‌های جدید به جدول (اگر وجود نداشته باشند)"""
+    existing = set(get_sqlite_columns(conn, table_name))
+    for col in columns:
+        if col not in existing:
+            conn.execute(f"ALTER TABLE {quote_sqlite_name(table_name)} ADD COLUMN {quote_sqlite_name(col)}")
+            existing.add(col)
+
+
+def init_sqlite_storage(conn):
+    """ایجاد جداول و ایندکس‌ها و انتقال یک‌باره داده‌های Excel موجود"""
+    global _sqlite_initialized_pid
+
+    with _sqlite_init_lock:
+        if _sqlite_initialized_pid == os.getpid():
+            return
+
+        conn.execute("CREATE TABLE IF NOT EXISTS storage_meta (TableName TEXT PRIMARY KEY, ImportedAt TEXT)")
+
+        for table_name, spec in SQLITE_TABLES.items():
+            columns_sql = ', '.join(quote_sqlite_name(col) for col in spec['columns'])
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {quote_sqlite_name(table_name)} ({columns_sql})")
+
+            for col in spec['indexes']:
+                index_name = f"idx_{table_name}_{col}"
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {quote_sqlite_name(index_name)} "
+                    f"ON {quote_sqlite_name(table_name)} ({quote_sqlite_name(col)})"
+                )
+
+            # انتقال داده‌های Excel فقط یک بار (قفل IMMEDIATE بین workerها)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                imported = conn.execute(
+                    "SELECT 1 FROM storage_meta WHERE TableName = ?", (table_name,)
+                ).fetchone()
+
+                if not imported:
+                    if os.path.exists(spec['file']):
+                        try:
+                            excel_df = pd.read_excel(spec['file'], sheet_name=spec['sheet'])
+                        except ValueError:
+                            excel_df = pd.DataFrame()
+                        if not excel_df.empty:
+                            insert_sqlite_rows(conn, table_name, excel_df.to_dict('records'))
+                            print(f"📥 {len(excel_df)} رکورد از {spec['file']} به SQLite منتقل شد")
+
+                    conn.execute(
+                        "INSERT INTO storage_meta (TableName, ImportedAt) VALUES (?, ?)",
+                        (table_name, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        _sqlite_initialized_pid = os.getpid()
+        print(f"✅ SQLite storage ready: {SQLITE_DB_FILE}")
+
+
+def insert_sqlite_rows(conn, table_name, rows):
+    """درج ردیف‌ها (بدون commit)"""
+    if not rows:
+        return
+
+    columns = []
+    for row in rows:
+        for col in row.keys():
+            if col not in columns:
+                columns.append(col)
+
+    ensure_sqlite_columns(conn, table_name, columns)
+
+    columns_sql = ', '.join(quote_sqlite_name(col) for col in columns)
+    placeholders = ', '.join('?' for _ in columns)
+    conn.executemany(
+        f"INSERT INTO {quote_sqlite_name(table_name)} ({columns_sql}) VALUES ({placeholders})",
+        [tuple(to_sqlite_value(row.get(col)) for col in columns) for row in rows]
+    )
+
+
+def load_storage_table(table_name):
+    """خواندن کل جدول SQLite به صورت DataFrame (به ترتیب ثبت)"""
+    try:
+        conn = get_sqlite_connection()
+        return pd.read_sql_query(
+            f"SELECT * FROM {quote_sqlite_name(table_name)} ORDER BY rowid", conn
+        )
+    except Exception as e:
+        print(f"❌ خطا در خواندن جدول {table_name} از SQLite: {e}")
+        return pd.DataFrame(columns=SQLITE_TABLES[table_name]['columns'])
+
+
+def count_storage_rows(table_name):
+    """تعداد ردیف‌های یک جدول SQLite"""
+    conn = get_sqlite_connection()
+    return conn.execute(f"SELECT COUNT(*) FROM {quote_sqlite_name(table_name)}").fetchone()[0]
+
+
+def append_storage_rows(table_name, rows):
+    """اضافه کردن ردیف‌های جدید - O(1) به ازای هر ردیف"""
+    try:
+        conn = get_sqlite_connection()
+        with conn:
+            insert_sqlite_rows(conn, table_name, rows)
+        return True
+    except Exception as e:
+        print(f"❌ خطا در ثبت در جدول {table_name}: {e}")
+        return False
+
+
+def append_storage_row_with_id(table_name, row, id_column, next_id):
+    """
+    درج یک ردیف با شناسه‌ای که در همان تراکنش محاسبه می‌شود
+
+    BEGIN IMMEDIATE قفل نوشتن را قبل از خواندن شناسه می‌گیرد، پس دو worker
+    نمی‌توانند یک شناسه را بگیرند.
+
+    Args:
+        next_id: تابعی که با اتصال (داخل تراکنش) شناسه بعدی را برمی‌گرداند
+
+    Returns:
+        شناسه ثبت‌شده یا None در صورت خطا
+    """
+    ids = append_storage_row_with_ids(table_name, row, lambda conn: {id_column: next_id(conn)})
+    return None if ids is None else ids[id_column]
+
+
+def append_storage_row_with_ids(table_name, row, next_ids):
+    """
+    مثل append_storage_row_with_id برای چند ستون شناسه
+
+    Args:
+        next_ids: تابعی که با اتصال (داخل تراکنش) dict ستون -> شناسه برمی‌گرداند
+
+    Returns:
+        dict شناسه‌های ثبت‌شده یا None در صورت خطا
+    """
+    try:
+        conn = get_sqlite_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = next_ids(conn)
+            insert_sqlite_rows(conn, table_name, [{**row, **ids}])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return ids
+    except Exception as e:
+        print(f"❌ خطا در ثبت در جدول {table_name}: {e}")
+        return None
+
+
+def replace_storage_rows(table_name, column, value, rows):
+    """حذف ردیف‌هایی با مقدار مشخص در یک ستون و درج ردیف‌های جدید در یک تراکنش"""
+    try:
+        conn = get_sqlite_connection()
+        with conn:
+            conn.execute(
+                f"DELETE FROM {quote_sqlite_name(table_name)} WHERE {quote_sqlite_name(column)} = ?",
+                (to_sqlite_value(value),)
+            )
+            insert_sqlite_rows(conn, table_name, rows)
+        return True
+    except Exception as e:
+        print(f"❌ خطا در به‌روزرسانی جدول {table_name}: {e}")
+        return False
+
+
+def update_storage_rows(table_name, column, value, values):
+    """
+    به‌روزرسانی چند ستون در ردیف‌هایی با مقدار مشخص در یک ستون (یک UPDATE در یک تراکنش)
+
+    Returns:
+        True اگر حداقل یک ردیف تغییر کرد
+    """
+    try:
+        conn = get_sqlite_connection()
+        ensure_sqlite_columns(conn, table_name, list(values.keys()))
+        set_sql = ', '.join(f"{quote_sqlite_name(col)} = ?" for col in values)
+        with conn:
+            cursor = conn.execute(
+                f"UPDATE {quote_sqlite_name(table_name)} SET {set_sql} WHERE {quote_sqlite_name(column)} = ?",
+                tuple(to_sqlite_value(v) for v in values.values()) + (to_sqlite_value(value),)
+            )
+        return cursor.rowcount > 0
+    except Exception as e:
+        print(f"❌ خطا در به‌روزرسانی جدول {table_name}: {e}")
+        return False
+
+
+def save_storage_table(table_name, df):
+    """جایگزینی کامل محتوای جدول (فقط برای ورود/خروج کامل داده؛ ویرایش‌ها از update_storage_rows)"""
+    try:
+        conn = get_sqlite_connection()
+        with conn:
+            conn.execute(f"DELETE FROM {quote_sqlite_name(table_name)}")
+            insert_sqlite_rows(conn, table_name, df.to_dict('records'))
+        return True
+    except Exception as e:
+        print(f"❌ خطا در ذخیره جدول {table_name}: {e}")
+        return False
+
+
+def export_storage_to_excel(table_names=None):
+    """خروجی گرفتن از جداول SQLite به فایل‌های Excel"""
+    exported = []
+    for table_name in (table_names or SQLITE_TABLES.keys()):
+        spec = SQLITE_TABLES[table_name]
+        df = load_storage_table(table_name)
+        df.to_excel(spec['file'], sheet_name=spec['sheet'], index=False)
+        exported.append((spec['file'], len(df)))
+        print(f"📤 {table_name}: {len(df)} رکورد → {spec['file']}")
+    return exported
+
+
+@app.cli.command('export-excel')
+def export_excel_command():
+    """خروجی Excel از جداول SQLite برای واحد اداری"""
+    if not os.path.exists(SQLITE_DB_FILE):
+        print(f"❌ SQLite database not found: {SQLITE_DB_FILE}")
+        return
+    export_storage_to_excel()
+    print("✅ خروجی Excel آماده شد")
+
+
+# ==============================================
+# ژورنال نوشتن (Append-only Write Journal)
+# ==============================================
+# با STORAGE_BACKEND=journal فایل‌های Excel مرجع اصلی می‌مانند، ولی هر ثبت
+# (سفارش، مراجعه، اجرای تور، نتیجه آزمون) فقط یک خط JSON به ژورنال اضافه می‌کند.
+# یک thread پس‌زمینه ژورنال را هر JOURNAL_COMPACT_INTERVAL ثانیه (و هنگام خروج)
+# در فایل Excel ادغام می‌کند و loaderها انتهای ژورنال را روی داده Excel اعمال می‌کنند.
+JOURNAL_FOLDER = 'data_journal'
+JOURNAL_COMPACT_INTERVAL = int(os.environ.get('JOURNAL_COMPACT_INTERVAL', '300'))
+
+JOURNAL_TABLES = {
+    'orders': {'file': 'orders.xlsx', 'sheet': 'orders'},
+    'visits': {'file': VISITS_FILE, 'sheet': 'visits'},
+    'visit_executions': {'file': VISIT_EXECUTIONS_FILE, 'sheet': 'executions'},
+    'exam_results': {'file': EXAMS_FILE, 'sheet': 'azmon'}
+}
+
+_journal_entries_cache = {}
+_journal_compactor_started = False
+
+
+def is_journal_storage():
+    """آیا نوشتن‌ها ابتدا در ژورنال ثبت می‌شوند؟"""
+    return STORAGE_BACKEND == 'journal'
+
+
+_thread_file_locks = {}
+_thread_file_locks_guard = threading.Lock()
+_held_file_locks = threading.local()
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    قفل انحصاری مشترک بین threadها و workerها با یک فایل قفل محلی
+
+    قفل در همان thread بازگشتی است: گرفتن دوباره همان مسیر (مثلاً بارگذاری
+    جدول ژورنالی زیر journal_lock) بدون انتظار ادامه می‌دهد.
+    """
+    held = getattr(_held_file_locks, 'paths', None)
+    if held is None or getattr(_held_file_locks, 'pid', None) != os.getpid():
+        held = _held_file_locks.paths = set()
+        _held_file_locks.pid = os.getpid()
+
+    key = os.path.abspath(lock_path)
+    if key in held:
+        yield
+        return
+
+    held.add(key)
+    try:
+        with acquire_file_lock(lock_path):
+            yield
+    finally:
+        held.discard(key)
+
+
+@contextmanager
+def acquire_file_lock(lock_path):
+    """گرفتن قفل فایل (flock یا در نبود آن قفل thread به ازای مسیر)"""
+    if fcntl is None:
+        # ویندوز: بدون flock، حداقل threadهای همین پردازه با یک قفل به ازای هر مسیر هماهنگ می‌شوند
+        with _thread_file_locks_guard:
+            thread_lock = _thread_file_locks.setdefault(os.path.abspath(lock_path), threading.Lock())
+        with thread_lock:
+            yield
+        return
+
+    lock_dir = os.path.dirname(lock_path)
+    if lock_dir:
+        os.makedirs(lock_dir, exist_ok=True)
+
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def get_journal_path(table_name):
+    """مسیر فایل ژورنال یک جدول"""
+    return os.path.join(JOURNAL_FOLDER, f"{table_name}.jsonl")
+
+
+def journal_lock(table_name):
+    """قفل ژورنال یک جدول"""
+    return file_lock(os.path.join(JOURNAL_FOLDER, f"{table_name}.lock"))
+
+
+def write_journal_entry(table_name, entry):
+    """اضافه کردن یک خط به ژورنال با fsync"""
+    try:
+        entry['ts'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        line = json.dumps(entry, ensure_ascii=False, default=to_sqlite_value)
+
+        with journal_lock(table_name):
+            with open(get_journal_path(table_name), 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+        start_journal_compactor()
+        return True
+    except Exception as e:
+        print(f"❌ خطا در ثبت ژورنال {table_name}: {e}")
+        return False
+
+
+def append_journal_rows(table_name, rows):
+    """ثبت ردیف‌های جدید در ژورنال"""
+    return write_journal_entry(table_name, {'op': 'append', 'rows': rows})
+
+
+def replace_journal_rows(table_name, column, value, rows):
+    """ثبت حذف ردیف‌های یک مقدار و درج ردیف‌های جدید در ژورنال"""
+    return write_journal_entry(table_name, {
+        'op': 'replace', 'column': column, 'value': value, 'rows': rows
+    })
+
+
+def read_journal_entries(table_name):
+    """خواندن ورودی‌های ژورنال (با کش بر اساس نسخه فایل)"""
+    path = get_journal_path(table_name)
+    version = get_file_version(path)
+    if version is None or version[1] == 0:
+        return []
+
+    cached = _journal_entries_cache.get(table_name)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # خط ناقص (مثلاً قطع برق وسط نوشتن) نادیده گرفته می‌شود
+                print(f"⚠️ خط نامعتبر در ژورنال {table_name} نادیده گرفته شد")
+
+    _journal_entries_cache[table_name] = (version, entries)
+    return entries
+
+
+def apply_journal_entries(df, entries):
+    """اعمال ورودی‌های ژورنال روی DataFrame"""
+    if not entries:
+        return df
+
+    if df is None:
+        df = pd.DataFrame()
+
+    pending_rows = []
+    for entry in entries:
+        if entry.get('op') == 'replace':
+            if pending_rows:
+                df = pd.concat([df, pd.DataFrame(pending_rows)], ignore_index=True)
+                pending_rows = []
+            column = entry.get('column')
+            if column in df.columns:
+                df = df[df[column].astype(str) != str(entry.get('value'))]
+
+        pending_rows.extend(entry.get('rows', []))
+
+    if pending_rows:
+        new_rows = pd.DataFrame(pending_rows)
+        df = new_rows if df.empty and len(df.columns) == 0 else pd.concat([df, new_rows], ignore_index=True)
+
+    return df.reset_index(drop=True)
+
+
+def load_with_journal(table_name, loader):
+    """بارگذاری داده Excel و اعمال انتهای ژورنال (زیر قفل تا با ادغام تداخل نکند)"""
+    with journal_lock(table_name):
+        df = loader()
+        return apply_journal_entries(df, read_journal_entries(table_name))
+
+
+def write_excel_sheet(path, sheet_name, df):
+    """بازنویسی اتمیک یک شیت با حفظ سایر شیت‌های فایل"""
+    other_sheets = {}
+    if os.path.exists(path):
+        with pd.ExcelFile(path) as xls:
+            for name in xls.sheet_names:
+                if name != sheet_name:
+                    other_sheets[name] = pd.read_excel(xls, sheet_name=name)
+
+    root, ext = os.path.splitext(path)
+    temp_path = f"{root}.{os.getpid()}.tmp{ext}"
+    with pd.ExcelWriter(temp_path, engine='openpyxl') as writer:
+        for name, sheet_df in other_sheets.items():
+            sheet_df.to_excel(writer, sheet_name=name, index=False)
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+    os.replace(temp_path, path)
+
+
+def compact_journal(table_name):
+    """ادغام ژورنال یک جدول در فایل Excel و خالی کردن ژورنال"""
+    spec = JOURNAL_TABLES[table_name]
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'لطفاً وارد شوید'}), 401
-        
-        data = request.get_json()
-        customer_code = data.get('customer_code')
-        periods = data.get('periods', [])
-        
-        if not customer_code or not periods:
-            return jsonify({'error': 'کد مشتری و دوره‌ها الزامی است'}), 400
-        
-        print(f"🔍 Detailed analysis for customer: {customer_code}")
-        
-        # بارگذاری داده‌ها
-        customers_df = load_customers_from_excel()
-        products_df = load_products_from_excel()
-        sales_df = load_sales_from_excel()
-        
-        if customers_df is None or products_df is None or sales_df is None:
-            return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
-        
-        # بررسی دسترسی کاربر به این مشتری
-        user_code = session['user_info']['Codev']
-        user_type = session['user_info']['Typev']
-        
-        if user_type != 'admin':
-            customer_info = customers_df[customers_df['CustomerCode'] == customer_code]
-            if customer_info.empty or customer_info.iloc[0]['BazaryabCode'] != user_code:
-                return jsonify({'error': 'دسترسی غیرمجاز'}), 403
-        
-        # اطلاعات کلی مشتری
-        customer_info = customers_df[customers_df['CustomerCode'] == customer_code]
-        if customer_info.empty:
-            return jsonify({'error': 'مشتری یافت نشد'}), 404
-        
-        customer_detail = customer_info.iloc[0].to_dict()
-        
-        # تحلیل هر دوره
-        period_analysis = {}
-        all_products_purchased = set()
-        
-        for period in periods:
-            year = period['year']
-            months = period['months']
-            period_key = f"{year}_{'-'.join(map(str, months))}"
-            
-            # فیلتر فروش‌ها برای این دوره
-            period_sales = []
-            for month in months:
-                month_sales = filter_sales_by_jalali_date_range(
-                    sales_df[sales_df['CustomerCode'] == customer_code],
-                    year, month, year, month
-                )
-                if not month_sales.empty:
-                    period_sales.append(month_sales)
-            
-            if period_sales:
-                combined_sales = pd.concat(period_sales, ignore_index=True)
-            else:
-                combined_sales = pd.DataFrame()
-            
-            # محاسبه فروش هر محصول
-            product_sales = {}
-            period_total = 0
-            
-            if not combined_sales.empty:
-                for _, sale in combined_sales.iterrows():
-                    product_code = sale['ProductCode']
-                    amount = float(sale.get('TotalAmount', 0))
-                    quantity = int(sale.get('Quantity', 0))
-                    
-                    if product_code not in product_sales:
-                        product_sales[product_code] = {
-                            'total_amount': 0,
-                            'total_quantity': 0,
-                            'purchase_dates': []
-                        }
-                    
-                    product_sales[product_code]['total_amount'] += amount
-                    product_sales[product_code]['total_quantity'] += quantity
-                    product_sales[product_code]['purchase_dates'].append({
-                        'date': sale.get('InvoiceDate', ''),
-                        'amount': amount,
-                        'quantity': quantity
-                    })
-                    
-                    period_total += amount
-                    all_products_purchased.add(product_code)
-            
-            # اطلاعات محصولات خریداری شده
-            purchased_products = []
-            for product_code, sales_data in product_sales.items():
-                product_info = products_df[products_df['ProductCode'] == product_code]
-                
-                if not product_info.empty:
-                    product_detail = product_info.iloc[0]
-                    purchased_products.append({
-                        'product_code': product_code,
-                        'product_name': product_detail.get('ProductName', ''),
-                        'brand': product_detail.get('Brand', ''),
-                        'category': product_detail.get('Category', ''),
-                        'price': float(product_detail.get('Price', 0)),
-                        'total_amount': int(sales_data['total_amount']),
-                        'total_quantity': int(sales_data['total_quantity']),
-                        'purchase_dates': sales_data['purchase_dates']
-                    })
-            
-            # مرتب‌سازی بر اساس مبلغ خرید
-            purchased_products.sort(key=lambda x: x['total_amount'], reverse=True)
-            
-            period_analysis[period_key] = {
-                'year': year,
-                'months': months,
-                'period_description': f"سال {year} - ماه‌های {', '.join(map(str, months))}",
-                'purchased_products': purchased_products,
-                'period_total': int(period_total),
-                'unique_products_count': len(purchased_products)
-            }
-        
-        # محصولات خریداری نشده (محصولات موجود که این مشتری نخریده)
-        all_purchased_codes = list(all_products_purchased)
-        not_purchased_products = []
-        
-        for _, product in products_df.iterrows():
-            if product['ProductCode'] not in all_purchased_codes:
-                not_purchased_products.append({
-                    'product_code': product['ProductCode'],
-                    'product_name': product.get('ProductName', ''),
-                    'brand': product.get('Brand', ''),
-                    'category': product.get('Category', ''),
-                    'price': float(product.get('Price', 0))
-                })
-        
-        # مرتب‌سازی بر اساس قیمت
-        not_purchased_products.sort(key=lambda x: x['price'], reverse=True)
-        
-        print(f"✅ Detailed analysis complete for customer {customer_code}")
-        
-        return jsonify({
-            'success': True,
-            'customer': customer_detail,
-            'periods': periods,
-            'period_analysis': period_analysis,
-            'not_purchased_products': not_purchased_products[:50],  # محدود کردن به 50 محصول
-            'summary': {
-                'total_across_periods': sum([p['period_total'] for p in period_analysis.values()]),
-                'unique_products_purchased': len(all_purchased_codes),
-                'products_not_purchased': len(not_purchased_products)
-            }
-        })
-        
+        with journal_lock(table_name):
+            entries = read_journal_entries(table_name)
+            if not entries:
+                return 0
+
+            df = pd.DataFrame()
+            if os.path.exists(spec['file']):
+                with pd.ExcelFile(spec['file']) as xls:
+                    if spec['sheet'] in xls.sheet_names:
+                        df = pd.read_excel(xls, sheet_name=spec['sheet'])
+
+            df = apply_journal_entries(df, entries)
+            write_excel_sheet(spec['file'], spec['sheet'], df)
+
+            # خالی کردن ژورنال
+            with open(get_journal_path(table_name), 'w', encoding='utf-8') as f:
+                f.flush()
+                os.fsync(f.fileno())
+            _journal_entries_cache.pop(table_name, None)
+
+        print(f"🗜️ ژورنال {table_name}: {len(entries)} ورودی در {spec['file']} ادغام شد")
+        return len(entries)
     except Exception as e:
-        print(f"❌ Error in get_customer_detailed_comparison: {str(e)}")
+        print(f"❌ خطا در ادغام ژورنال {table_name}: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({'error': f'خطای سرور: {str(e)}'}), 500
-# اضافه کردن این کدها به فایل app.py
+        return 0
 
 
-# فایل‌های مربوط به تورهای ویزیت
-VISIT_PERIODS_FILE = 'visit_periods.xlsx'
-VISIT_TOURS_FILE = 'visit_tours.xlsx'
-VISIT_EXECUTIONS_FILE = 'visit_executions.xlsx'
+def compact_all_journals():
+    """ادغام همه ژورنال‌ها"""
+    for table_name in JOURNAL_TABLES:
+        compact_journal(table_name)
+
+
+def start_journal_compactor():
+    """راه‌اندازی thread پس‌زمینه ادغام ژورنال (یک بار در هر worker)"""
+    global _journal_compactor_started
+
+    if _journal_compactor_started or not is_journal_storage():
+        return
+    _journal_compactor_started = True
+
+    def compactor_loop():
+        while True:
+            time.sleep(JOURNAL_COMPACT_INTERVAL)
+            compact_all_journals()
+
+    threading.Thread(target=compactor_loop, name='journal-compactor', daemon=True).start()
+    atexit.register(compact_all_journals)
+    print(f"✅ Journal compactor started (every {JOURNAL_COMPACT_INTERVAL}s)")
+
+
+@app.cli.command('compact-journal')
+def compact_journal_command():
+    """ادغام دستی ژورنال‌ها در فایل‌های Excel"""
+    compact_all_journals()
+    print("✅ ادغام ژورنال‌ها انجام شد")
+
+
+start_journal_compactor()
+
 
 def create_visit_files_if_not_exist():
     """ایجاد فایل‌های مربوط به تورهای ویزیت در صورت عدم وجود"""
@@ -5483,8 +7464,12 @@ def load_visit_periods():
     """بارگذاری دوره‌های ویزیت"""
     try:
         create_visit_files_if_not_exist()
-        df = pd.read_excel(VISIT_PERIODS_FILE, sheet_name='periods')
-        return clean_dataframe_for_json(df)
+        
+        def read_visit_periods():
+            df = pd.read_excel(VISIT_PERIODS_FILE, sheet_name='periods')
+            return clean_dataframe_for_json(df)
+        
+        return load_cached_dataset(VISIT_PERIODS_FILE, 'periods', read_visit_periods)
     except Exception as e:
         print(f"❌ خطا در بارگذاری دوره‌های ویزیت: {e}")
         return pd.DataFrame()
@@ -5493,8 +7478,12 @@ def load_visit_tours():
     """بارگذاری تورهای ویزیت"""
     try:
         create_visit_files_if_not_exist()
-        df = pd.read_excel(VISIT_TOURS_FILE, sheet_name='tours')
-        return clean_dataframe_for_json(df)
+        
+        def read_visit_tours():
+            df = pd.read_excel(VISIT_TOURS_FILE, sheet_name='tours')
+            return clean_dataframe_for_json(df)
+        
+        return load_cached_dataset(VISIT_TOURS_FILE, 'tours', read_visit_tours)
     except Exception as e:
         print(f"❌ خطا در بارگذاری تورهای ویزیت: {e}")
         return pd.DataFrame()
@@ -5502,9 +7491,22 @@ def load_visit_tours():
 def load_visit_executions():
     """بارگذاری اجرای تورها"""
     try:
+        if is_sqlite_storage():
+            return clean_dataframe_for_json(load_storage_table('visit_executions'))
+        
         create_visit_files_if_not_exist()
-        df = pd.read_excel(VISIT_EXECUTIONS_FILE, sheet_name='executions')
-        return clean_dataframe_for_json(df)
+        
+        def read_visit_executions():
+            df = pd.read_excel(VISIT_EXECUTIONS_FILE, sheet_name='executions')
+            return clean_dataframe_for_json(df)
+        
+        if is_journal_storage():
+            return clean_dataframe_for_json(load_with_journal(
+                'visit_executions',
+                lambda: load_cached_dataset(VISIT_EXECUTIONS_FILE, 'executions', read_visit_executions)
+            ))
+        
+        return load_cached_dataset(VISIT_EXECUTIONS_FILE, 'executions', read_visit_executions)
     except Exception as e:
         print(f"❌ خطا در بارگذاری اجرای تورها: {e}")
         return pd.DataFrame()
@@ -5530,6 +7532,9 @@ def save_visit_tours(df):
 def save_visit_executions(df):
     """ذخیره اجرای تورها"""
     try:
+        if is_sqlite_storage():
+            return save_storage_table('visit_executions', df)
+        
         df.to_excel(VISIT_EXECUTIONS_FILE, sheet_name='executions', index=False)
         return True
     except Exception as e:
@@ -5707,8 +7712,8 @@ def create_tours_for_period():
         end_date = period_detail['EndDate']
         
         # بارگذاری مشتریان این بازاریاب
-        customers_df = load_customers_from_excel()
-        bazaryab_customers = customers_df[customers_df['BazaryabCode'] == bazaryab_code]
+        scope_index = get_customer_scope_index()
+        bazaryab_customers = scope_customers(scope_index, bazaryab_code)
         
         if bazaryab_customers.empty:
             return jsonify({'error': 'هیچ مشتری برای این بازاریاب یافت نشد'}), 404
@@ -6026,12 +8031,6 @@ def submit_tour_execution():
         if user_type != 'admin' and tour_detail['BazaryabCode'] != user_code:
             return jsonify({'error': 'دسترسی غیرمجاز'}), 403
         
-        # بارگذاری ویزیت‌های موجود
-        executions_df = load_visit_executions()
-        
-        # حذف ویزیت‌های قبلی این تور
-        executions_df = executions_df[executions_df['TourCode'] != tour_code]
-        
         # اضافه کردن ویزیت‌های جدید
         new_executions = []
         now = datetime.now()
@@ -6055,16 +8054,30 @@ def submit_tour_execution():
             
             new_executions.append(new_execution)
         
-        # اضافه کردن به DataFrame
-        if new_executions:
-            new_executions_df = pd.DataFrame(new_executions)
-            if executions_df.empty:
-                executions_df = new_executions_df
-            else:
-                executions_df = pd.concat([executions_df, new_executions_df], ignore_index=True)
+        if is_sqlite_storage():
+            # حذف ویزیت‌های قبلی این تور و ثبت جدیدها در یک تراکنش
+            saved = replace_storage_rows('visit_executions', 'TourCode', tour_code, new_executions)
+        elif is_journal_storage():
+            saved = replace_journal_rows('visit_executions', 'TourCode', tour_code, new_executions)
+        else:
+            # بارگذاری ویزیت‌های موجود
+            executions_df = load_visit_executions()
+            
+            # حذف ویزیت‌های قبلی این تور
+            executions_df = executions_df[executions_df['TourCode'] != tour_code]
+            
+            # اضافه کردن به DataFrame
+            if new_executions:
+                new_executions_df = pd.DataFrame(new_executions)
+                if executions_df.empty:
+                    executions_df = new_executions_df
+                else:
+                    executions_df = pd.concat([executions_df, new_executions_df], ignore_index=True)
+            
+            saved = save_visit_executions(executions_df)
         
         # ذخیره
-        if save_visit_executions(executions_df):
+        if saved:
             # به‌روزرسانی وضعیت تور
             tours_df.loc[tours_df['TourCode'] == tour_code, 'Status'] = 'در حال اجرا'
             save_visit_tours(tours_df)
@@ -6308,43 +8321,53 @@ def get_customers_by_products():
         print(f"🔍 Multi-product analysis for {len(product_codes)} products")
         
         # بارگذاری داده‌ها
-        customers_df = load_customers_from_excel()
-        products_df = load_products_from_excel()
-        sales_df = load_sales_from_excel()
+        scope_index = get_customer_scope_index()
+        catalog_index = get_product_catalog_index()
         users_df = load_users_from_excel()
         
-        if customers_df is None or products_df is None:
+        if scope_index is None or catalog_index is None:
             return jsonify({'error': 'خطا در بارگذاری فایل‌ها'}), 500
         
         # فیلتر مشتریان بر اساس بازاریاب
         bazaryab_code = session['user_info']['Codev']
         if session['user_info']['Typev'] != 'admin':
-            my_customers = customers_df[customers_df['BazaryabCode'] == bazaryab_code]
+            my_customers = scope_customers(scope_index, bazaryab_code)
             print(f"👤 User filter: {len(my_customers)} customers")
         else:
-            my_customers = customers_df
+            my_customers = scope_customers(scope_index)
             print(f"👑 Admin: {len(my_customers)} total customers")
         
+        # خریداران همه کالاها با یک برش از ایندکس فروش
+        from_ordinal, to_ordinal = resolve_date_window(date_from, date_to, date_type)
+        buyers = get_product_buyers(product_codes, from_ordinal, to_ordinal)
+        if buyers is None:
+            print(f"   ⚠️ No sales data available")
+            buyers = {product_code: {} for product_code in product_codes}
+
+        # اطلاعات مشتریان محدوده فقط یک بار ساخته می‌شود
+        customer_records = get_scope_customer_records(my_customers, users_df)
+
         # پردازش هر محصول
         products_results = []
-        
+
         for product_code in product_codes:
             # بررسی وجود کالا
-            product_info = products_df[products_df['ProductCode'] == product_code]
-            if product_info.empty:
+            product_info = lookup_product(catalog_index, product_code)
+            if product_info is None:
                 print(f"⚠️ Product not found: {product_code}")
                 continue
-            
-            product_details = product_info.iloc[0].to_dict()
-            
-            # محاسبه مشتریان خریدار/نخریدار برای این محصول
-            product_result = calculate_product_customers(
-                product_code, product_details, my_customers, 
-                sales_df, users_df, date_from, date_to, date_type
-            )
-            
-            products_results.append(product_result)
-        
+
+            purchased_customers, not_purchased_customers = split_product_customers(customer_records, buyers[product_code])
+            print(f"   📊 {product_code}: {len(purchased_customers)} purchased, {len(not_purchased_customers)} not purchased")
+
+            products_results.append({
+                'product': clean_product_details(product_info.to_dict()),
+                'purchased_customers': purchased_customers,
+                'not_purchased_customers': not_purchased_customers,
+                'total_purchased': len(purchased_customers),
+                'total_not_purchased': len(not_purchased_customers)
+            })
+
         print(f"✅ Analysis complete for {len(products_results)} products")
         
         return jsonify({
@@ -6362,184 +8385,6 @@ def get_customers_by_products():
         return jsonify({'error': f'خطای سرور: {str(e)}'}), 500
 
 
-def calculate_product_customers(product_code, product_details, customers_df, sales_df, users_df, date_from, date_to, date_type):
-    """محاسبه مشتریان خریدار/نخریدار برای یک محصول"""
-    try:
-        print(f"📊 Processing product: {product_code}")
-        
-        # تبدیل تاریخ
-        date_from_gregorian = None
-        date_to_gregorian = None
-        
-        if date_from and date_to:
-            if date_type == 'jalali':
-                date_from_gregorian = jalali_to_gregorian(date_from)
-                date_to_gregorian = jalali_to_gregorian(date_to)
-                
-                if not date_from_gregorian or not date_to_gregorian:
-                    print(f"⚠️ Invalid date format")
-                    date_from_gregorian = None
-                    date_to_gregorian = None
-            else:
-                date_from_gregorian = date_from
-                date_to_gregorian = date_to
-        
-        # فیلتر فروش
-        purchased_codes = []
-        product_sales = pd.DataFrame()
-        
-        if sales_df is not None and not sales_df.empty:
-            def convert_sale_date(date_value):
-                if pd.isna(date_value):
-                    return None
-                date_str = str(date_value).strip()
-                if '/' in date_str and len(date_str.split('/')) == 3:
-                    return jalali_to_gregorian(date_str)
-                elif '-' in date_str and len(date_str) == 10:
-                    return date_str
-                return None
-            
-            sales_copy = sales_df.copy()
-            sales_copy['DateConverted'] = sales_copy['InvoiceDate'].apply(convert_sale_date)
-            
-            # فیلتر بر اساس تاریخ
-            if date_from_gregorian and date_to_gregorian:
-                filtered_sales = sales_copy[
-                    (sales_copy['DateConverted'] >= date_from_gregorian) &
-                    (sales_copy['DateConverted'] <= date_to_gregorian)
-                ]
-                print(f"   📅 Filtered sales: {len(filtered_sales)} records")
-            else:
-                filtered_sales = sales_copy
-                print(f"   📅 All sales: {len(filtered_sales)} records")
-            
-            # فروش این محصول
-            product_sales = filtered_sales[filtered_sales['ProductCode'] == product_code]
-            purchased_codes = product_sales['CustomerCode'].unique().tolist()
-            
-            print(f"   💰 Product sales: {len(product_sales)} records, {len(purchased_codes)} unique customers")
-        else:
-            print(f"   ⚠️ No sales data available")
-        
-        # تفکیک مشتریان
-        purchased_customers = []
-        not_purchased_customers = []
-        
-        for _, customer in customers_df.iterrows():
-            customer_code = customer['CustomerCode']
-            customer_name = customer['CustomerName']
-            bazaryab_code = customer['BazaryabCode']
-            
-            # نام بازاریاب
-            bazaryab_name = "نامشخص"
-            if users_df is not None:
-                bazaryab = users_df[users_df['Codev'] == bazaryab_code]
-                if not bazaryab.empty:
-                    bazaryab_name = bazaryab.iloc[0]['Namev']
-            
-            # بررسی LocationSet
-            location_set = customer.get('LocationSet', False)
-            if pd.isna(location_set):
-                location_set = False
-            elif isinstance(location_set, str):
-                location_set = location_set.lower() in ['true', '1', 'yes', 'بله']
-            else:
-                location_set = bool(location_set)
-            
-            customer_data = {
-                'CustomerCode': str(customer_code),
-                'CustomerName': str(customer_name),
-                'BazaryabName': bazaryab_name,
-                'LocationSet': location_set
-            }
-            
-            if customer_code in purchased_codes:
-                # محاسبه آمار خرید
-                customer_sales = product_sales[product_sales['CustomerCode'] == customer_code]
-                
-                # محاسبه امن
-                total_qty = 0
-                total_amount = 0
-                
-                for _, sale in customer_sales.iterrows():
-                    qty = sale.get('Quantity', 0)
-                    amount = sale.get('TotalAmount', 0)
-                    
-                    if not pd.isna(qty):
-                        total_qty += int(qty)
-                    if not pd.isna(amount):
-                        total_amount += float(amount)
-                
-                # تاریخ‌های خرید
-                purchase_dates = []
-                for _, sale in customer_sales.iterrows():
-                    original_date = sale.get('InvoiceDate', '')
-                    
-                    if pd.isna(original_date):
-                        continue
-                    
-                    # تبدیل تاریخ برای نمایش
-                    date_str = str(original_date).strip()
-                    if '/' in date_str:
-                        display_date = date_str
-                    elif '-' in date_str and len(date_str) == 10:
-                        display_date = gregorian_to_jalali(date_str)
-                    else:
-                        display_date = date_str
-                    
-                    qty = sale.get('Quantity', 0)
-                    amount = sale.get('TotalAmount', 0)
-                    
-                    purchase_dates.append({
-                        'date': display_date,
-                        'quantity': int(qty) if not pd.isna(qty) else 0,
-                        'amount': int(amount) if not pd.isna(amount) else 0
-                    })
-                
-                customer_data.update({
-                    'TotalQuantity': int(total_qty),
-                    'TotalAmount': int(total_amount),
-                    'PurchaseDates': purchase_dates
-                })
-                purchased_customers.append(customer_data)
-            else:
-                not_purchased_customers.append(customer_data)
-        
-        print(f"   ✅ Result: {len(purchased_customers)} purchased, {len(not_purchased_customers)} not purchased")
-        
-        # تمیز کردن product_details از NaN
-        clean_product_details = {}
-        for key, value in product_details.items():
-            if pd.isna(value):
-                if key in ['Price', 'Stock']:
-                    clean_product_details[key] = 0
-                else:
-                    clean_product_details[key] = ""
-            else:
-                clean_product_details[key] = value
-        
-        return {
-            'product': clean_product_details,
-            'purchased_customers': purchased_customers,
-            'not_purchased_customers': not_purchased_customers,
-            'total_purchased': len(purchased_customers),
-            'total_not_purchased': len(not_purchased_customers)
-        }
-        
-    except Exception as e:
-        print(f"❌ Error in calculate_product_customers for {product_code}: {e}")
-        import traceback
-        traceback.print_exc()
-        
-        # برگرداندن نتیجه خالی در صورت خطا
-        return {
-            'product': product_details,
-            'purchased_customers': [],
-            'not_purchased_customers': [],
-            'total_purchased': 0,
-            'total_not_purchased': 0
-        }
-
 @app.route('/weekly_sales_report')
 def weekly_sales_report():
     """صفحه گزارش هفتگی فروش"""
@@ -6561,7 +8406,7 @@ def get_weekly_sales_report():
         
         # بارگذاری داده‌ها
         sales_df = load_sales_from_excel()
-        customers_df = load_customers_from_excel()
+        scope_index = get_customer_scope_index()
         
         if sales_df is None or sales_df.empty:
             return jsonify({'error': 'داده‌های فروش یافت نشد'}), 404
@@ -6570,13 +8415,15 @@ def get_weekly_sales_report():
         user_code = session['user_info']['Codev']
         user_type = session['user_info']['Typev']
         
-        if user_type != 'admin' and customers_df is not None:
+        # فروش‌های سال (برش از فروش کش‌شده با ستون‌های DayOrdinal و ماه شمسی)
+        year_sales = filter_by_jalali_range(year * 100 + 1, year * 100 + 12)
+        
+        if user_type != 'admin' and scope_index is not None:
             # فقط فروش‌های مشتریان این بازاریاب
-            my_customers = customers_df[customers_df['BazaryabCode'] == user_code]
-            customer_codes = my_customers['CustomerCode'].tolist()
-            filtered_sales = sales_df[sales_df['CustomerCode'].isin(customer_codes)]
+            customer_codes = scope_customer_codes(scope_index, user_code)
+            filtered_sales = year_sales[year_sales['CustomerCode'].isin(customer_codes)]
         else:
-            filtered_sales = sales_df
+            filtered_sales = year_sales
         
         # تولید گزارش هفتگی
         weekly_report = generate_weekly_sales_report(filtered_sales, year)
@@ -6590,50 +8437,30 @@ def get_weekly_sales_report():
         return jsonify({'error': f'خطای سرور: {str(e)}'}), 500
 
 def generate_weekly_sales_report(sales_df, year):
-    """تولید گزارش هفتگی فروش - هفته‌ها از شنبه شروع می‌شوند"""
-    try:
-        # نام ماه‌های شمسی
-        month_names = [
-            'فروردین', 'اردیبهشت', 'خرداد', 'تیر', 'مرداد', 'شهریور',
-            'مهر', 'آبان', 'آذر', 'دی', 'بهمن', 'اسفند'
-        ]
-        
-        # نام روزهای هفته
-        day_names = ['شنبه', 'یکشنبه', 'دوشنبه', 'سه‌شنبه', 'چهارشنبه', 'پنج‌شنبه', 'جمعه']
-        
-        # تبدیل تاریخ‌های فروش
-        def parse_sale_date(date_value):
-            if pd.isna(date_value):
-                return None
-            
-            date_str = str(date_value).strip()
-            
-            try:
-                # اگر شمسی است
-                if '/' in date_str and len(date_str.split('/')) == 3:
-                    parts = date_str.split('/')
-                    return jdatetime.date(int(parts[0]), int(parts[1]), int(parts[2]))
-                # اگر میلادی است
-                elif '-' in date_str and len(date_str) == 10:
-                    gregorian_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-                    return jdatetime.date.fromgregorian(date=gregorian_date)
-            except:
-                return None
-            
-            return None
-        
-        # اضافه کردن ستون تاریخ پارس شده
-        sales_df['ParsedDate'] = sales_df['InvoiceDate'].apply(parse_sale_date)
+    """
+    تولید گزارش هفتگی فروش - هفته‌ها از شنبه شروع می‌شوند
+
+    جمع و تعداد فاکتور هر روز با یک groupby روی DayOrdinal محاسبه می‌شود؛
+    هفته‌ها و ماه‌ها از همان جمع روزانه و چیدمان تقویم ساخته می‌شوند.
+    """
+    try:
+        # ستون‌های تاریخ از ایندکس فروش؛ در غیر این صورت تبدیل برداری
+        if not {'DayOrdinal', 'JalaliYear', 'JalaliMonth'} <= set(sales_df.columns):
+            sale_dates = convert_date_column(sales_df['InvoiceDate'])
+            sales_df = sales_df.assign(
+                DayOrdinal=sale_dates['DayOrdinal'],
+                JalaliYear=sale_dates['JalaliYear'],
+                JalaliMonth=sale_dates['JalaliMonth']
+            )
         
-        # فیلتر فروش‌های سال مورد نظر
-        year_sales = sales_df[
-            (sales_df['ParsedDate'].notna()) &
-            (sales_df['ParsedDate'].apply(lambda x: x.year if x else 0) == year)
-        ].copy()
+        # فیلتر فروش‌های سال مورد نظر (فقط دو ستون لازم)
+        in_year = sales_df['JalaliYear'].to_numpy() == year
+        year_ordinals = sales_df['DayOrdinal'].to_numpy()[in_year]
+        amounts = sales_df['TotalAmount'].fillna(0).to_numpy()[in_year]
         
-        print(f"   Found {len(year_sales)} sales for year {year}")
+        print(f"   Found {len(year_ordinals)} sales for year {year}")
         
-        if year_sales.empty:
+        if len(year_ordinals) == 0:
             return {
                 'summary': {
                     'total_sales': 0,
@@ -6645,130 +8472,48 @@ def generate_weekly_sales_report(sales_df, year):
             }
         
         # محاسبه آمار کلی
-        total_sales = int(year_sales['TotalAmount'].fillna(0).sum())
-        total_invoices = len(year_sales)
+        total_sales = int(amounts.sum())
+        total_invoices = len(year_ordinals)
+        
+        # جمع و تعداد فاکتور هر روز (یک groupby) و جمع ماه‌ها از روی آن
+        day_stats = pd.Series(amounts).groupby(year_ordinals).agg(['sum', 'size'])
+        day_amounts = dict(zip(day_stats.index, day_stats['sum'].astype('int64')))
+        day_invoices = dict(zip(day_stats.index, day_stats['size']))
+        month_stats = day_stats.groupby(ordinal_to_jalali_parts(day_stats.index)[1]).sum()
         
         # تولید گزارش ماه به ماه
         months_data = []
         total_weeks = 0
         
-        # حلقه روی ماه‌ها
-        for month_num in range(1, 13):
-            month_name = month_names[month_num - 1]
-            
-            # فروش‌های این ماه
-            month_sales = year_sales[
-                year_sales['ParsedDate'].apply(lambda x: x.month if x else 0) == month_num
-            ].copy()
-            
-            if month_sales.empty:
-                continue
-            
-            # محاسبه آمار ماه
-            month_total = int(month_sales['TotalAmount'].fillna(0).sum())
-            month_invoices = len(month_sales)
-            
-            # تعیین تعداد روزهای ماه
-            days_in_month = 31 if month_num <= 6 else 30
-            if month_num == 12:
-                # بررسی سال کبیسه
-                try:
-                    jdatetime.date(year, 12, 30)
-                    days_in_month = 30
-                except:
-                    days_in_month = 29
-            
-            # پیدا کردن اولین شنبه ماه
-            first_saturday = None
-            for day in range(1, days_in_month + 1):
-                try:
-                    current_date = jdatetime.date(year, month_num, day)
-                    if current_date.weekday() == 0:  # 0 = شنبه
-                        first_saturday = day
-                        break
-                except:
-                    continue
-            
-            if first_saturday is None:
-                continue
-            
-            # تقسیم به هفته‌ها (هر هفته از شنبه شروع می‌شود)
+        for month_num in month_stats.index:
+            # هفته‌های ماه از جدول تقویم (هر هفته از شنبه شروع می‌شود)
             weeks_data = []
-            week_num = 1
-            current_day = first_saturday
-            
-            while current_day <= days_in_month:
-                week_name = f"هفته {week_num}"
-                week_days = []
-                week_total = 0
-                week_invoices = 0
-                
-                # 7 روز برای هر هفته (شنبه تا جمعه)
-                for day_offset in range(7):
-                    day = current_day + day_offset
-                    
-                    # بررسی اینکه آیا روز در همین ماه است یا ماه بعد
-                    try:
-                        if day <= days_in_month:
-                            # روز در همین ماه است
-                            current_date = jdatetime.date(year, month_num, day)
-                            is_next_month = False
-                        else:
-                            # روز در ماه بعد است
-                            next_month = month_num + 1 if month_num < 12 else 1
-                            next_year = year if month_num < 12 else year + 1
-                            next_month_day = day - days_in_month
-                            
-                            try:
-                                current_date = jdatetime.date(next_year, next_month, next_month_day)
-                                is_next_month = True
-                            except:
-                                break
-                        
-                        day_of_week = current_date.weekday()  # 0=شنبه, 6=جمعه
-                        day_name = day_names[day_of_week]
-                        
-                        # فروش‌های این روز
-                        day_sales = year_sales[
-                            year_sales['ParsedDate'] == current_date
-                        ]
-                        
-                        day_amount = int(day_sales['TotalAmount'].fillna(0).sum())
-                        day_invoices = len(day_sales)
-                        
-                        week_total += day_amount
-                        week_invoices += day_invoices
-                        
-                        week_days.append({
-                            'day_name': day_name,
-                            'date': current_date.strftime('%Y/%m/%d'),
-                            'sales_amount': day_amount,
-                            'invoice_count': day_invoices,
-                            'is_next_month': is_next_month
-                        })
-                        
-                    except Exception as e:
-                        print(f"   Error processing day {day}: {e}")
-                        break
-                
-                if week_days:
-                    weeks_data.append({
-                        'week_name': week_name,
-                        'week_total': week_total,
-                        'week_invoices': week_invoices,
-                        'days': week_days
-                    })
-                    week_num += 1
-                    total_weeks += 1
+            
+            for week_layout in get_month_week_layout(year, int(month_num)):
+                week_days = [
+                    {
+                        'day_name': day_info['day_name'],
+                        'date': day_info['date'],
+                        'sales_amount': int(day_amounts.get(day_info['ordinal'], 0)),
+                        'invoice_count': int(day_invoices.get(day_info['ordinal'], 0)),
+                        'is_next_month': day_info['is_next_month']
+                    }
+                    for day_info in week_layout
+                ]
                 
-                # رفتن به شنبه بعدی
-                current_day += 7
+                weeks_data.append({
+                    'week_name': f"هفته {len(weeks_data) + 1}",
+                    'week_total': sum(day['sales_amount'] for day in week_days),
+                    'week_invoices': sum(day['invoice_count'] for day in week_days),
+                    'days': week_days
+                })
+                total_weeks += 1
             
             if weeks_data:
                 months_data.append({
-                    'month_name': month_name,
-                    'month_total': month_total,
-                    'month_invoices': month_invoices,
+                    'month_name': JALALI_MONTH_NAMES[int(month_num) - 1],
+                    'month_total': int(month_stats.at[month_num, 'sum']),
+                    'month_invoices': int(month_stats.at[month_num, 'size']),
                     'weeks': weeks_data
                 })
         
@@ -6863,72 +8608,72 @@ def get_weekly_visit_report():
         traceback.print_exc()
         return jsonify({'error': f'خطای سرور: {str(e)}'}), 500
 
-def generate_weekly_visit_report(reports_df, customers_df, year, selected_months):
-    """تولید گزارش هفتگی ویزیت - هر هفته از شنبه شروع می‌شود"""
-    try:
-        month_names = [
-            '', 'فروردین', 'اردیبهشت', 'خرداد', 'تیر', 'مرداد', 'شهریور',
-            'مهر', 'آبان', 'آذر', 'دی', 'بهمن', 'اسفند'
-        ]
-        
-        day_names = ['شنبه', 'یکشنبه', 'دوشنبه', 'سه‌شنبه', 'چهارشنبه', 'پنج‌شنبه', 'جمعه']
-        
-        # تبدیل تاریخ‌های ویزیت
-        def parse_visit_date(date_value):
-            if pd.isna(date_value):
-                return None
+VISIT_UNKNOWN_TIME = "نامشخص"
+VISIT_UNKNOWN_MINUTE = 24 * 60  # زمان نامشخص بعد از همه زمان‌های روز
+
+
+def normalize_visit_times(time_values):
+    """
+    زمان ویزیت‌ها به رشته HH:MM و دقیقه از ابتدای روز - تبدیل فقط روی مقادیر یکتا
+
+    Returns:
+        DataFrame با ستون‌های ParsedTime و MinuteOfDay (هم‌ایندکس ورودی)
+    """
+    def parse_visit_time(time_value):
+        try:
+            time_str = str(time_value).strip()
             
-            date_str = str(date_value).strip()
+            # اگر datetime است
+            if isinstance(time_value, datetime):
+                return time_value.strftime('%H:%M')
             
-            try:
-                if '/' in date_str and len(date_str.split('/')) == 3:
-                    parts = date_str.split('/')
-                    return jdatetime.date(int(parts[0]), int(parts[1]), int(parts[2]))
-                elif '-' in date_str and len(date_str) >= 10:
-                    # اگر datetime است، فقط تاریخ را بگیر
-                    date_part = date_str[:10]
-                    gregorian_date = datetime.strptime(date_part, '%Y-%m-%d').date()
-                    return jdatetime.date.fromgregorian(date=gregorian_date)
-            except:
-                return None
+            # اگر time است
+            if hasattr(time_value, 'hour'):
+                return f"{time_value.hour:02d}:{time_value.minute:02d}"
             
-            return None
-        
-        # تبدیل زمان ویزیت
-        def parse_visit_time(time_value):
-            if pd.isna(time_value):
-                return "نامشخص"
+            # اگر string است
+            if ':' in time_str:
+                parts = time_str.split(':')
+                if len(parts) >= 2:
+                    return f"{parts[0].zfill(2)}:{parts[1].zfill(2)}"
             
-            try:
-                time_str = str(time_value).strip()
-                
-                # اگر datetime است
-                if isinstance(time_value, datetime):
-                    return time_value.strftime('%H:%M')
-                
-                # اگر time است
-                if hasattr(time_value, 'hour'):
-                    return f"{time_value.hour:02d}:{time_value.minute:02d}"
-                
-                # اگر string است
-                if ':' in time_str:
-                    parts = time_str.split(':')
-                    if len(parts) >= 2:
-                        return f"{parts[0].zfill(2)}:{parts[1].zfill(2)}"
-                
-                return "نامشخص"
-            except:
-                return "نامشخص"
-        
-        reports_df['ParsedDate'] = reports_df['VisitDate'].apply(parse_visit_date)
-        reports_df['ParsedTime'] = reports_df['VisitTime'].apply(parse_visit_time)
+            return VISIT_UNKNOWN_TIME
+        except:
+            return VISIT_UNKNOWN_TIME
+    
+    def minute_of_day(parsed_time):
+        try:
+            hour, minute = parsed_time.split(':')[:2]
+            return int(hour) * 60 + int(minute)
+        except ValueError:
+            return VISIT_UNKNOWN_MINUTE
+    
+    codes, uniques = pd.factorize(time_values)
+    parsed = np.array([parse_visit_time(value) for value in uniques] + [VISIT_UNKNOWN_TIME], dtype=object)
+    minutes = np.array([minute_of_day(value) for value in parsed], dtype=np.int64)
+    
+    # کد -1 (مقدار خالی) به ردیف آخر (نامشخص) اشاره می‌کند
+    return pd.DataFrame({
+        'ParsedTime': parsed[codes],
+        'MinuteOfDay': minutes[codes]
+    }, index=time_values.index)
+
+
+def generate_weekly_visit_report(reports_df, customers_df, year, selected_months):
+    """
+    تولید گزارش هفتگی ویزیت - هر هفته از شنبه شروع می‌شود
+
+    تاریخ و زمان ویزیت‌ها یک بار (شماره روز + دقیقه روز) نرمال می‌شوند، نام مشتری
+    با یک merge اضافه می‌شود و ویزیت‌ها یک بار بر اساس روز و زمان مرتب می‌شوند.
+    """
+    try:
+        # تبدیل تاریخ‌های ویزیت به شماره روز و سال/ماه شمسی (برداری)
+        visit_dates = convert_date_column(reports_df['VisitDate'])
+        in_period = (visit_dates['JalaliYear'] == year) & (visit_dates['JalaliMonth'].isin(selected_months))
         
         # فیلتر گزارش‌های سال و ماه‌های مورد نظر
-        filtered_reports = reports_df[
-            (reports_df['ParsedDate'].notna()) &
-            (reports_df['ParsedDate'].apply(lambda x: x.year if x else 0) == year) &
-            (reports_df['ParsedDate'].apply(lambda x: x.month if x else 0).isin(selected_months))
-        ].copy()
+        filtered_reports = reports_df[in_period]
+        visit_dates = visit_dates[in_period]
         
         print(f"   Found {len(filtered_reports)} visits for year {year}, months {selected_months}")
         
@@ -6947,132 +8692,78 @@ def generate_weekly_visit_report(reports_df, customers_df, year, selected_months
         total_visits = len(filtered_reports)
         unique_customers = filtered_reports['CustomerCode'].nunique()
         
+        visit_times = normalize_visit_times(filtered_reports['VisitTime'])
+        
+        if 'VisitType' in filtered_reports.columns:
+            visit_types = filtered_reports['VisitType'].fillna('').astype(str)
+            visit_types = visit_types.where(visit_types != '', VISIT_UNKNOWN_TIME)
+        else:
+            visit_types = pd.Series(VISIT_UNKNOWN_TIME, index=filtered_reports.index)
+        
+        visits = pd.DataFrame({
+            'DayOrdinal': visit_dates['DayOrdinal'].to_numpy(),
+            'JalaliMonth': visit_dates['JalaliMonth'].to_numpy(),
+            'CustomerCode': filtered_reports['CustomerCode'].to_numpy(),
+            'ParsedTime': visit_times['ParsedTime'].to_numpy(),
+            'MinuteOfDay': visit_times['MinuteOfDay'].to_numpy(),
+            'VisitType': visit_types.to_numpy()
+        })
+        
+        # نام مشتریان با یک merge (کد خالی یا ناشناخته: نامشخص)
+        if customers_df is not None:
+            customer_names = customers_df.drop_duplicates('CustomerCode')[['CustomerCode', 'CustomerName']]
+            customer_names = customer_names.assign(CustomerName=customer_names['CustomerName'].astype(str))
+            visits = visits.merge(customer_names, on='CustomerCode', how='left')
+        else:
+            visits['CustomerName'] = np.nan
+        has_code = visits['CustomerCode'].notna() & (visits['CustomerCode'].astype(str) != '')
+        visits['CustomerName'] = visits['CustomerName'].where(has_code).fillna(VISIT_UNKNOWN_TIME)
+        
+        # ویزیت‌های هر روز به ترتیب زمان (مرتب‌سازی پایدار یک‌باره)
+        visits = visits.sort_values(['DayOrdinal', 'MinuteOfDay'], kind='stable')
+        day_visits = defaultdict(list)
+        for ordinal, visit_time, customer_name, visit_type in zip(
+                visits['DayOrdinal'], visits['ParsedTime'], visits['CustomerName'], visits['VisitType']):
+            day_visits[ordinal].append({
+                'time': visit_time,
+                'customer_name': customer_name,
+                'visit_type': visit_type
+            })
+        month_visit_counts = visits['JalaliMonth'].value_counts()
+        
         # تولید گزارش ماه به ماه
         months_data = []
         total_weeks = 0
         
         for month_num in selected_months:
-            month_name = month_names[month_num]
-            
-            # گزارش‌های این ماه
-            month_reports = filtered_reports[
-                filtered_reports['ParsedDate'].apply(lambda x: x.month if x else 0) == month_num
-            ].copy()
-            
-            if month_reports.empty:
-                continue
-            
-            month_visits = len(month_reports)
-            
-            # تعیین تعداد روزهای ماه
-            days_in_month = 31 if month_num <= 6 else 30
-            if month_num == 12:
-                try:
-                    jdatetime.date(year, 12, 30)
-                    days_in_month = 30
-                except:
-                    days_in_month = 29
-            
-            # پیدا کردن اولین شنبه ماه
-            first_saturday = None
-            for day in range(1, days_in_month + 1):
-                try:
-                    current_date = jdatetime.date(year, month_num, day)
-                    if current_date.weekday() == 0:
-                        first_saturday = day
-                        break
-                except:
-                    continue
-            
-            if first_saturday is None:
+            month_visits = int(month_visit_counts.get(month_num, 0))
+            if month_visits == 0:
                 continue
             
-            # تقسیم به هفته‌ها
+            # هفته‌های ماه از جدول تقویم
             weeks_data = []
-            week_num = 1
-            current_day = first_saturday
             
-            while current_day <= days_in_month:
-                week_name = f"هفته {week_num}"
-                week_days = []
-                week_visits = 0
-                
-                for day_offset in range(7):
-                    day = current_day + day_offset
-                    
-                    try:
-                        if day <= days_in_month:
-                            current_date = jdatetime.date(year, month_num, day)
-                            is_next_month = False
-                        else:
-                            next_month = month_num + 1 if month_num < 12 else 1
-                            next_year = year if month_num < 12 else year + 1
-                            next_month_day = day - days_in_month
-                            
-                            try:
-                                current_date = jdatetime.date(next_year, next_month, next_month_day)
-                                is_next_month = True
-                            except:
-                                break
-                        
-                        day_of_week = current_date.weekday()
-                        day_name = day_names[day_of_week]
-                        
-                        # ویزیت‌های این روز
-                        day_reports = filtered_reports[
-                            filtered_reports['ParsedDate'] == current_date
-                        ]
-                        
-                        visits_list = []
-                        for _, report in day_reports.iterrows():
-                            customer_name = "نامشخص"
-                            customer_code = report.get('CustomerCode', '')
-                            
-                            if customer_code and customers_df is not None:
-                                customer_row = customers_df[customers_df['CustomerCode'] == customer_code]
-                                if not customer_row.empty:
-                                    customer_name = str(customer_row.iloc[0]['CustomerName'])
-                            
-                            visit_type = report.get('VisitType', 'نامشخص')
-                            if pd.isna(visit_type) or visit_type == '':
-                                visit_type = 'نامشخص'
-                            
-                            visits_list.append({
-                                'time': report['ParsedTime'],
-                                'customer_name': customer_name,
-                                'visit_type': str(visit_type)
-                            })
-                        
-                        # مرتب‌سازی بر اساس زمان
-                        visits_list.sort(key=lambda x: x['time'])
-                        
-                        week_visits += len(visits_list)
-                        
-                        week_days.append({
-                            'day_name': day_name,
-                            'date': current_date.strftime('%Y/%m/%d'),
-                            'is_next_month': is_next_month,
-                            'visits': visits_list
-                        })
-                        
-                    except Exception as e:
-                        print(f"   Error processing day {day}: {e}")
-                        break
-                
-                if week_days:
-                    weeks_data.append({
-                        'week_name': week_name,
-                        'week_visits': week_visits,
-                        'days': week_days
-                    })
-                    week_num += 1
-                    total_weeks += 1
+            for week_layout in get_month_week_layout(year, month_num):
+                week_days = [
+                    {
+                        'day_name': day_info['day_name'],
+                        'date': day_info['date'],
+                        'is_next_month': day_info['is_next_month'],
+                        'visits': list(day_visits.get(day_info['ordinal'], []))
+                    }
+                    for day_info in week_layout
+                ]
                 
-                current_day += 7
+                weeks_data.append({
+                    'week_name': f"هفته {len(weeks_data) + 1}",
+                    'week_visits': sum(len(day['visits']) for day in week_days),
+                    'days': week_days
+                })
+                total_weeks += 1
             
             if weeks_data:
                 months_data.append({
-                    'month_name': month_name,
+                    'month_name': JALALI_MONTH_NAMES[month_num - 1],
                     'month_visits': month_visits,
                     'weeks': weeks_data
                 })
@@ -7113,11 +8804,10 @@ def get_reports_data():
             return jsonify({'error': 'لطفاً وارد شوید'}), 401
         
         # بارگذاری داده‌ها
-        customers_df = load_customers_from_excel()
+        scope_index = get_customer_scope_index()
         reports_df = load_reports_from_excel()
-        users_df = load_users_from_excel()
         
-        if customers_df is None:
+        if scope_index is None:
             return jsonify({'error': 'خطا در بارگذاری مشتریان'}), 500
         
         # فیلتر بر اساس کاربر
@@ -7125,18 +8815,22 @@ def get_reports_data():
         user_type = session['user_info']['Typev']
         
         if user_type != 'admin':
-            my_customers = customers_df[customers_df['BazaryabCode'] == user_code]
+            my_customers = scope_customers(scope_index, user_code)
         else:
-            my_customers = customers_df
+            my_customers = scope_customers(scope_index)
         
         # تبدیل به لیست
-        customers_list = []
-        for _, customer in my_customers.iterrows():
-            customers_list.append({
-                'CustomerCode': str(customer['CustomerCode']),
-                'CustomerName': str(customer['CustomerName']),
-                'LocationSet': bool(customer.get('LocationSet', False))
-            })
+        location_sets = (my_customers['LocationSet'] if 'LocationSet' in my_customers.columns
+                         else pd.Series(False, index=my_customers.index))
+        customers_list = [
+            {
+                'CustomerCode': str(customer_code),
+                'CustomerName': str(customer_name),
+                'LocationSet': bool(location_set)
+            }
+            for customer_code, customer_name, location_set in zip(
+                my_customers['CustomerCode'], my_customers['CustomerName'], location_sets)
+        ]
         
         # بارگذاری گزارش‌ها
         reports_list = []
@@ -7167,21 +8861,16 @@ def get_reports_data():
                 else:
                     time_str = ''
                 
-                # یافتن نام مشتری
+                # یافتن نام مشتری و بازاریاب (از محدوده مشتریان)
                 customer_name = ''
                 customer_code = report.get('CustomerCode', '')
                 if customer_code:
-                    customer_row = customers_df[customers_df['CustomerCode'] == customer_code]
-                    if not customer_row.empty:
-                        customer_name = customer_row.iloc[0]['CustomerName']
+                    customer_name = scope_index['customer_names'].get(customer_code, '')
                 
-                # یافتن نام بازاریاب
                 bazaryab_name = ''
                 bazaryab_code = report.get('BazaryabCode', '')
-                if bazaryab_code and users_df is not None:
-                    user_row = users_df[users_df['Codev'] == bazaryab_code]
-                    if not user_row.empty:
-                        bazaryab_name = user_row.iloc[0]['Namev']
+                if bazaryab_code:
+                    bazaryab_name = scope_index['salesperson_names'].get(bazaryab_code, '')
                 
                 # نوع ویزیت
                 visit_type = report.get('VisitType', '')
@@ -7221,9 +8910,12 @@ def load_reports_from_excel():
             print(f"⚠️ Visits file not found: {reports_file}")
             return None
         
-        df = pd.read_excel(reports_file)
-        print(f"✅ Visits loaded: {len(df)} records")
-        return df
+        def read_reports():
+            df = pd.read_excel(reports_file)
+            print(f"✅ Visits loaded: {len(df)} records")
+            return df
+        
+        return load_cached_dataset(reports_file, 0, read_reports)
         
     except Exception as e:
         print(f"❌ Error loading visits: {e}")
@@ -7291,28 +8983,34 @@ def load_messages():
     try:
         init_chat_files()
         
-        if not os.path.exists(MESSAGES_FILE):
+        if not is_sqlite_storage() and not os.path.exists(MESSAGES_FILE):
             return pd.DataFrame()
         
-        df = pd.read_excel(MESSAGES_FILE, sheet_name='messages')
+        def read_messages():
+            df = load_all_messages()
         
-        # پاک کردن NaN
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].fillna('')
-            elif df[col].dtype in ['int64', 'float64']:
-                df[col] = df[col].fillna(0)
+            # پاک کردن NaN
+            for col in df.columns:
+                if df[col].dtype == 'object':
+                    df[col] = df[col].fillna('')
+                elif df[col].dtype in ['int64', 'float64']:
+                    df[col] = df[col].fillna(0)
         
-        # ✅ اصلاح: فیلتر پیام‌های حذف نشده
-        if not df.empty and 'IsDeleted' in df.columns:
-            # تبدیل به boolean صریح
-            df['IsDeleted'] = df['IsDeleted'].fillna(False).astype(bool)
-            # فیلتر: فقط پیام‌های حذف نشده
-            df = df[~df['IsDeleted']]  # ← استفاده از ~ به جای == False
+            # ✅ اصلاح: فیلتر پیام‌های حذف نشده
+            if not df.empty and 'IsDeleted' in df.columns:
+                # تبدیل به boolean صریح
+                df['IsDeleted'] = df['IsDeleted'].fillna(False).astype(bool)
+                # فیلتر: فقط پیام‌های حذف نشده
+                df = df[~df['IsDeleted']]  # ← استفاده از ~ به جای == False
         
-        print(f"✅ بارگذاری پیام‌ها: {len(df)} پیام")
+            print(f"✅ بارگذاری پیام‌ها: {len(df)} پیام")
         
-        return df
+            return df
+
+        if is_sqlite_storage():
+            return read_messages()
+        
+        return load_cached_dataset(MESSAGES_FILE, 'messages', read_messages)
         
     except Exception as e:
         print(f"❌ خطا در بارگذاری پیام‌ها: {e}")
@@ -7321,18 +9019,37 @@ def load_messages():
         return pd.DataFrame()
 
 
+def load_all_messages():
+    """خواندن همه پیام‌ها (شامل حذف شده‌ها)"""
+    if is_sqlite_storage():
+        return load_storage_table('messages')
+    return pd.read_excel(MESSAGES_FILE, sheet_name='messages')
+
+
 def save_messages(df):
     """ذخیره پیام‌ها"""
     try:
+        if is_sqlite_storage():
+            return save_storage_table('messages', df)
+        
         df.to_excel(MESSAGES_FILE, sheet_name='messages', index=False)
         return True
     except Exception as e:
         print(f"❌ خطا در ذخیره پیام‌ها: {e}")
         return False
 
+def next_sqlite_message_id(conn):
+    """شناسه پیام بعدی در SQLite (داخل تراکنش درج صدا زده شود)"""
+    max_id = conn.execute('SELECT MAX(CAST("MessageID" AS INTEGER)) FROM messages').fetchone()[0]
+    return int(max_id) + 1 if max_id is not None else 1
+
+
 def get_next_message_id():
     """دریافت شناسه پیام بعدی"""
     try:
+        if is_sqlite_storage():
+            return next_sqlite_message_id(get_sqlite_connection())
+        
         if not os.path.exists(MESSAGES_FILE):
             return 1
         
@@ -7521,22 +9238,32 @@ def chat_send_message():
             'AttachmentSize': attachment_size
         }])
         
-        # خواندن همه پیام‌ها (شامل حذف شده‌ها)
-        try:
-            all_messages = pd.read_excel(MESSAGES_FILE, sheet_name='messages')
-            messages_df = pd.concat([all_messages, new_message], ignore_index=True)
-        except:
-            messages_df = new_message
+        if is_sqlite_storage():
+            # شناسه پیام در همان تراکنش درج گرفته می‌شود تا دو worker شناسه تکراری نگیرند
+            message_id = append_storage_row_with_id(
+                'messages', new_message.to_dict('records')[0], 'MessageID', next_sqlite_message_id
+            )
+            saved = message_id is not None
+        else:
+            # خواندن همه پیام‌ها (شامل حذف شده‌ها)
+            try:
+                all_messages = pd.read_excel(MESSAGES_FILE, sheet_name='messages')
+                messages_df = pd.concat([all_messages, new_message], ignore_index=True)
+            except:
+                messages_df = new_message
+            
+            saved = save_messages(messages_df)
+            message_id = new_message.iloc[0]['MessageID']
         
         # ذخیره
-        if save_messages(messages_df):
+        if saved:
             update_user_activity(user['Codev'], user['Namev'])
             
             print(f"✅ پیام ارسال شد: {user['Namev']} - {message[:30]}")
             
             return jsonify({
                 'success': True,
-                'message_id': int(new_message.iloc[0]['MessageID'])
+                'message_id': int(message_id)
             })
         else:
             return jsonify({'success': False, 'error': 'خطا در ذخیره پیام'}), 500
@@ -7573,7 +9300,7 @@ def chat_edit_message():
         user = session.get('user_info')
         
         # بارگذاری پیام‌ها (شامل حذف شده‌ها)
-        messages_df = pd.read_excel(MESSAGES_FILE, sheet_name='messages')
+        messages_df = load_all_messages()
         
         # پیدا کردن پیام
         if message_id not in messages_df['MessageID'].values:
@@ -7584,12 +9311,15 @@ def chat_edit_message():
         if str(msg_sender).strip() != str(user['Codev']).strip():
             return jsonify({'success': False, 'error': 'شما مجاز به ویرایش این پیام نیستید'}), 403
         
-        # ویرایش
-        messages_df.loc[messages_df['MessageID'] == message_id, 'MessageText'] = new_text
-        messages_df.loc[messages_df['MessageID'] == message_id, 'IsEdited'] = True
+        # ویرایش و ذخیره (در SQLite فقط همان ردیف، تا پیام‌های ثبت‌شده در این فاصله از بین نروند)
+        if is_sqlite_storage():
+            saved = update_storage_rows('messages', 'MessageID', message_id, {'MessageText': new_text, 'IsEdited': True})
+        else:
+            messages_df.loc[messages_df['MessageID'] == message_id, 'MessageText'] = new_text
+            messages_df.loc[messages_df['MessageID'] == message_id, 'IsEdited'] = True
+            saved = save_messages(messages_df)
         
-        # ذخیره
-        if save_messages(messages_df):
+        if saved:
             print(f"✅ پیام {message_id} ویرایش شد")
             return jsonify({'success': True})
         else:
@@ -7622,7 +9352,7 @@ def chat_delete_message():
         print(f"🗑️ درخواست حذف پیام {message_id} توسط {user['Namev']}")
         
         # بارگذاری پیام‌ها (شامل حذف شده‌ها)
-        messages_df = pd.read_excel(MESSAGES_FILE, sheet_name='messages')
+        messages_df = load_all_messages()
         
         # پیدا کردن پیام
         if message_id not in messages_df['MessageID'].values:
@@ -7636,11 +9366,14 @@ def chat_delete_message():
         if not is_owner and not is_admin:
             return jsonify({'success': False, 'error': 'شما مجاز به حذف این پیام نیستید'}), 403
         
-        # علامت‌گذاری به عنوان حذف شده
-        messages_df.loc[messages_df['MessageID'] == message_id, 'IsDeleted'] = True
+        # علامت‌گذاری به عنوان حذف شده و ذخیره (در SQLite فقط همان ردیف)
+        if is_sqlite_storage():
+            saved = update_storage_rows('messages', 'MessageID', message_id, {'IsDeleted': True})
+        else:
+            messages_df.loc[messages_df['MessageID'] == message_id, 'IsDeleted'] = True
+            saved = save_messages(messages_df)
         
-        # ذخیره
-        if save_messages(messages_df):
+        if saved:
             print(f"✅ پیام {message_id} حذف شد")
             return jsonify({'success': True})
         else:
@@ -7750,9 +9483,7 @@ def filter_duplicate_products_in_analysis(sold_by_me, sold_by_others, not_sold):
     """
     فیلتر محصولات تکراری (رسمی/غیررسمی) در گزارش عملکرد
     
-    فرمت کدها:
-    - رسمی: P991234 (P + 99 + کد پایه)
-    - غیررسمی: P1234 (P + کد پایه)
+    کد پایه هر کالا از split_product_variant_codes خوانده می‌شود.
     
     منطق:
     1. اگر محصول رسمی یا غیررسمی فروخته شد → هر دو از "نفروخته‌ها" و "از دست رفته‌ها" حذف شوند
@@ -7768,174 +9499,41 @@ def filter_duplicate_products_in_analysis(sold_by_me, sold_by_others, not_sold):
         tuple: (sold_by_me_filtered, sold_by_others_filtered, not_sold_filtered)
     """
     
-    print("\n" + "="*70)
-    print("🔍 شروع فیلتر محصولات تکراری در گزارش عملکرد (فرمت P99...)")
-    print("="*70)
-    
-    # =====================================
-    # تابع کمکی برای استخراج کد پایه
-    # =====================================
-    def get_base_code(code):
-        """استخراج کد پایه از کد محصول"""
-        code = str(code).strip().upper()
-        
-        # اگر با P شروع نمی‌شود
-        if not code.startswith('P'):
-            return code, code, False
-        
-        # حذف P از ابتدا
-        code_without_p = code[1:]
-        
-        # بررسی رسمی یا غیررسمی
-        if code_without_p.startswith('99') and len(code_without_p) > 2:
-            # رسمی (P99...)
-            base_code = code_without_p[2:]  # حذف 99
-            is_official = True
-        else:
-            # غیررسمی (P...)
-            base_code = code_without_p
-            is_official = False
-        
-        return code, base_code, is_official
-    
-    # =====================================
-    # مرحله 1: ساخت مجموعه کدهای پایه فروخته شده توسط من
-    # =====================================
-    my_sold_base_codes = set()
-    
-    for product in sold_by_me:
-        code = str(product.get('product_code', '')).strip()
-        original_code, base_code, is_official = get_base_code(code)
-        my_sold_base_codes.add(base_code)
-    
-    print(f"\n📊 محصولات فروخته شده توسط من:")
-    print(f"   تعداد کل: {len(sold_by_me)}")
-    print(f"   کدهای پایه یکتا: {len(my_sold_base_codes)}")
-    print(f"   نمونه کدهای پایه: {list(my_sold_base_codes)[:5]}")
-    
-    # =====================================
-    # مرحله 2: فیلتر "فرصت‌های از دست رفته"
-    # =====================================
-    # حذف محصولاتی که من فروخته‌ام (هر دو نسخه رسمی/غیررسمی)
-    
-    filtered_sold_by_others = []
-    removed_from_others = 0
-    
-    for product in sold_by_others:
-        code = str(product.get('product_code', '')).strip()
-        original_code, base_code, is_official = get_base_code(code)
-        
-        # اگر این محصول (رسمی یا غیررسمی) توسط من فروخته نشده
-        if base_code not in my_sold_base_codes:
-            filtered_sold_by_others.append(product)
-        else:
-            removed_from_others += 1
-            print(f"   ❌ حذف از 'از دست رفته': {original_code} (کد پایه: {base_code}) - چون من فروخته‌ام")
-    
-    print(f"\n⚠️ فرصت‌های از دست رفته:")
-    print(f"   قبل از فیلتر: {len(sold_by_others)}")
-    print(f"   حذف شده (چون من فروختم): {removed_from_others}")
-    print(f"   بعد از فیلتر: {len(filtered_sold_by_others)}")
-    
-    # =====================================
-    # مرحله 3: فیلتر "فرصت‌های فروش جدید" (نفروخته‌ها)
-    # =====================================
-    
-    # گروه‌بندی بر اساس کد پایه
-    not_sold_grouped = defaultdict(list)
-    
-    for product in not_sold:
-        code = str(product.get('product_code', '')).strip()
-        original_code, base_code, is_official = get_base_code(code)
-        
-        # اگر این محصول توسط من فروخته نشده
-        if base_code not in my_sold_base_codes:
-            not_sold_grouped[base_code].append({
-                'product': product,
-                'code': original_code,
-                'base_code': base_code,
-                'is_official': is_official,
-                'price': float(product.get('price', 0))
-            })
-    
-    print(f"\n🎯 فرصت‌های فروش جدید:")
-    print(f"   قبل از فیلتر: {len(not_sold)}")
-    print(f"   بعد از حذف فروخته‌ها: {sum(len(v) for v in not_sold_grouped.values())}")
-    print(f"   کدهای پایه یکتا: {len(not_sold_grouped)}")
-    
-    # انتخاب یکی از رسمی/غیررسمی
-    filtered_not_sold = []
-    
-    for base_code, variants in not_sold_grouped.items():
-        if len(variants) == 1:
-            # فقط یک نسخه دارد
-            filtered_not_sold.append(variants[0]['product'])
-        else:
-            # هر دو نسخه دارد → گران‌تر را انتخاب کن
-            variants_sorted = sorted(variants, key=lambda x: x['price'], reverse=True)
-            selected = variants_sorted[0]
-            
-            print(f"\n   🔄 تکراری یافت شد - کد پایه: {base_code}")
-            for v in variants:
-                marker = "✅" if v == selected else "❌"
-                v_type = "رسمی" if v['is_official'] else "غیررسمی"
-                print(f"      {marker} {v_type} ({v['code']}): {v['price']:,.0f} تومان")
-            
-            filtered_not_sold.append(selected['product'])
-    
-    print(f"\n   بعد از حذف تکراری: {len(filtered_not_sold)}")
-    
-    # =====================================
-    # مرحله 4: حذف تکراری‌ها از "فرصت‌های از دست رفته"
-    # =====================================
-    
-    others_grouped = defaultdict(list)
-    
-    for product in filtered_sold_by_others:
-        code = str(product.get('product_code', '')).strip()
-        original_code, base_code, is_official = get_base_code(code)
-        
-        others_grouped[base_code].append({
-            'product': product,
-            'code': original_code,
-            'base_code': base_code,
-            'is_official': is_official,
-            'total_lost_amount': float(product.get('total_lost_amount', 0))
-        })
-    
-    # انتخاب یکی از رسمی/غیررسمی
-    final_sold_by_others = []
-    
-    for base_code, variants in others_grouped.items():
-        if len(variants) == 1:
-            final_sold_by_others.append(variants[0]['product'])
-        else:
-            # گران‌تر (بیشترین فرصت از دست رفته)
-            variants_sorted = sorted(variants, key=lambda x: x['total_lost_amount'], reverse=True)
-            selected = variants_sorted[0]
-            
-            print(f"\n   🔄 تکراری در از دست رفته - کد پایه: {base_code}")
-            for v in variants:
-                marker = "✅" if v == selected else "❌"
-                v_type = "رسمی" if v['is_official'] else "غیررسمی"
-                print(f"      {marker} {v_type} ({v['code']}): {v['total_lost_amount']:,.0f} تومان")
-            
-            final_sold_by_others.append(selected['product'])
-    
-    print(f"\n⚠️ فرصت‌های از دست رفته (بعد از حذف تکراری):")
-    print(f"   قبل: {len(filtered_sold_by_others)}")
-    print(f"   بعد: {len(final_sold_by_others)}")
-    
-    # =====================================
-    # نتیجه نهایی
-    # =====================================
-    
-    print("\n" + "="*70)
-    print("📊 نتیجه نهایی:")
-    print(f"   ✅ فروخته شده توسط من: {len(sold_by_me)} (بدون تغییر)")
-    print(f"   ⚠️ از دست رفته: {len(sold_by_others)} → {len(final_sold_by_others)}")
-    print(f"   🎯 نفروخته: {len(not_sold)} → {len(filtered_not_sold)}")
-    print("="*70 + "\n")
+    def get_base_codes(products):
+        """کد پایه هر محصول لیست (برداری)"""
+        codes = [str(product.get('product_code', '')).strip() for product in products]
+        return split_product_variant_codes(codes)['BaseCode'].tolist()
+    
+    def pick_one_per_base(products, base_codes, value_key):
+        """از هر کد پایه فقط یک محصول (بیشترین value_key، به ترتیب اولین ظهور)"""
+        selected = {}
+        for product, base_code in zip(products, base_codes):
+            value = float(product.get(value_key, 0))
+            if base_code not in selected or value > selected[base_code][0]:
+                selected[base_code] = (value, product)
+        return [product for _, product in selected.values()]
+    
+    # مرحله 1: کدهای پایه فروخته شده توسط من
+    my_sold_base_codes = set(get_base_codes(sold_by_me))
+    
+    # مرحله 2: حذف محصولاتی که من فروخته‌ام (هر دو نسخه) از "از دست رفته‌ها"
+    others_base_codes = get_base_codes(sold_by_others)
+    filtered_others = [(product, base_code) for product, base_code in zip(sold_by_others, others_base_codes)
+                       if base_code not in my_sold_base_codes]
+    
+    # مرحله 3: نفروخته‌ها - حذف فروخته‌های من و انتخاب گران‌تر از رسمی/غیررسمی
+    not_sold_base_codes = get_base_codes(not_sold)
+    remaining_not_sold = [(product, base_code) for product, base_code in zip(not_sold, not_sold_base_codes)
+                          if base_code not in my_sold_base_codes]
+    filtered_not_sold = pick_one_per_base([product for product, _ in remaining_not_sold],
+                                          [base_code for _, base_code in remaining_not_sold], 'price')
+    
+    # مرحله 4: از دست رفته‌ها - بیشترین فرصت از دست رفته از رسمی/غیررسمی
+    final_sold_by_others = pick_one_per_base([product for product, _ in filtered_others],
+                                             [base_code for _, base_code in filtered_others], 'total_lost_amount')
+    
+    print(f"🔍 فیلتر تکراری گزارش عملکرد (P99): از دست رفته {len(sold_by_others)} → {len(final_sold_by_others)}، "
+          f"نفروخته {len(not_sold)} → {len(filtered_not_sold)}")
     
     return sold_by_me, final_sold_by_others, filtered_not_sold
 
@@ -7985,15 +9583,14 @@ def api_get_brands_list():
             if not brands_df.empty:
                 brands_list = brands_df.to_dict('records')
         
-        # روش 2: استخراج از products.xlsx
+        # روش 2: استخراج از ایندکس کاتالوگ products.xlsx
         elif os.path.exists('products.xlsx'):
-            products_df = pd.read_excel('products.xlsx', sheet_name='products')
+            catalog_index = get_product_catalog_index()
             
-            if 'Brand' in products_df.columns:
-                unique_brands = products_df['Brand'].dropna().unique()
+            if catalog_index is not None:
                 brands_list = [
                     {'BrandID': i+1, 'BrandName': brand}
-                    for i, brand in enumerate(sorted(unique_brands))
+                    for i, brand in enumerate(brand for brand in catalog_index['brands'] if str(brand) not in ['', 'nan', 'None'])
                 ]
         
         brands_list = sorted(brands_list, key=lambda x: x['BrandName'])
@@ -8057,6 +9654,10 @@ def api_detailed_brand_sales_report():
         if not date_from_gregorian or not date_to_gregorian:
             return jsonify({'success': False, 'error': 'فرمت تاریخ نامعتبر است'}), 400
         
+        day_window = date_window_to_ordinals(date_from_gregorian, date_to_gregorian)
+        if day_window is None:
+            return jsonify({'success': False, 'error': 'فرمت تاریخ نامعتبر است'}), 400
+        
         print(f"   تاریخ میلادی: {date_from_gregorian} تا {date_to_gregorian}")
         
         # تعیین بازاریاب
@@ -8085,201 +9686,195 @@ def api_detailed_brand_sales_report():
             filter_by_salesperson = True  # فیلتر می‌کند
             print(f"   ✅ حالت: کاربر عادی - {target_salesperson} ({salesperson_code})")
         
-        # بارگذاری داده‌ها
-        sales_df = load_sales_from_excel()
-        products_df = load_products_from_excel()
-        
-        if sales_df.empty or products_df.empty:
-            return jsonify({
-                'success': True,
-                'brands_data': [],
-                'total_amount': 0,
-                'total_quantity': 0,
-                'report_title': f'گزارش فروش {target_salesperson}',
-                'date_from': date_from,
-                'date_to': date_to
-            })
-        
-        # تشخیص نام ستون تاریخ
-        date_column = None
-        if 'JalaliDate' in sales_df.columns:
-            date_column = 'JalaliDate'
-        elif 'InvoiceDate' in sales_df.columns:
-            date_column = 'InvoiceDate'
-        elif 'SaleDate' in sales_df.columns:
-            date_column = 'SaleDate'
-        else:
-            return jsonify({'success': False, 'error': 'ستون تاریخ در فایل یافت نشد'}), 500
-        
-        print(f"   ستون تاریخ: {date_column}")
-        
-        # تبدیل تاریخ‌های فروش
-        def convert_date_to_gregorian(date_value):
-            """تبدیل تاریخ به میلادی"""
-            if pd.isna(date_value):
-                return None
+        def build_report():
+            # بارگذاری داده‌ها
+            sales_df = load_sales_from_excel()
+            products_df = load_products_from_excel()
+            
+            if sales_df.empty or products_df.empty:
+                return {
+                    'success': True,
+                    'brands_data': [],
+                    'total_amount': 0,
+                    'total_quantity': 0,
+                    'report_title': f'گزارش فروش {target_salesperson}',
+                    'date_from': date_from,
+                    'date_to': date_to
+                }
             
-            date_str = str(date_value).strip()
+            # تشخیص نام ستون تاریخ
+            date_column = None
+            if 'JalaliDate' in sales_df.columns:
+                date_column = 'JalaliDate'
+            elif 'InvoiceDate' in sales_df.columns:
+                date_column = 'InvoiceDate'
+            elif 'SaleDate' in sales_df.columns:
+                date_column = 'SaleDate'
+            else:
+                return jsonify({'success': False, 'error': 'ستون تاریخ در فایل یافت نشد'}), 500
             
-            # اگر قبلاً میلادی است (YYYY-MM-DD)
-            if '-' in date_str and len(date_str) == 10:
-                return date_str
+            print(f"   ستون تاریخ: {date_column}")
             
-            # اگر شمسی است (YYYY/MM/DD)
-            if '/' in date_str:
-                return jalali_to_gregorian(date_str)
+            if date_column == 'InvoiceDate':
+                # فیلتر بر اساس تاریخ (جستجوی دودویی روی ایندکس تاریخ)
+                sales_filtered = sales_between(*day_window)
+            else:
+                # تبدیل تاریخ‌ها
+                sales_df_copy = sales_df.copy()
+                sales_df_copy['DateConverted'] = convert_date_column(sales_df_copy[date_column])['GregorianDate']
             
-            return None
-        
-        # تبدیل تاریخ‌ها
-        sales_df_copy = sales_df.copy()
-        sales_df_copy['DateConverted'] = sales_df_copy[date_column].apply(convert_date_to_gregorian)
-        
-        # حذف ردیف‌های بدون تاریخ
-        sales_df_copy = sales_df_copy.dropna(subset=['DateConverted'])
-        
-        print(f"   فروش کل: {len(sales_df_copy)} سفارش")
-        
-        # فیلتر بر اساس تاریخ
-        sales_filtered = sales_df_copy[
-            (sales_df_copy['DateConverted'] >= date_from_gregorian) & 
-            (sales_df_copy['DateConverted'] <= date_to_gregorian)
-        ].copy()
-        
-        print(f"   فروش در بازه زمانی: {len(sales_filtered)} سفارش")
-        
-        # ✅ فیلتر بر اساس بازاریاب (فقط اگر لازم باشد)
-        if filter_by_salesperson:
-            print(f"   🔍 فیلتر بازاریاب فعال: {salesperson_code}")
-            
-            # تشخیص نام ستون بازاریاب
-            salesperson_column = None
-            if 'SalespersonCode' in sales_filtered.columns:
-                salesperson_column = 'SalespersonCode'
-                print(f"   ✅ ستون بازاریاب: SalespersonCode")
-            elif 'VisitorCode' in sales_filtered.columns:
-                salesperson_column = 'VisitorCode'
-                print(f"   ✅ ستون بازاریاب: VisitorCode")
-            elif 'BazaryabCode' in sales_filtered.columns:
-                salesperson_column = 'BazaryabCode'
-                print(f"   ✅ ستون بازاریاب: BazaryabCode")
-            
-            if salesperson_column:
-                # فیلتر
-                before_filter = len(sales_filtered)
-                sales_filtered = sales_filtered[
-                    sales_filtered[salesperson_column].astype(str).str.strip() == str(salesperson_code).strip()
+                # حذف ردیف‌های بدون تاریخ
+                sales_df_copy = sales_df_copy.dropna(subset=['DateConverted'])
+            
+                print(f"   فروش کل: {len(sales_df_copy)} سفارش")
+            
+                # فیلتر بر اساس تاریخ
+                sales_filtered = sales_df_copy[
+                    (sales_df_copy['DateConverted'] >= date_from_gregorian) & 
+                    (sales_df_copy['DateConverted'] <= date_to_gregorian)
                 ]
-                after_filter = len(sales_filtered)
-                print(f"   فروش بازاریاب: {before_filter} → {after_filter} سفارش")
+            
+            print(f"   فروش در بازه زمانی: {len(sales_filtered)} سفارش")
+            
+            # ✅ فیلتر بر اساس بازاریاب (فقط اگر لازم باشد)
+            if filter_by_salesperson:
+                print(f"   🔍 فیلتر بازاریاب فعال: {salesperson_code}")
+            
+                # تشخیص نام ستون بازاریاب
+                salesperson_column = None
+                if 'SalespersonCode' in sales_filtered.columns:
+                    salesperson_column = 'SalespersonCode'
+                    print(f"   ✅ ستون بازاریاب: SalespersonCode")
+                elif 'VisitorCode' in sales_filtered.columns:
+                    salesperson_column = 'VisitorCode'
+                    print(f"   ✅ ستون بازاریاب: VisitorCode")
+                elif 'BazaryabCode' in sales_filtered.columns:
+                    salesperson_column = 'BazaryabCode'
+                    print(f"   ✅ ستون بازاریاب: BazaryabCode")
+            
+                if salesperson_column:
+                    # فیلتر
+                    before_filter = len(sales_filtered)
+                    sales_filtered = sales_filtered[
+                        sales_filtered[salesperson_column].astype(str).str.strip() == str(salesperson_code).strip()
+                    ]
+                    after_filter = len(sales_filtered)
+                    print(f"   فروش بازاریاب: {before_filter} → {after_filter} سفارش")
+                else:
+                    print(f"   ⚠️ ستون بازاریاب یافت نشد - فیلتر اعمال نمی‌شود")
             else:
-                print(f"   ⚠️ ستون بازاریاب یافت نشد - فیلتر اعمال نمی‌شود")
-        else:
-            print(f"   ℹ️  فیلتر بازاریاب غیرفعال (همه بازاریاب‌ها)")
-        
-        if sales_filtered.empty:
-            return jsonify({
-                'success': True,
-                'brands_data': [],
-                'total_amount': 0,
-                'total_quantity': 0,
-                'report_title': f'گزارش فروش {target_salesperson}',
-                'date_from': date_from,
-                'date_to': date_to
-            })
-        
-        # Merge با محصولات
-        sales_with_brand = sales_filtered.merge(
-            products_df[['ProductCode', 'ProductName', 'Brand']],
-            on='ProductCode',
-            how='left'
-        )
-        
-        sales_with_brand['Brand'] = sales_with_brand['Brand'].fillna('نامشخص')
-        
-        # فیلتر بر اساس برندها
-        sales_with_brand = sales_with_brand[
-            sales_with_brand['Brand'].isin(selected_brands)
-        ]
-        
-        print(f"   فروش برندهای انتخابی: {len(sales_with_brand)} سفارش")
-        
-        # تشخیص ستون مبلغ و تعداد
-        amount_column = 'TotalPrice' if 'TotalPrice' in sales_with_brand.columns else 'TotalAmount'
-        quantity_column = 'Quantity'
-        
-        # محاسبه فروش هر محصول در هر برند
-        product_sales = sales_with_brand.groupby(['Brand', 'ProductCode', 'ProductName']).agg({
-            amount_column: 'sum',
-            quantity_column: 'sum'
-        }).reset_index()
-        
-        product_sales.columns = ['Brand', 'ProductCode', 'ProductName', 'Amount', 'Quantity']
-        
-        # محاسبه فروش هر برند
-        brand_sales = sales_with_brand.groupby('Brand').agg({
-            amount_column: 'sum',
-            quantity_column: 'sum'
-        }).reset_index()
-        
-        brand_sales.columns = ['Brand', 'TotalAmount', 'TotalQuantity']
-        brand_sales = brand_sales.sort_values('TotalAmount', ascending=False)
-        
-        # ساخت گزارش نهایی
-        brands_data = []
-        
-        for _, brand_row in brand_sales.iterrows():
-            brand_name = brand_row['Brand']
-            brand_total = float(brand_row['TotalAmount'])
-            brand_quantity = int(brand_row['TotalQuantity'])
+                print(f"   ℹ️  فیلتر بازاریاب غیرفعال (همه بازاریاب‌ها)")
             
-            # محصولات این برند
-            brand_products = product_sales[product_sales['Brand'] == brand_name]
-            brand_products = brand_products.sort_values('Amount', ascending=False)
+            if sales_filtered.empty:
+                return {
+                    'success': True,
+                    'brands_data': [],
+                    'total_amount': 0,
+                    'total_quantity': 0,
+                    'report_title': f'گزارش فروش {target_salesperson}',
+                    'date_from': date_from,
+                    'date_to': date_to
+                }
             
-            products_list = []
-            for _, prod in brand_products.iterrows():
-                products_list.append({
-                    'product_code': str(prod['ProductCode']),
-                    'product_name': str(prod['ProductName']),
-                    'amount': float(prod['Amount']),
-                    'quantity': int(prod['Quantity'])
+            # Merge با محصولات
+            sales_with_brand = sales_filtered.merge(
+                products_df[['ProductCode', 'ProductName', 'Brand']],
+                on='ProductCode',
+                how='left'
+            )
+            
+            sales_with_brand['Brand'] = sales_with_brand['Brand'].fillna('نامشخص')
+            
+            # فیلتر بر اساس برندها
+            sales_with_brand = sales_with_brand[
+                sales_with_brand['Brand'].isin(selected_brands)
+            ]
+            
+            print(f"   فروش برندهای انتخابی: {len(sales_with_brand)} سفارش")
+            
+            # تشخیص ستون مبلغ و تعداد
+            amount_column = 'TotalPrice' if 'TotalPrice' in sales_with_brand.columns else 'TotalAmount'
+            quantity_column = 'Quantity'
+            
+            # محاسبه فروش هر محصول در هر برند
+            product_sales = sales_with_brand.groupby(['Brand', 'ProductCode', 'ProductName']).agg({
+                amount_column: 'sum',
+                quantity_column: 'sum'
+            }).reset_index()
+            
+            product_sales.columns = ['Brand', 'ProductCode', 'ProductName', 'Amount', 'Quantity']
+            
+            # محاسبه فروش هر برند
+            brand_sales = sales_with_brand.groupby('Brand').agg({
+                amount_column: 'sum',
+                quantity_column: 'sum'
+            }).reset_index()
+            
+            brand_sales.columns = ['Brand', 'TotalAmount', 'TotalQuantity']
+            brand_sales = brand_sales.sort_values('TotalAmount', ascending=False)
+            
+            # ساخت گزارش نهایی
+            brands_data = []
+            
+            for _, brand_row in brand_sales.iterrows():
+                brand_name = brand_row['Brand']
+                brand_total = float(brand_row['TotalAmount'])
+                brand_quantity = int(brand_row['TotalQuantity'])
+            
+                # محصولات این برند
+                brand_products = product_sales[product_sales['Brand'] == brand_name]
+                brand_products = brand_products.sort_values('Amount', ascending=False)
+            
+                products_list = []
+                for _, prod in brand_products.iterrows():
+                    products_list.append({
+                        'product_code': str(prod['ProductCode']),
+                        'product_name': str(prod['ProductName']),
+                        'amount': float(prod['Amount']),
+                        'quantity': int(prod['Quantity'])
+                    })
+            
+                brands_data.append({
+                    'brand_name': str(brand_name),
+                    'total_amount': brand_total,
+                    'total_quantity': brand_quantity,
+                    'products': products_list
                 })
             
-            brands_data.append({
-                'brand_name': str(brand_name),
-                'total_amount': brand_total,
-                'total_quantity': brand_quantity,
-                'products': products_list
-            })
-        
-        # محاسبه مجموع کل
-        total_amount = float(brand_sales['TotalAmount'].sum())
-        total_quantity = int(brand_sales['TotalQuantity'].sum())
-        
-        print(f"\n✅ گزارش آماده شد:")
-        print(f"   تعداد برندها: {len(brands_data)}")
-        print(f"   مجموع فروش: {total_amount:,.0f} تومان")
-        print(f"   مجموع تعداد: {total_quantity:,.0f} عدد")
-        
-        print(f"\n   📊 برندهای برتر:")
-        for i, brand in enumerate(brands_data[:5], 1):
-            percentage = (brand['total_amount'] / total_amount * 100) if total_amount > 0 else 0
-            print(f"      {i}. {brand['brand_name']}: {brand['total_amount']:,.0f} تومان ({percentage:.1f}%)")
-            print(f"         محصولات: {len(brand['products'])} محصول")
-        
-        print("="*70 + "\n")
-        
-        return jsonify({
-            'success': True,
-            'brands_data': brands_data,
-            'total_amount': total_amount,
-            'total_quantity': total_quantity,
-            'report_title': f'گزارش فروش {target_salesperson}',
-            'date_from': date_from,
-            'date_to': date_to
-        })
-        
+            # محاسبه مجموع کل
+            total_amount = float(brand_sales['TotalAmount'].sum())
+            total_quantity = int(brand_sales['TotalQuantity'].sum())
+            
+            print(f"\n✅ گزارش آماده شد:")
+            print(f"   تعداد برندها: {len(brands_data)}")
+            print(f"   مجموع فروش: {total_amount:,.0f} تومان")
+            print(f"   مجموع تعداد: {total_quantity:,.0f} عدد")
+            
+            print(f"\n   📊 برندهای برتر:")
+            for i, brand in enumerate(brands_data[:5], 1):
+                percentage = (brand['total_amount'] / total_amount * 100) if total_amount > 0 else 0
+                print(f"      {i}. {brand['brand_name']}: {brand['total_amount']:,.0f} تومان ({percentage:.1f}%)")
+                print(f"         محصولات: {len(brand['products'])} محصول")
+            
+            print("="*70 + "\n")
+            
+            return {
+                'success': True,
+                'brands_data': brands_data,
+                'total_amount': total_amount,
+                'total_quantity': total_quantity,
+                'report_title': f'گزارش فروش {target_salesperson}',
+                'date_from': date_from,
+                'date_to': date_to
+            }
+
+        # نتیجه از کش گزارش‌ها؛ درخواست‌های همزمان یکسان فقط یک بار محاسبه می‌شوند
+        versions = get_dataset_versions('sales.xlsx', 'products.xlsx', USERS_FILE)
+        return cached_report_response('detailed_brand_sales',
+                                      {'salesperson_code': salesperson_code, 'date_from': date_from,
+                                       'date_to': date_to, 'brands': selected_brands},
+                                      (user['Typev'],), versions, build_report)
+
     except Exception as e:
         print(f"❌ خطا در تولید گزارش: {e}")
         import traceback